@@ -3,31 +3,51 @@
 Add images to a dataset.
 
 If a filename is already in the dataset, it will be skipped.
+
+Files are found by a streaming walk of the inputs, probed and hashed by a pool
+of worker processes, and added to the dataset in order, in batches. What was
+learned about each file is kept in {dsfile}.stat, so unchanged files are never
+read twice.
 """
 import argparse
+import collections
+import concurrent.futures
 import os
-import hashlib
+import time
 import util
 import PIL
 
+# How many records to write to the dataset at a time.
+BATCH = 1000
+
 
 def walk_dir(path):
     """
-    Recursively walk the given path and return a list of filenames.
+    Recursively walk the given path and yield filenames, in sorted order,
+    without listing the whole tree first.
     """
-    out = []
-    for dirpath, dirnames, filenames in os.walk(path):
-        for fn in filenames:
-            out.append(f"{dirpath}/{fn}")
-    return out
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            # Sort a dir by its children's paths, so the result is the same as
+            # sorting every filename.
+            entries.append((entry.name + "/" if is_dir else entry.name, entry))
+    for key, entry in sorted(entries, key=lambda i: i[0]):
+        if not key.endswith("/"):
+            yield f"{path}/{entry.name}"
+        elif not entry.is_symlink():
+            yield from walk_dir(f"{path}/{entry.name}")
 
 
 def md5(fn):
     """
     Returns the hex md5sum of the given filename.
     """
-    with open(fn, "rb") as f:
-        return hashlib.md5(f.read()).hexdigest()
+    return util.md5_file(fn)
 
 
 def center_crop(obj):
@@ -58,6 +78,166 @@ def pad_to_square(obj):
         obj["y"] = 0
 
 
+def probe(fn, with_dhash):
+    """
+    Runs in a worker process. Returns (stat, md5, w, h, dhash) for image fn,
+    where stat is from util.StatIndex.stat before reading it and dhash is
+    None unless with_dhash.
+    """
+    st = util.StatIndex.stat(fn)
+    w, h = util.probe_image(fn)
+    dhash = util.dhash(fn) if with_dhash else None
+    return st, md5(fn), w, h, dhash
+
+
+def new_record(fn, fsz, cksum, w, h, no_pad):
+    """
+    Returns the new metadata object for image fn.
+    """
+    obj = {
+        "fn": fn,
+        "md5": cksum,
+        "fsz": fsz,
+        "orig_w": w,
+        "orig_h": h,
+        "rot": 0,
+        "needs_rebuild": 1,
+    }
+    if no_pad:
+        center_crop(obj)
+    else:
+        pad_to_square(obj)
+    return obj
+
+
+def find_new(ds, inputs, dsdir, onefile):
+    """
+    Yields the filenames under `inputs`, relative to dsdir, that should be
+    added to the dataset.
+    """
+    # Walk the inputs in the same order as their contents would sort.
+    inputs = sorted(
+        inputs, key=lambda i: os.path.relpath(i, dsdir) + "/" * os.path.isdir(i)
+    )
+    queued = set()
+    seen_dirs = set()
+    for i in inputs:
+        if os.path.isdir(i):
+            fns = walk_dir(i)
+        else:
+            assert os.path.isfile(i), i
+            fns = [i]
+        for fn in fns:
+            fn = os.path.relpath(fn, dsdir)
+            if fn in queued:
+                continue
+            queued.add(fn)
+
+            # Skip seen files.
+            if ds.seen_fn(fn):
+                print(f"seen {fn!r}")
+                continue
+
+            # Honor onefile if set.
+            if onefile:
+                subdir = os.path.dirname(fn)
+                if subdir in seen_dirs:
+                    print(f"skipping {fn!r} because seen {subdir!r}")
+                    continue
+                seen_dirs.add(subdir)
+
+            yield fn
+
+
+def load_dupes(ds, max_dist):
+    """
+    Returns a DupeIndex of the records in ds that have a dhash, by fn.
+    """
+    dupes = util.DupeIndex(max_dist)
+    for obj in ds._data.values():
+        if "dhash" in obj:
+            dupes.add(obj["fn"], obj["dhash"])
+    return dupes
+
+
+def check_near_dupe(dupes, obj, mode):
+    """
+    Flags obj with "dupe_of" if it's a near duplicate of a file in dupes, and
+    adds it to dupes. Returns False if it should be skipped instead.
+    """
+    match = dupes.query(obj["dhash"])
+    if match:
+        dist, other = match[0]
+        if mode == "skip":
+            print(f"skipping {obj['fn']!r}, near duplicate of {other!r} ({dist} bits)")
+            return False
+        print(f"flagging {obj['fn']!r}, near duplicate of {other!r} ({dist} bits)")
+        obj["dupe_of"] = other
+    dupes.add(obj["fn"], obj["dhash"])
+    return True
+
+
+def add(ds, fns, args, pool, index, dupes):
+    """
+    Probes fns in `pool` and adds them to ds, in order, BATCH at a time.
+    Files that `index` already knows are not read again. If dupes is set,
+    near duplicates are handled as args.near_dupes says.
+    """
+    start = last_report = time.monotonic()
+    done = added = nbytes = 0
+    batch = []
+    in_flight = collections.deque()
+    while True:
+        # Keep the pool busy without queueing the whole walk.
+        while len(in_flight) < args.jobs * 4:
+            fn = next(fns, None)
+            if fn is None:
+                break
+            st = util.StatIndex.stat(fn)
+            known = index.get(fn, st)
+            if known is None or (dupes is not None and known[3] is None):
+                future = pool.submit(probe, fn, dupes is not None)
+                read = True
+            else:
+                future = concurrent.futures.Future()
+                future.set_result((st, *known))
+                read = False
+            in_flight.append((fn, future, read))
+        if not in_flight:
+            break
+        fn, future, read = in_flight.popleft()
+        done += 1
+        try:
+            st, cksum, w, h, dhash = future.result()
+        except PIL.UnidentifiedImageError as e:
+            print(f"WARN: skipping {fn} because {e}")
+        else:
+            if read:
+                index.put(fn, st, cksum, w, h, dhash)
+                nbytes += st[0]
+            obj = new_record(fn, st[0], cksum, w, h, args.no_pad)
+            if dhash is not None:
+                obj["dhash"] = dhash
+            if dupes is None or check_near_dupe(dupes, obj, args.near_dupes):
+                batch.append(obj)
+                added += 1
+        if len(batch) >= BATCH:
+            ds.add_many(batch)
+            index.flush()
+            batch = []
+
+        now = time.monotonic()
+        if now - last_report >= args.report_secs:
+            last_report = now
+            elapsed = now - start
+            print(
+                f"{done} files, {added} added, {done / elapsed:.1f} files/sec, "
+                f"{nbytes / elapsed / 1e6:.1f} MB/sec read"
+            )
+    ds.add_many(batch)
+    print(f"added {added} of {done} files in {time.monotonic() - start:.1f} sec")
+
+
 def main():
     p = argparse.ArgumentParser()
     p.add_argument(
@@ -70,6 +250,32 @@ def main():
         help="Don't pad to square aspect; center crop instead.",
         action="store_true",
     )
+    p.add_argument(
+        "--near_dupes",
+        choices=["flag", "skip", "off"],
+        default="off",
+        help="What to do with files that look like one already added: set "
+        "dupe_of on them, leave them out, or don't check. Checking computes "
+        "a dhash, which decodes every new file (at reduced size for JPEGs).",
+    )
+    p.add_argument(
+        "--dupe_dist",
+        type=int,
+        default=4,
+        help="How many bits of dhash near duplicates can differ by.",
+    )
+    p.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes.",
+    )
+    p.add_argument(
+        "--report_secs",
+        type=float,
+        default=5,
+        help="How often to print progress.",
+    )
     p.add_argument("dsfile", help="JSON dataset file to add to.")
     p.add_argument("inputs", nargs="+", help="Dirs and files to add.")
     args = p.parse_args()
@@ -93,55 +299,16 @@ def main():
         print("exiting due to bad inputs")
 
     # Load dataset.
-    ds = util.Dataset(args.dsfile)
+    ds = util.open_dataset(args.dsfile)
 
-    # Build list of inputs.
-    fns = []
-    for i in args.inputs:
-        if os.path.isdir(i):
-            fns += walk_dir(i)
-        else:
-            assert os.path.isfile(i), i
-            fns.append(i)
-    fns = [os.path.relpath(i, dsdir) for i in fns]
-    fns.sort()
+    dupes = None
+    if args.near_dupes != "off":
+        dupes = load_dupes(ds, args.dupe_dist)
 
-    # Process.
-    seen_dirs = set()
-    for fn in fns:
-        # Skip seen files.
-        if ds.seen_fn(fn):
-            print(f"seen {fn!r}")
-            continue
-
-        # Honor onefile if set.
-        if args.onefile:
-            subdir = os.path.dirname(fn)
-            if subdir in seen_dirs:
-                print(f"skipping {fn!r} because seen {subdir!r}")
-                continue
-            seen_dirs.add(subdir)
-
-        print(f"processing {fn}")
-        try:
-            img = util.load_image(fn)
-        except PIL.UnidentifiedImageError as e:
-            print(f"WARN: skipping {fn} because {e}")
-            continue
-        obj = {
-            "fn": fn,
-            "md5": md5(fn),
-            "fsz": os.path.getsize(fn),
-            "orig_w": img.width,
-            "orig_h": img.height,
-            "rot": 0,
-            "needs_rebuild": 1,
-        }
-        if args.no_pad:
-            center_crop(obj)
-        else:
-            pad_to_square(obj)
-        ds.add(obj)
+    fns = find_new(ds, args.inputs, dsdir, args.onefile)
+    with util.StatIndex.for_dataset(args.dsfile) as index:
+        with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+            add(ds, fns, args, pool, index, dupes)
 
 
 if __name__ == "__main__":
@@ -6,11 +6,14 @@ Areas in purple (#FF00FF) in the input mask are masked out (converted to dark),
 other areas are kept (converted to light) in the output mask.
 """
 import argparse
-from util import Dataset
+from util import open_dataset
 from PIL import Image
 import numpy as np
 import os
 
+# How many records to write to the dataset at a time.
+BATCH = 100
+
 
 def main():
     p = argparse.ArgumentParser()
@@ -19,11 +22,11 @@ def main():
 
     for fn in args.inputs:
         print(f"loading {fn}")
-        ds = Dataset(fn)
+        ds = open_dataset(fn)
 
-        for n, md in ds._data.items():
-            if md.get("mask_state", "") != "prep":
-                continue
+        batch = []
+        for n in ds.select(mask_state="prep"):
+            md = ds._data[n]
             mask_fn = md["mask_fn"]
             assert ".prep.mask.png" in mask_fn, mask_fn
             out_fn = mask_fn.replace(".prep.mask.png", ".mask.png")
@@ -41,7 +44,11 @@ def main():
 
             md["mask_fn"] = out_fn
             md["mask_state"] = "done"
-            ds.add(md)
+            batch.append(md)
+            if len(batch) >= BATCH:
+                ds.add_many(batch)
+                batch = []
+        ds.add_many(batch)
 
         print("compacting")
         ds.compact()
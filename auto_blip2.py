@@ -12,7 +12,7 @@ import os
 if "TRANSFORMERS_OFFLINE" not in os.environ:
     os.environ["TRANSFORMERS_OFFLINE"] = "1"
 import argparse
-from util import Dataset
+from util import open_dataset
 from PIL import Image, ImageOps
 import io
 import torch
@@ -21,6 +21,9 @@ import transformers
 # Trade-off: use default size to get cache hits, BLIP will scale images down to 384px.
 SZ = 512
 
+# How many captioned records to write to the dataset at a time.
+BATCH = 32
+
 
 def main():
     p = argparse.ArgumentParser()
@@ -42,6 +45,17 @@ def main():
         help="Regenerate existing autocaptions.",
         action="store_true",
     )
+    p.add_argument(
+        "--cache_dir",
+        default=None,
+        help="Use the shared thumbnail cache in this dir. (optional)",
+    )
+    p.add_argument(
+        "--shard",
+        type=int,
+        default=None,
+        help="Only process this shard of a sharded dataset. (optional)",
+    )
     args = p.parse_args()
 
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
@@ -64,45 +78,61 @@ def main():
     key = "auto_blip2"
     for fn in args.inputs:
         logging.info(f"loading dataset {fn}")
-        ds = Dataset(fn)
-
-        ln = len(ds._data.items())
-        for n, md in ds._data.items():
-            if not args.override:
-                if key in md:
-                    logging.info(f"already has {key!r}, skipping {md}, try --override")
-                    continue
-            jpg = ds.masked_thumbnail(n, SZ, color=(0, 0, 0))
-            img = Image.open(io.BytesIO(jpg))
-            sz = max(img.width, img.height)
-            img = ImageOps.pad(img, (sz, sz))
-
-            with torch.no_grad():  # matters
-                # BLIP
-                inputs = blip_processor(img, args.blip_prefix, return_tensors="pt").to(
-                    device, torch.float16  # dtype is important
-                )
-                outputs = blip_model.generate(
-                    **inputs,
-                    max_length=args.max_length,
-                    min_length=args.min_length,
-                    num_beams=args.num_beams,
-                    num_return_sequences=args.num_gen,
-                    do_sample=True,
-                )
-                captions = blip_processor.batch_decode(
-                    outputs, skip_special_tokens=True
-                )  # List of strings.
-                crop = len(args.blip_prefix)
-                captions = [args.clip_prefix + i[crop:] for i in captions]
-                captions = [i.strip() for i in captions]
-                md[key] = captions
-
-            ds.add(md)
-            logging.info(f'{n+1}/{ln} {md["fn"]} {captions}')
+        ds = open_dataset(fn, cache_dir=args.cache_dir, shard=args.shard)
+
+        if args.override:
+            todo = list(ds._data.keys())
+        else:
+            todo = ds.select(**{key: False})
+            logging.info(
+                f"{len(ds._data) - len(todo)} records already have {key!r}, "
+                "skipping them, try --override"
+            )
+        ln = len(todo)
+        batch = []
+        try:
+            for i, n in enumerate(todo):
+                md = ds._data[n]
+                jpg = ds.masked_thumbnail(n, SZ, color=(0, 0, 0))
+                img = Image.open(io.BytesIO(jpg))
+                sz = max(img.width, img.height)
+                img = ImageOps.pad(img, (sz, sz))
+
+                with torch.no_grad():  # matters
+                    # BLIP
+                    inputs = blip_processor(
+                        img, args.blip_prefix, return_tensors="pt"
+                    ).to(
+                        device, torch.float16  # dtype is important
+                    )
+                    outputs = blip_model.generate(
+                        **inputs,
+                        max_length=args.max_length,
+                        min_length=args.min_length,
+                        num_beams=args.num_beams,
+                        num_return_sequences=args.num_gen,
+                        do_sample=True,
+                    )
+                    captions = blip_processor.batch_decode(
+                        outputs, skip_special_tokens=True
+                    )  # List of strings.
+                    crop = len(args.blip_prefix)
+                    captions = [args.clip_prefix + i[crop:] for i in captions]
+                    captions = [i.strip() for i in captions]
+                    md[key] = captions
+
+                batch.append(md)
+                if len(batch) >= BATCH:
+                    ds.add_many(batch, keys=[key])
+                    batch = []
+                logging.info(f'{i+1}/{ln} {md["fn"]} {captions}')
+        finally:
+            # Don't lose finished captions if interrupted.
+            ds.add_many(batch, keys=[key])
 
         print("compacting")
         ds.compact()
+        ds.flush()
 
 
 if __name__ == "__main__":
@@ -13,7 +13,7 @@ import os
 if "TRANSFORMERS_OFFLINE" not in os.environ:
     os.environ["TRANSFORMERS_OFFLINE"] = "1"
 import argparse
-from util import Dataset
+from util import open_dataset
 from PIL import Image
 import io
 import torch
@@ -22,6 +22,9 @@ import open_clip
 # Trade-off: use default size to get cache hits, BLIP will scale images down to 384px.
 SZ = 512
 
+# How many captioned records to write to the dataset at a time.
+BATCH = 32
+
 
 def main():
     p = argparse.ArgumentParser()
@@ -31,6 +34,17 @@ def main():
         help="Regenerate existing autocaptions.",
         action="store_true",
     )
+    p.add_argument(
+        "--cache_dir",
+        default=None,
+        help="Use the shared thumbnail cache in this dir. (optional)",
+    )
+    p.add_argument(
+        "--shard",
+        type=int,
+        default=None,
+        help="Only process this shard of a sharded dataset. (optional)",
+    )
     args = p.parse_args()
 
     device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
@@ -45,36 +59,50 @@ def main():
     key = "auto_coca"
     for fn in args.inputs:
         logging.info(f"loading dataset {fn}")
-        ds = Dataset(fn)
+        ds = open_dataset(fn, cache_dir=args.cache_dir, shard=args.shard)
 
-        ln = len(ds._data.items())
-        for n, md in ds._data.items():
-            if not args.override:
-                if key in md:
-                    logging.info(f"already has {key!r}, skipping {md}, try --override")
-                    continue
-            jpg = ds.masked_thumbnail(n, SZ, color=(0, 0, 0))
-            im = Image.open(io.BytesIO(jpg)).convert("RGB")
-            im = transform(im).unsqueeze(0)
-            im = im.to(device, torch.float16)
+        if args.override:
+            todo = list(ds._data.keys())
+        else:
+            todo = ds.select(**{key: False})
+            logging.info(
+                f"{len(ds._data) - len(todo)} records already have {key!r}, "
+                "skipping them, try --override"
+            )
+        ln = len(todo)
+        batch = []
+        try:
+            for i, n in enumerate(todo):
+                md = ds._data[n]
+                jpg = ds.masked_thumbnail(n, SZ, color=(0, 0, 0))
+                im = Image.open(io.BytesIO(jpg)).convert("RGB")
+                im = transform(im).unsqueeze(0)
+                im = im.to(device, torch.float16)
 
-            with torch.no_grad(), torch.cuda.amp.autocast():
-                generated = model.generate(im)
-                p = (
-                    open_clip.decode(generated[0])
-                    .split("<end_of_text>")[0]
-                    .replace("<start_of_text>", "")
-                )
-                if p.endswith(" . "):
-                    p = p[:-3]
-                p = p.strip()
-                md[key] = [p]
+                with torch.no_grad(), torch.cuda.amp.autocast():
+                    generated = model.generate(im)
+                    p = (
+                        open_clip.decode(generated[0])
+                        .split("<end_of_text>")[0]
+                        .replace("<start_of_text>", "")
+                    )
+                    if p.endswith(" . "):
+                        p = p[:-3]
+                    p = p.strip()
+                    md[key] = [p]
 
-            ds.add(md)
-            logging.info(f'{n+1}/{ln} {md["fn"]} {p!r}')
+                batch.append(md)
+                if len(batch) >= BATCH:
+                    ds.add_many(batch, keys=[key])
+                    batch = []
+                logging.info(f'{i+1}/{ln} {md["fn"]} {p!r}')
+        finally:
+            # Don't lose finished captions if interrupted.
+            ds.add_many(batch, keys=[key])
 
         print("compacting")
         ds.compact()
+        ds.flush()
 
 
 if __name__ == "__main__":
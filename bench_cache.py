@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Benchmark the thumbnail cache.
+
+Compares the old write path (one commit per insert) against the
+group-committed backends, and the old JSON string keys against the packed
+binary keys for lookup latency and on-disk index size. Every backend in
+util.CACHE_BACKENDS runs the same benchmark.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import util
+
+
+class OldDB:
+    """
+    The previous util.DB: JSON string keys in a rowid table, committing after
+    every insert.
+    """
+
+    def __init__(self, fn):
+        self._db = sqlite3.connect(fn)
+        self._db.execute("CREATE TABLE IF NOT EXISTS db(key PRIMARY KEY, value)")
+
+    def __getitem__(self, key):
+        ret = self._db.execute("SELECT value FROM db WHERE key=?", (key,)).fetchone()
+        if ret is None:
+            raise KeyError()
+        return ret[0]
+
+    def __setitem__(self, key, value):
+        self._db.execute("REPLACE INTO db VALUES(?, ?)", (key, value))
+        self._db.commit()
+
+    def flush(self):
+        pass
+
+
+def fake_record(i):
+    return {
+        "md5": "%032x" % random.getrandbits(128),
+        "x": 0,
+        "y": -(i % 500),
+        "w": 4000 + i % 1000,
+        "h": 4000 + i % 1000,
+        "rot": i % 4,
+    }
+
+
+def old_key(o, sz):
+    key = dict(o)
+    key["sz"] = sz
+    return json.dumps(key, sort_keys=True)
+
+
+def bench_inserts(db, keys, value):
+    start = time.monotonic()
+    for key in keys:
+        db[key] = value
+    db.flush()
+    return len(keys) / (time.monotonic() - start)
+
+
+def bench_lookups(get, keys, num):
+    keys = random.sample(keys, min(num, len(keys)))
+    start = time.monotonic()
+    for key in keys:
+        get(key)
+    return (time.monotonic() - start) / len(keys) * 1e6
+
+
+def index_size(fn, names):
+    """
+    Returns the bytes used by the given sqlite tables and indexes.
+    """
+    db = sqlite3.connect(fn)
+    try:
+        rows = db.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name")
+        return sum(size for name, size in rows if name in names)
+    except sqlite3.OperationalError:
+        # No dbstat, the whole file is close enough with tiny values.
+        return os.path.getsize(fn)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--inserts", type=int, default=5000, help="Number of inserts.")
+    p.add_argument("--value_size", type=int, default=50000, help="Bytes per value.")
+    p.add_argument(
+        "--entries", type=int, default=1000000, help="Entries for lookup benchmark."
+    )
+    p.add_argument("--lookups", type=int, default=100000, help="Number of lookups.")
+    p.add_argument("--dir", default=None, help="Where to put the temp DBs.")
+    args = p.parse_args()
+
+    print(f"== inserts ({args.inserts} x {args.value_size} bytes)")
+    value = os.urandom(args.value_size)
+    records = [fake_record(i) for i in range(max(args.inserts, args.entries))]
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        keys = [old_key(o, 512) for o in records[: args.inserts]]
+        before = bench_inserts(OldDB(f"{tmp}/old.cache"), keys, value)
+        print(f"before: {before:.0f} inserts/sec")
+        keys = [util.cache_key(o, 512) for o in records[: args.inserts]]
+        for name, backend in util.CACHE_BACKENDS.items():
+            after = bench_inserts(backend(f"{tmp}/{name}.cache"), keys, value)
+            print(f"{name}: {after:.0f} inserts/sec ({after / before:.1f}x)")
+
+    print(f"== lookups ({args.entries} entries, {args.lookups} lookups)")
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        old = OldDB(f"{tmp}/old.cache")
+        keys = [old_key(o, 512) for o in records[: args.entries]]
+        old._db.executemany("INSERT INTO db VALUES(?, x'00')", [(k,) for k in keys])
+        old._db.commit()
+        us = bench_lookups(old.__getitem__, keys, args.lookups)
+        sz = index_size(f"{tmp}/old.cache", ["db", "sqlite_autoindex_db_1"])
+        print(f"before: {us:.1f} us/lookup, index {sz / 1e6:.1f} MB")
+
+        keys = [util.cache_key(o, 512) for o in records[: args.entries]]
+        for name, backend in util.CACHE_BACKENDS.items():
+            base = f"{tmp}/{name}.cache"
+            cache = backend(base, batch_size=args.entries + 1)
+            for key in keys:
+                cache[key] = b"\x00"
+            cache.flush()
+            us = bench_lookups(cache.__getitem__, keys, args.lookups)
+            view_us = bench_lookups(cache.view, keys, args.lookups)
+            if name == "sqlite":
+                sz = index_size(base, ["keys", "keys_atime"])
+            else:
+                sz = os.path.getsize(f"{base}.idx")
+            print(
+                f"{name}: {us:.1f} us/lookup, {view_us:.1f} us/view, "
+                f"index {sz / 1e6:.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Benchmark thumbnail rendering from large originals.
+
+Compares the old path (decode the whole original at full resolution, then
+crop and scale) against util.load_and_transform, which lets JPEGs decode at
+a reduced resolution. Reports time per render, the memory held by the decoded
+original, and the PSNR of the new output against the old one.
+
+Then simulates dragging a crop in the web UI: a series of crop previews of
+the same original, which util renders from its cached image pyramid.
+"""
+from PIL import Image, ImageOps
+import argparse
+import numpy as np
+import tempfile
+import time
+import util
+
+
+def old_transform(o, out_w, out_h, dsdir="."):
+    """
+    The previous util.load_and_transform.
+    """
+    img = Image.open(f"{dsdir}/{o['fn']}")
+    img = ImageOps.exif_transpose(img)
+    img = img.convert("RGBA")
+    x, y, w, h = o["x"], o["y"], o["w"], o["h"]
+    img = img.crop((x, y, x + w, y + h))
+    img = img.resize((out_w, out_h), Image.Resampling.BICUBIC)
+    return img.rotate(o.get("rot", 0) * 90)
+
+
+def fake_photo(fn, w, h, orientation=1):
+    """
+    Writes a w x h image (format from the extension) with smooth structure plus grain, roughly like a
+    photo as far as the codec is concerned.
+    """
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 256, (h // 100 + 1, w // 100 + 1, 3), dtype=np.uint8)
+    img = Image.fromarray(base).resize((w, h), Image.Resampling.BICUBIC)
+    grain = rng.normal(0, 12, (h, w, 3))
+    img = Image.fromarray(np.clip(np.asarray(img) + grain, 0, 255).astype(np.uint8))
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    if fn.endswith(".png"):
+        img.save(fn, compress_level=1, exif=exif)
+    else:
+        img.save(fn, quality=90, exif=exif)
+
+
+def record(dsdir, fn):
+    img = ImageOps.exif_transpose(Image.open(f"{dsdir}/{fn}"))
+    wh = min(img.size)
+    return {
+        "fn": fn,
+        "orig_w": img.width,
+        "orig_h": img.height,
+        "x": (img.width - wh) // 2 + 3,
+        "y": (img.height - wh) // 2 + 5,
+        "w": wh - 7,
+        "h": wh - 7,
+        "rot": 1,
+    }
+
+
+def psnr(a, b):
+    a = np.asarray(a.convert("RGB"), dtype=np.float64)
+    b = np.asarray(b.convert("RGB"), dtype=np.float64)
+    mse = np.mean((a - b) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255**2 / mse)
+
+
+def bench(func, o, sz, dsdir, repeat):
+    start = time.monotonic()
+    for _ in range(repeat):
+        util.image_cache.clear()
+        img = func(o, sz, sz, dsdir=dsdir)
+    return img, (time.monotonic() - start) / repeat * 1e3
+
+
+def bench_drag(func, o, sz, dsdir, steps):
+    """
+    Returns ms per crop preview while dragging and shrinking the crop.
+    """
+    util.image_cache.clear()
+    start = time.monotonic()
+    for i in range(steps):
+        step = dict(o, x=o["x"] + i * 7, y=o["y"] + i * 5, w=o["w"] - i * 11)
+        step["h"] = step["w"]
+        func(step, sz, sz, dsdir=dsdir)
+    return (time.monotonic() - start) / steps * 1e3
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument(
+        "images",
+        nargs="*",
+        help="Originals to render. By default, synthetic 6000x4000 JPEGs and PNG.",
+    )
+    p.add_argument(
+        "--sizes", type=int, nargs="+", default=[256, 512], help="Output sizes."
+    )
+    p.add_argument("--repeat", type=int, default=3, help="Renders per measurement.")
+    p.add_argument("--drag_steps", type=int, default=10, help="Previews per drag.")
+    args = p.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.images:
+            dsdir = "."
+            fns = args.images
+        else:
+            dsdir = tmp
+            fns = []
+            for fn, orientation in [("a.jpg", 1), ("b.jpg", 6), ("c.png", 1)]:
+                fake_photo(f"{tmp}/{fn}", 6000, 4000, orientation)
+                fns.append(fn)
+
+        for fn in fns:
+            o = record(dsdir, fn)
+            print(f"== {fn} ({o['orig_w']}x{o['orig_h']})")
+            for sz in args.sizes:
+                before, before_ms = bench(old_transform, o, sz, dsdir, args.repeat)
+                after, after_ms = bench(
+                    util.load_and_transform, o, sz, dsdir, args.repeat
+                )
+                decoded = util.image_cache.stats()["bytes"] / (
+                    o["orig_w"] * o["orig_h"] * 4
+                )
+                print(
+                    f"{sz}: before {before_ms:.0f} ms, after {after_ms:.0f} ms "
+                    f"({before_ms / after_ms:.1f}x), decoded image {decoded:.1%} "
+                    f"of the size, PSNR {psnr(before, after):.1f} dB"
+                )
+
+            # The UI's crop previews are 256px.
+            before = bench_drag(old_transform, o, 256, dsdir, args.drag_steps)
+            after = bench_drag(util.load_and_transform, o, 256, dsdir, args.drag_steps)
+            print(
+                f"crop drag: before {before:.0f} ms, after {after:.0f} ms "
+                f"per preview ({before / after:.1f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
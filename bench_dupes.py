@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Benchmark finding near-duplicate groups with util.DupeIndex.groups().
+
+Times it on uniformly random hashes, and on skewed ones with only a few bits
+set, like the dhashes of real photos: those share chunks a lot, which is what
+makes grouping slow. Some hashes are near copies of others, so there are
+groups to find.
+"""
+import argparse
+import random
+import time
+import util
+
+
+def uniform_hash():
+    return random.getrandbits(64)
+
+
+def skewed_hash(bits):
+    h = 0
+    for i in random.sample(range(64), bits):
+        h |= 1 << i
+    return h
+
+
+def near_copy(h, max_dist):
+    for i in random.sample(range(64), random.randint(1, max_dist)):
+        h ^= 1 << i
+    return h
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--hashes", type=int, default=200000, help="Number of hashes.")
+    p.add_argument("--bits", type=int, default=8, help="Bits set in skewed hashes.")
+    p.add_argument("--max_dist", type=int, default=4)
+    p.add_argument("--copies", type=float, default=0.01, help="Near copy fraction.")
+    args = p.parse_args()
+
+    random.seed(0)
+    dists = {
+        "uniform": uniform_hash,
+        f"skewed ({args.bits} bits set)": lambda: skewed_hash(args.bits),
+    }
+    for name, make in dists.items():
+        hashes = [make() for _ in range(args.hashes)]
+        copies = int(args.hashes * args.copies)
+        hashes[-copies:] = [near_copy(h, args.max_dist) for h in hashes[:copies]]
+        hexhashes = ["%016x" % h for h in hashes]
+        start = time.monotonic()
+        groups = util.DupeIndex.groups(range(len(hexhashes)), hexhashes, args.max_dist)
+        secs = time.monotonic() - start
+        print(f"{name}: {len(groups)} groups in {secs:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
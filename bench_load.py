@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Benchmark loading a large dataset.
+
+Compares parsing the whole JSON file, loading through the {fn}.idx index and
+loading through the columnar {fn}.snap snapshot. Each load runs in a fresh
+process, which reports its time and peak RSS, first for just loading and then
+for touching every record.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import util
+
+
+def fake_record(n):
+    o = {
+        "fn": f"photos/{n // 1000:04d}/IMG_{n:07d}.jpg",
+        "md5": "%032x" % random.getrandbits(128),
+        "fsz": random.randint(100000, 20000000),
+        "orig_w": 6000,
+        "orig_h": 4000,
+        "x": 1000,
+        "y": 0,
+        "w": 4000,
+        "h": 4000,
+        "rot": n % 4,
+        "n": n,
+    }
+    if n % 3 == 0:
+        o["caption"] = "a photo of something " * 3
+        o["manual_crop"] = 1
+        o["manual_ts"] = 1700000000 + n
+    if n % 7 == 0:
+        o["skip"] = "blurry"
+    if n % 2 == 0:
+        o["auto_blip1"] = ["a photo of a thing", "a thing in a photo"]
+    return o
+
+
+def peak_rss_mb():
+    # ru_maxrss survives exec, so it would include the parent's peak.
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def child(mode, fn):
+    """
+    Runs in the benchmark subprocess: loads fn and prints JSON results.
+    """
+    start = time.monotonic()
+    ds = util.Dataset(fn)
+    load = time.monotonic() - start
+    load_rss = peak_rss_mb()
+    assert (mode == "snapshot") == (ds._data._base is not None)
+    start = time.monotonic()
+    num = sum(1 for o in ds._data.values() if "caption" in o)
+    touch = time.monotonic() - start
+    touch_rss = peak_rss_mb()
+    print(json.dumps([load, load_rss, touch, touch_rss, num]))
+
+
+def run(mode, fn):
+    out = subprocess.run(
+        [sys.executable, __file__, "--child", mode, fn],
+        check=True,
+        capture_output=True,
+    ).stdout
+    return json.loads(out)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--records", type=int, default=1000000, help="Dataset size.")
+    p.add_argument("--dir", default=None, help="Where to put the temp datasets.")
+    p.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    args = p.parse_args()
+    if args.child:
+        child(*args.child)
+        return
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        print(f"writing {args.records} records")
+        fn = f"{tmp}/jsonl.json"
+        with open(fn, "w") as f:
+            for n in range(args.records):
+                f.write(json.dumps(fake_record(n)) + "\n")
+        print(f"{os.path.getsize(fn) / 1e6:.0f} MB of JSON")
+        shutil.copy(fn, f"{tmp}/index.json")
+        util.Dataset(f"{tmp}/index.json")
+        shutil.copy(fn, f"{tmp}/snapshot.json")
+        util.Dataset(f"{tmp}/snapshot.json").write_snapshot()
+        os.unlink(f"{tmp}/snapshot.json.idx")
+        print(f"{os.path.getsize(f'{tmp}/snapshot.json.snap') / 1e6:.0f} MB snapshot")
+
+        for mode in ["jsonl", "index", "snapshot"]:
+            if mode == "jsonl":
+                # Nothing to load from but the JSON file.
+                for ext in [".idx", ".snap"]:
+                    if os.path.exists(fn + ext):
+                        os.unlink(fn + ext)
+            load, load_rss, touch, touch_rss, _ = run(mode, f"{tmp}/{mode}.json")
+            print(
+                f"{mode}: load {load:.2f}s, {load_rss:.0f} MB RSS; "
+                f"+ all records {touch:.2f}s, {touch_rss:.0f} MB RSS"
+            )
+
+
+if __name__ == "__main__":
+    main()
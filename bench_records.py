@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Benchmark the memory used by in-memory records.
+
+Loads a synthetic dataset's records as plain dicts (the old representation)
+and as util.Record, along with the set of filenames Dataset keeps, and
+compares the Python heap used by each.
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+from bench_load import fake_record
+import util
+
+
+def measure(lines, make):
+    gc.collect()
+    tracemalloc.start()
+    start = time.monotonic()
+    data = {}
+    for line in lines:
+        obj = make(json.loads(line))
+        data[obj["n"]] = obj
+    fns = {obj["fn"] for obj in data.values()}
+    secs = time.monotonic() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data, fns
+    return size, secs
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--records", type=int, default=1000000, help="Dataset size.")
+    args = p.parse_args()
+
+    lines = [json.dumps(fake_record(n)) for n in range(args.records)]
+    print(f"{args.records} records")
+    before, before_secs = measure(lines, dict)
+    print(f"dict: {before / 1e6:.0f} MB, {before_secs:.1f}s")
+    after, after_secs = measure(lines, util.Record)
+    print(
+        f"Record: {after / 1e6:.0f} MB, {after_secs:.1f}s "
+        f"({before / after:.1f}x smaller)"
+    )
+
+
+if __name__ == "__main__":
+    main()
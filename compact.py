@@ -1,19 +1,31 @@
 #!/usr/bin/env python3
 """
 Compact one or more dataset JSON files: rewrites the file and removes un-needed lines.
+
+With --snapshot, also writes a columnar snapshot ({fn}.snap) that loads
+without parsing every record.
 """
-from util import Dataset
+from util import open_dataset
 import argparse
 
 
 def main():
     p = argparse.ArgumentParser()
     p.add_argument("inputs", nargs="+", help="One or more dataset JSON files.")
+    p.add_argument(
+        "--snapshot",
+        help="Also write a columnar snapshot for fast loading.",
+        action="store_true",
+    )
     args = p.parse_args()
 
     for i in args.inputs:
         print(f"compacting {i}")
-        Dataset(i).compact()
+        ds = open_dataset(i)
+        if args.snapshot:
+            ds.write_snapshot()
+        else:
+            ds.compact()
 
 
 if __name__ == "__main__":
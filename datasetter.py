@@ -5,8 +5,11 @@ Web-based dataset editing.
 import json
 from PIL import Image
 import argparse
+import asyncio
+import bisect
+import concurrent.futures
+import hashlib
 import os
-from util import Dataset
 import util
 from aiohttp import web
 import aiohttp
@@ -19,10 +22,97 @@ logging.basicConfig(level=logging.INFO)
 routes = web.RouteTableDef()
 
 
+# Renders in flight per route, on top of the overall --render_queue. Thumbnails
+# get all of --render_jobs, previews are only useful while the user is looking.
+ROUTE_LIMITS = {"thumbnail": None, "preview": 2, "prep_mask": 1}
+
+# records.json writes its response in chunks of about this many characters.
+RECORDS_CHUNK = 1 << 16
+
+# Keys summary.json counts the records that have.
+SUMMARY_KEYS = ["caption", "manual_crop", "manual_rot", "skip"]
+
+# For thumbnail URLs with the right ?v=, see thumbnail_headers.
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
 def now():
     return int(time.time())
 
 
+def crop_version(o):
+    """
+    Returns a string that changes whenever the thumbnail of metadata object
+    `o` does, like util.crop_id. index.js computes the same for ?v=.
+    """
+    return f'{o["md5"]}.{o["x"]}.{o["y"]}.{o["w"]}.{o["h"]}.{o.get("rot", 0)}'
+
+
+def thumbnail_headers(request, o, keys, mask):
+    """
+    Returns (headers, fresh) for a thumbnail of metadata object `o` made from
+    the cache entries `keys`, where fresh means the browser already has it.
+
+    The ETag is derived from the cache keys, so it changes exactly when the
+    image does. URLs with ?v=crop_version(o) are immutable, except with a
+    hand-drawn mask, which can change without the record changing.
+    """
+    etag = f'"{hashlib.md5(b"".join(keys)).hexdigest()}"'
+    immutable = request.query.get("v") == crop_version(o)
+    if mask and o.get("mask_state", "") == "done":
+        immutable = False
+    headers = {"ETag": etag, "Cache-Control": IMMUTABLE if immutable else "no-cache"}
+    return headers, etag in request.headers.get("If-None-Match", "")
+
+
+class Renderer:
+    """
+    Runs image rendering in a pool, off the event loop, so a slow render
+    doesn't stall every other request.
+
+    At most `queue` renders may be waiting or running, beyond that requests get
+    a 503 and the browser retries. Each route also has its own limit on
+    concurrent renders, so e.g. crop previews can't starve the thumbnails.
+    """
+
+    def __init__(self, pool, queue, limits):
+        self.pool = pool
+        self.queue = queue
+        self.pending = 0
+        self.limits = {k: asyncio.Semaphore(v) for k, v in limits.items()}
+
+    async def run(self, request, route, func, *args):
+        if self.pending >= self.queue:
+            raise web.HTTPServiceUnavailable(headers={"Retry-After": "1"})
+        self.pending += 1
+        try:
+            # aiohttp < 3.9 cancels the handler when the client disconnects,
+            # which also cancels the render if it hasn't started. Later
+            # versions don't, so check before starting.
+            async with self.limits[route]:
+                if request.transport is None or request.transport.is_closing():
+                    raise asyncio.CancelledError()
+                return await asyncio.wrap_future(self.pool.submit(func, *args))
+        finally:
+            self.pending -= 1
+
+
+async def cached_render(request, route, key, view, func, *args):
+    """
+    Returns cache entry `key`, rendering it with func(*args) in the pool if
+    it's missing. The cache is only touched from the event loop. See
+    Dataset.cropped_jpg for `view`.
+    """
+    ds = request.config_dict["ds"]
+    try:
+        return ds._cache.view(key) if view else ds._cache[key]
+    except KeyError:
+        pass
+    img = await request.config_dict["renderer"].run(request, route, func, *args)
+    ds._cache[key] = img
+    return img
+
+
 @routes.get("/")
 async def index_html(request):
     with open(f"{WWW}/index.html", "r") as f:
@@ -55,8 +145,110 @@ async def title(request):
 
 @routes.get("/data.json")
 async def data(request):
+    ds = request.config_dict["ds"]
+    # Pick up records added by other processes, e.g. captioners.
+    ds.refresh()
     return web.json_response(
-        request.config_dict["ds"]._data, headers={"Pragma": "no-cache"}
+        dict(ds._data.items()),
+        headers={"Pragma": "no-cache"},
+        dumps=util.json_dumps,
+    )
+
+
+@routes.get("/records.json")
+async def records(request):
+    """
+    Like data.json, but only records number `offset` to `offset + limit` of
+    the ones that match the filters, e.g. ?skip=0&caption=1 for captioned and
+    not skipped, or ?autocaption=0 for the ones without. Filters are the keys
+    Dataset.select takes: INDEXED_KEYS by presence (0 or 1), INDEXED_VALUES by
+    value. With n=N, only record N if it matches. With start=N, the offset
+    is that of the first match from record N on (or the last match), rounded
+    down to a multiple of `limit`: the page it's on. With fields=a,b,c only
+    those keys are included (and always "n").
+    Returns {"total": number of matches, "offset": offset, "records":
+    {n: record, ...}}.
+    """
+    ds = request.config_dict["ds"]
+    query = request.query.copy()
+    try:
+        offset = int(query.pop("offset", 0))
+        limit = int(query.pop("limit", -1))
+    except ValueError:
+        return json_error('"offset" and "limit" must be int')
+    try:
+        only_n = int(query.pop("n")) if "n" in query else None
+        start = int(query.pop("start")) if "start" in query else None
+    except ValueError:
+        return json_error('"n" and "start" must be int')
+    fields = query.pop("fields", None)
+    if fields is not None:
+        fields = ["n"] + fields.split(",")
+    conds = {}
+    for k, v in query.items():
+        if k in ds.INDEXED_KEYS:
+            conds[k] = v not in ("0", "false", "")
+        elif k in ds.INDEXED_VALUES:
+            conds[k] = v
+        else:
+            return json_error(f"can't filter on {k!r}")
+
+    ds.refresh()
+    if only_n is not None:
+        # What every page but the catalog asks for, so don't sort everything.
+        match = only_n in ds._data and (not conds or only_n in ds._select(conds))
+        ns = [only_n] if match else []
+    else:
+        ns = ds.select(**conds)
+    if start is not None:
+        offset = min(bisect.bisect_left(ns, start), max(len(ns) - 1, 0))
+        if limit > 0:
+            offset -= offset % limit
+    page = ns[offset:] if limit < 0 else ns[offset : offset + limit]
+
+    response = web.StreamResponse(headers={"Pragma": "no-cache"})
+    response.content_type = "application/json"
+    # Browsers accept deflate too, which aiohttp would otherwise prefer.
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        response.enable_compression(web.ContentCoding.gzip)
+    await response.prepare(request)
+    head = f'{{"total": {len(ns)}, "offset": {offset}, "records": {{'
+    await response.write(head.encode())
+    chunk = []
+    size = 0
+    for i, n in enumerate(page):
+        o = ds._data[n]
+        if fields is not None:
+            o = {k: o[k] for k in fields if k in o}
+        s = f'{", " if i else ""}"{n}": {util.json_dumps(o)}'
+        chunk.append(s)
+        size += len(s)
+        if size >= RECORDS_CHUNK:
+            await response.write("".join(chunk).encode())
+            chunk = []
+            size = 0
+    chunk.append("}}")
+    await response.write("".join(chunk).encode())
+    await response.write_eof()
+    return response
+
+
+@routes.get("/summary.json")
+async def summary(request):
+    """
+    Returns the counts for the header of the page.
+    """
+    ds = request.config_dict["ds"]
+    ds.refresh()
+    counts = {k: ds.count(**{k: True}) for k in SUMMARY_KEYS}
+    counts["total"] = len(ds._data)
+    return web.json_response(counts, headers={"Pragma": "no-cache"})
+
+
+@routes.get("/cache_stats.json")
+async def cache_stats(request):
+    return web.json_response(
+        request.config_dict["ds"].cache_stats(), headers={"Pragma": "no-cache"}
     )
 
 
@@ -67,6 +259,7 @@ async def update_receiver(request):
         id = int(received["id"])
     except (KeyError, ValueError):
         return json_error('"id" must be int')
+    request.config_dict["ds"].refresh()
     try:
         obj = request.config_dict["ds"]._data[id]
     except KeyError:
@@ -106,7 +299,13 @@ async def prep_mask_receiver(request):
         return json_error('"id" must be int')
     force = received.get("force", 0) == 1
     append = request.config_dict["args"].append
-    request.config_dict["ds"].prep_mask(id, append, force)
+    ds = request.config_dict["ds"]
+    ds.refresh()
+    maskfn = ds.prep_mask_fn(id, force)
+    await request.config_dict["renderer"].run(
+        request, "prep_mask", util.render_prep_mask, dict(ds._data[id]), ds._dir, maskfn
+    )
+    ds.set_prep_mask(id, maskfn, append)
     return web.Response(status=204)
 
 
@@ -119,8 +318,16 @@ async def thumbnail_receiver(request):
     n = int(request.match_info.get("n", ""))
     sz = int(request.match_info.get("sz", ""))
     assert sz <= 1024
-    img = request.config_dict["ds"].cropped_jpg(n, sz)
-    return web.Response(body=img, content_type="image/jpeg")
+    ds = request.config_dict["ds"]
+    o = ds._data[n]
+    key = util.cache_key(o, sz)
+    headers, fresh = thumbnail_headers(request, o, [key], mask=False)
+    if fresh:
+        return web.Response(status=304, headers=headers)
+    img = await cached_render(
+        request, "thumbnail", key, True, util.render_jpg, dict(o), sz, ds._dir
+    )
+    return web.Response(body=img, content_type="image/jpeg", headers=headers)
 
 
 @routes.get("/mask_thumbnail/{n}/{sz}")
@@ -128,8 +335,16 @@ async def mask_thumbnail_receiver(request):
     n = int(request.match_info.get("n", ""))
     sz = int(request.match_info.get("sz", ""))
     assert sz <= 1024
-    img = request.config_dict["ds"].cropped_mask(n, sz)
-    return web.Response(body=img, content_type="image/png")
+    ds = request.config_dict["ds"]
+    o = ds._data[n]
+    key = ds.cache_keys(n, sz)[1]
+    headers, fresh = thumbnail_headers(request, o, [key], mask=True)
+    if fresh:
+        return web.Response(status=304, headers=headers)
+    img = await cached_render(
+        request, "thumbnail", key, True, util.render_mask, dict(o), sz, ds._dir
+    )
+    return web.Response(body=img, content_type="image/png", headers=headers)
 
 
 @routes.get("/masked_thumbnail/{n}/{sz}")
@@ -137,8 +352,22 @@ async def masked_thumbnail_receiver(request):
     n = int(request.match_info.get("n", ""))
     sz = int(request.match_info.get("sz", ""))
     assert sz <= 1024
-    img = request.config_dict["ds"].masked_thumbnail(n, sz)
-    return web.Response(body=img, content_type="image/jpeg")
+    ds = request.config_dict["ds"]
+    o = ds._data[n]
+    keys = ds.cache_keys(n, sz)
+    headers, fresh = thumbnail_headers(request, o, keys, mask=True)
+    if fresh:
+        return web.Response(status=304, headers=headers)
+    jpg = await cached_render(
+        request, "thumbnail", keys[0], False, util.render_jpg, dict(o), sz, ds._dir
+    )
+    mask = await cached_render(
+        request, "thumbnail", keys[1], False, util.render_mask, dict(o), sz, ds._dir
+    )
+    img = await request.config_dict["renderer"].run(
+        request, "thumbnail", util.render_masked, jpg, mask
+    )
+    return web.Response(body=img, content_type="image/jpeg", headers=headers)
 
 
 @routes.get("/crop/{n}/{x}/{y}/{wh}/{sz}")
@@ -151,7 +380,11 @@ async def crop_receiver(request):
     assert sz <= 1024
     assert x >= 0
     assert y >= 0
-    img = request.config_dict["ds"].crop_preview(n, x, y, wh, sz)
+    ds = request.config_dict["ds"]
+    o = dict(ds._data[n], x=x, y=y, w=wh, h=wh)
+    img = await request.config_dict["renderer"].run(
+        request, "preview", util.render_preview, o, sz, ds._dir
+    )
     return web.Response(body=img, content_type="image/jpeg")
 
 
@@ -160,7 +393,11 @@ async def rotate_receiver(request):
     n = int(request.match_info.get("n", ""))
     rot = int(request.match_info.get("rot", ""))
     sz = int(request.match_info.get("sz", ""))
-    img = request.config_dict["ds"].rotate_preview(n, rot, sz)
+    ds = request.config_dict["ds"]
+    o = dict(ds._data[n], rot=rot)
+    img = await request.config_dict["renderer"].run(
+        request, "preview", util.render_preview, o, sz, ds._dir
+    )
     return web.Response(body=img, content_type="image/jpeg")
 
 
@@ -168,6 +405,44 @@ async def strip_headers(request, response):
     del response.headers["Server"]
 
 
+async def start_renderer(app):
+    args = app["args"]
+    if args.render_pool == "process":
+        # Each worker decodes into its own image_cache, so split the budget.
+        pool = concurrent.futures.ProcessPoolExecutor(
+            args.render_jobs,
+            initializer=util.init_image_cache,
+            initargs=((args.image_cache_mb << 20) // args.render_jobs,),
+        )
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(args.render_jobs)
+    limits = dict(ROUTE_LIMITS, **dict(args.render_limit))
+    limits = {k: v or args.render_jobs for k, v in limits.items()}
+    app["renderer"] = Renderer(pool, args.render_queue, limits)
+
+
+async def stop_renderer(app):
+    app["renderer"].pool.shutdown(cancel_futures=True)
+
+
+def route_limit(s):
+    route, sep, limit = s.partition("=")
+    if not sep or route not in ROUTE_LIMITS:
+        raise argparse.ArgumentTypeError(
+            f"expected ROUTE=N with ROUTE one of {', '.join(ROUTE_LIMITS)}"
+        )
+    return route, int(limit)
+
+
+async def close_dataset(app):
+    ds = app["ds"]
+    ds.flush()
+    ds.wait_for_compaction()
+    if not app["args"].append and ds.stale_lines() > 0:
+        logging.info("compacting")
+        ds.compact_log()
+
+
 def main():
     p = argparse.ArgumentParser()
     p.add_argument("--port", type=int, default=8001)
@@ -177,14 +452,68 @@ def main():
         help="Only append to the JSON file.",
         action="store_true",
     )
+    p.add_argument(
+        "--cache_dir",
+        default=None,
+        help="Use the shared thumbnail cache in this dir. (optional)",
+    )
+    p.add_argument(
+        "--cache_backend",
+        choices=sorted(util.CACHE_BACKENDS),
+        default=None,
+        help="Thumbnail cache implementation, when creating a new cache.",
+    )
+    p.add_argument(
+        "--image_cache_mb",
+        type=int,
+        default=util.image_cache.max_bytes >> 20,
+        help="Memory for decoded originals, in MB of pixel data. With "
+        "--render_pool process, this is split between the workers.",
+    )
+    p.add_argument(
+        "--render_pool",
+        choices=["thread", "process"],
+        default="thread",
+        help="Render in threads (sharing decoded originals) or processes.",
+    )
+    p.add_argument(
+        "--render_jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of render threads or processes.",
+    )
+    p.add_argument(
+        "--render_queue",
+        type=int,
+        default=64,
+        help="Renders that may be waiting or running before answering 503.",
+    )
+    p.add_argument(
+        "--render_limit",
+        type=route_limit,
+        action="append",
+        default=[],
+        metavar="ROUTE=N",
+        help="Concurrent renders for a route: "
+        + ", ".join(
+            f"{k} (default {v or 'render_jobs'})" for k, v in ROUTE_LIMITS.items()
+        )
+        + ". Can be repeated.",
+    )
     p.add_argument("dsfile", help="JSON dataset file to operate on.")
     args = p.parse_args()
+    util.image_cache.max_bytes = args.image_cache_mb << 20
 
     app = web.Application()
     app.on_response_prepare.append(strip_headers)
+    app.on_startup.append(start_renderer)
+    app.on_shutdown.append(close_dataset)
+    app.on_cleanup.append(stop_renderer)
     app.add_routes(routes)
     app["args"] = args
-    app["ds"] = Dataset(args.dsfile)
+    app["ds"] = util.open_dataset(
+        args.dsfile, cache_dir=args.cache_dir, cache_backend=args.cache_backend
+    )
     web.run_app(app, port=args.port, host=args.host)
 
 
@@ -3,7 +3,7 @@
 Remove dataset entries where the file is missing.
 Leaves gaps in "n" numbers.
 """
-from util import Dataset
+from util import open_dataset
 import argparse
 import os
 
@@ -15,7 +15,7 @@ def main():
 
     for i in args.inputs:
         print(f"processing {i}")
-        d = Dataset(i)
+        d = open_dataset(i)
         keys = list(d._data.keys())
         n = 0
         for k in keys:
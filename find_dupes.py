@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Find groups of near-duplicate images in a dataset.
+
+Records are compared by their dhash (see util.DupeIndex), which add.py
+computes as files are added. Records that don't have one yet get it computed
+here first, in parallel, and saved to the dataset.
+"""
+from util import open_dataset
+import argparse
+import collections
+import concurrent.futures
+import os
+import time
+import util
+
+# How many records to write to the dataset at a time.
+BATCH = 1000
+
+
+def compute_dhashes(ds, args, pool):
+    todo = ds.select(dhash=False)
+    print(f"computing dhash for {len(todo)} records")
+    start = last_report = time.monotonic()
+    batch = []
+    in_flight = collections.deque()
+    todo = iter(todo)
+    done = 0
+    while True:
+        # Keep the pool busy without queueing the whole dataset.
+        while len(in_flight) < args.jobs * 4:
+            n = next(todo, None)
+            if n is None:
+                break
+            path = f"{ds._dir}/{ds._data[n]['fn']}"
+            in_flight.append((n, pool.submit(util.dhash, path)))
+        if not in_flight:
+            break
+        n, future = in_flight.popleft()
+        done += 1
+        try:
+            batch.append({"n": n, "dhash": future.result()})
+        except Exception as e:
+            print(f"WARN: no dhash for {n} because {e!r}")
+        if len(batch) >= BATCH:
+            ds.add_many(batch, keys=["dhash"])
+            batch = []
+
+        now = time.monotonic()
+        if now - last_report >= args.report_secs:
+            last_report = now
+            print(f"{done} records, {done / (now - start):.1f} records/sec")
+    ds.add_many(batch, keys=["dhash"])
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("dsfile", help="JSON dataset file to check.")
+    p.add_argument(
+        "--dupe_dist",
+        type=int,
+        default=4,
+        help="How many bits of dhash near duplicates can differ by.",
+    )
+    p.add_argument(
+        "--mark",
+        help="Set dupe_of on every record in a group but the first, to the "
+        "first one's fn.",
+        action="store_true",
+    )
+    p.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes.",
+    )
+    p.add_argument(
+        "--report_secs",
+        type=float,
+        default=5,
+        help="How often to print progress.",
+    )
+    args = p.parse_args()
+
+    ds = open_dataset(args.dsfile)
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+        compute_dhashes(ds, args, pool)
+
+    print("grouping")
+    start = time.monotonic()
+    ns = sorted(ds.select(dhash=True))
+    hashes = [ds._data[n]["dhash"] for n in ns]
+    groups = util.DupeIndex.groups(ns, hashes, args.dupe_dist)
+    print(f"{len(groups)} groups in {time.monotonic() - start:.1f} sec")
+
+    marks = []
+    for group in groups:
+        first = ds._data[group[0]]["fn"]
+        print(f"{len(group)} near duplicates of {first!r}:")
+        for n in group:
+            print(f"  {n} {ds._data[n]['fn']}")
+        for n in group[1:]:
+            if ds._data[n].get("dupe_of") != first:
+                marks.append({"n": n, "dupe_of": first})
+    if args.mark:
+        print(f"marking {len(marks)} records")
+        for i in range(0, len(marks), BATCH):
+            ds.add_many(marks[i : i + BATCH], keys=["dupe_of"])
+    if ds.needs_compact():
+        print("compacting")
+        ds.compact()
+
+
+if __name__ == "__main__":
+    main()
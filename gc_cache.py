@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Garbage collect the thumbnail cache of one or more datasets.
+
+Drops cache entries that no longer match any record (e.g. after a re-crop or
+rotation), optionally sets the cache's byte budget, and prints cache stats.
+
+With --cache_dir, the shared cache is collected against all the inputs
+together, so every dataset that uses that cache must be listed.
+"""
+from util import open_dataset
+import argparse
+import util
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("inputs", nargs="+", help="One or more dataset JSON files.")
+    p.add_argument(
+        "--max_mb",
+        type=int,
+        default=None,
+        help="Set the cache budget in MB, least recently used entries are "
+        "evicted beyond it. 0 means unlimited.",
+    )
+    p.add_argument(
+        "--stats",
+        help="Only print stats, don't collect garbage.",
+        action="store_true",
+    )
+    p.add_argument(
+        "--vacuum",
+        help="Shrink the cache file after collecting.",
+        action="store_true",
+    )
+    p.add_argument(
+        "--cache_dir",
+        default=None,
+        help="Collect the shared thumbnail cache in this dir. (optional)",
+    )
+    args = p.parse_args()
+
+    if args.cache_dir is not None:
+        gc_shared(args)
+        return
+
+    for i in args.inputs:
+        with open_dataset(i) as ds:
+            if args.max_mb is not None:
+                ds._cache.set_max_bytes(args.max_mb << 20)
+            if not args.stats:
+                print(f"{i}: dropped {ds.gc_cache()} stale entries")
+                if args.vacuum:
+                    ds._cache.vacuum()
+            print(f"{i}: {ds.cache_stats()}")
+
+
+def gc_shared(args):
+    live = set()
+    for i in args.inputs:
+        print(f"loading {i}")
+        ds = open_dataset(i, cache_dir=args.cache_dir)
+        live |= ds.live_crop_ids()
+    with ds._cache as cache:
+        if args.max_mb is not None:
+            cache.set_max_bytes(args.max_mb << 20)
+        if not args.stats:
+            print(f"dropped {util.gc_cache(cache, live)} stale entries")
+            if args.vacuum:
+                cache.vacuum()
+        print(cache.stats())
+
+
+if __name__ == "__main__":
+    main()
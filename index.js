@@ -8,8 +8,27 @@ const curr_id = (() => {
     return parseInt(i);
 })();
 
+// Catalog page from URL, or null for the one with curr_id.
+const curr_page = (() => {
+    let p = new URLSearchParams(window.location.search).get('page');
+    if (!p) return null;
+    return parseInt(p);
+})();
+
 const SZ = 512;
 var data = null;  // Global for debugging.
+var total = 0;    // Number of records in the dataset.
+var offset = 0;   // Position of the first record of data among all of them.
+
+// Catalog mode shows this many records per page, and only needs these keys.
+const CATALOG_PAGE = 500;
+const CATALOG_FIELDS = 'md5,x,y,w,h,rot,skip';
+
+// Changes whenever the thumbnail of record `md` does, which lets the browser
+// cache thumbnail URLs forever. Same as crop_version in datasetter.py.
+function crop_version(md) {
+    return `${md.md5}.${md.x}.${md.y}.${md.w}.${md.h}.${md.rot || 0}`;
+}
 
 // Main.
 $(document).ready(function() {
@@ -26,52 +45,60 @@ $(document).ready(function() {
         $(`#mode_${mode}`).attr('href', '?' + s.toString());
     }
 
-    // Load data.
-    fetch('data.json').then((response) => response.json().then((json) => {
-        data = json;
-        $('#ds_size').text(Object.keys(data).length);
-
-        let num_caption = 0;
-        let num_crop = 0;
-        let num_rotate = 0;
-        let num_skip = 0;
-        for (const [n, md] of Object.entries(data)) {
-            if ('caption' in md) {
-                num_caption++;
-            }
-            if ('manual_crop' in md) {
-                num_crop++;
-            }
-            if ('manual_rot' in md) {
-                num_rotate++;
-            }
-            if ('skip' in md) {
-                num_skip++;
+    // The server answers 503 when its render queue is full, so retry images
+    // a few times. Error events don't bubble, hence the capture.
+    document.addEventListener('error', (ev) => {
+        let img = ev.target;
+        if (img.tagName != 'IMG') return;
+        let tries = parseInt(img.dataset.tries || '0');
+        if (tries >= 5) return;
+        img.dataset.tries = tries + 1;
+        setTimeout(() => img.src = img.src, 500 * (tries + 1));
+    }, true);
+
+    // Load the counts, and only the records this page shows.
+    const mode = new URLSearchParams(window.location.search).get('mode');
+    let query;
+    if (mode == 'catalog') {
+        // Ns can have gaps, so pages are by position rather than by N.
+        const at = curr_page === null ? `start=${curr_id}` :
+                                        `offset=${curr_page * CATALOG_PAGE}`;
+        query = `${at}&limit=${CATALOG_PAGE}&fields=${CATALOG_FIELDS}`;
+    } else {
+        query = `n=${curr_id}`;
+    }
+    Promise
+        .all([
+            fetch('summary.json').then((response) => response.json()),
+            fetch(`records.json?${query}`).then((response) => response.json()),
+        ])
+        .then(([summary, json]) => {
+            total = summary.total;
+            offset = json.offset;
+            data = json.records;
+            $('#ds_size').text(total);
+            $('#num_caption').text(summary.caption);
+            $('#num_crop').text(summary.manual_crop);
+            $('#num_rotate').text(summary.manual_rot);
+            $('#num_skip').text(summary.skip);
+
+            if (mode == 'catalog') {
+                catalog();
+            } else if (mode == 'crop') {
+                crop();
+            } else if (mode == 'rotate') {
+                rotate();
+            } else {
+                caption();
             }
-        }
-        $('#num_caption').text(num_caption);
-        $('#num_crop').text(num_crop);
-        $('#num_rotate').text(num_rotate);
-        $('#num_skip').text(num_skip);
-
-        const mode = new URLSearchParams(window.location.search).get('mode');
-        if (mode == 'catalog') {
-            catalog();
-        } else if (mode == 'crop') {
-            crop();
-        } else if (mode == 'rotate') {
-            rotate();
-        } else {
-            caption();
-        }
-    }));
+        });
 });
 
 // ---
 
 function go_to_id(id) {
     if (id < 0) return;
-    if (id >= Object.keys(data).length) return;
+    if (id >= total) return;
     let s = new URLSearchParams(window.location.search);
     s.set('id', id);
     window.location.search = '?' + s.toString();
@@ -97,7 +124,23 @@ function append_warns(md, content) {
 
 function catalog() {
     const sz = 256;  // Preview size.
-    let content = $('#content').html('Catalog:<br>');
+    let content = $('#content').html('Catalog: ');
+    // Links to the previous and next pages.
+    const page = Math.floor(offset / CATALOG_PAGE);
+    if (page > 0) {
+        $('<a>')
+            .attr('href', `?mode=catalog&page=${page - 1}`)
+            .text('prev')
+            .appendTo(content);
+        content.append(' ');
+    }
+    if ((page + 1) * CATALOG_PAGE < total) {
+        $('<a>')
+            .attr('href', `?mode=catalog&page=${page + 1}`)
+            .text('next')
+            .appendTo(content);
+    }
+    $('<br>').appendTo(content);
     for (const [n, md] of Object.entries(data)) {
         let a = $('<a>').attr('href', `?mode=caption&id=${n}`);
         // Trade-off: load full size thumbnails to hit the cache, but then scale
@@ -106,7 +149,7 @@ function catalog() {
                       style: 'float:left; margin:5px;',
                       loading: 'lazy',
                       class: 'thumbnail',
-                      src: `masked_thumbnail/${n}/${SZ}`
+                      src: `masked_thumbnail/${n}/${SZ}?v=${crop_version(md)}`
                   })
                       .width(sz)
                       .height(sz)
@@ -131,11 +174,14 @@ function caption() {
     const md = data[curr_id];
     let content = $('#content').html('');
     $('<div>')
-        .text(`Caption: ${curr_id + 1} / ${Object.keys(data).length} (n = ${
+        .text(`Caption: ${curr_id + 1} / ${total} (n = ${
             md.n})`)
         .appendTo(content);
     $('#mode_caption').attr('class', 'mode_select');
-    $('<img>', {class: 'thumbnail', src: `thumbnail/${curr_id}/${SZ}`})
+    $('<img>', {
+        class: 'thumbnail',
+        src: `thumbnail/${curr_id}/${SZ}?v=${crop_version(md)}`
+    })
         .width(SZ)
         .height(SZ)
         .appendTo(content);
@@ -145,8 +191,10 @@ function caption() {
     }
     if (has_mask) {
         let mask_img =
-            $('<img>',
-              {class: 'thumbnail', src: `mask_thumbnail/${curr_id}/${SZ}`})
+            $('<img>', {
+                class: 'thumbnail',
+                src: `mask_thumbnail/${curr_id}/${SZ}?v=${crop_version(md)}`
+            })
                 .width(SZ)
                 .height(SZ)
                 .appendTo(content);
@@ -238,7 +286,7 @@ function crop() {
     let content = $('#content').html('');
     $('<div>')
         .text(
-            `Crop: ${curr_id + 1} / ${Object.keys(data).length} (n = ${md.n}) |
+            `Crop: ${curr_id + 1} / ${total} (n = ${md.n}) |
     original size ${md.orig_w} x ${md.orig_h}`)
         .appendTo(content);
 
@@ -335,7 +383,7 @@ function rotate() {
     const md = data[curr_id];
     let content = $('#content').html('');
     $('<div>')
-        .text(`Rotate: ${curr_id + 1} / ${Object.keys(data).length} (n = ${
+        .text(`Rotate: ${curr_id + 1} / ${total} (n = ${
             md.n})`)
         .appendTo(content);
 
@@ -2,8 +2,10 @@
 """
 Generate a dataset directory.
 """
-from util import Dataset
+from util import open_dataset
+import util
 import argparse
+import contextlib
 import os
 import numpy as np
 import io
@@ -30,71 +32,101 @@ def main():
     p.add_argument(
         "--prefix", type=str, default="", help="Prefix to add to all captions."
     )
+    p.add_argument(
+        "--cache_dir",
+        default=None,
+        help="Use the shared thumbnail cache in this dir. (optional)",
+    )
+    p.add_argument(
+        "--cache_backend",
+        choices=sorted(util.CACHE_BACKENDS),
+        default=None,
+        help="Thumbnail cache implementation, when creating a new cache.",
+    )
+    p.add_argument(
+        "--shard",
+        type=int,
+        default=None,
+        help="Only process this shard of a sharded dataset. (optional)",
+    )
     args = p.parse_args()
 
     os.makedirs(f"{args.outdir}", exist_ok=True)
 
-    # Load datasets.
-    datasets = [Dataset(i) for i in args.inputs]
-    dsn = len(datasets)
-    print(f"loaded {dsn} datasets")
+    # Load datasets. Exiting the stack flushes their thumbnail caches.
+    with contextlib.ExitStack() as stack:
+        datasets = [
+            stack.enter_context(
+                open_dataset(
+                    i,
+                    cache_dir=args.cache_dir,
+                    cache_backend=args.cache_backend,
+                    shard=args.shard,
+                )
+            )
+            for i in args.inputs
+        ]
+        dsn = len(datasets)
+        print(f"loaded {dsn} datasets")
 
-    # Process all inputs.
-    count = 0
-    for dsi, ds in enumerate(datasets):
-        on = len(ds._data)
-        for oi, o in enumerate(ds._data.values()):
-            # assert os.path.getsize(o["fn"]) == o["fsz"]
-            if "skip" in o:
-                print(f'skip {o["fn"]} because {o["skip"]!r}')
-                continue
-            if args.need_crop and "manual_crop" not in o:
-                print(f'skip {o["fn"]} because no manual crop')
-                continue
-            if args.need_caption and "caption" not in o:
-                print(f'skip {o["fn"]} because no caption')
-                continue
+        # Process all inputs.
+        count = 0
+        for dsi, ds in enumerate(datasets):
+            conds = {"skip": False}
+            if args.need_crop:
+                conds["manual_crop"] = True
+            if args.need_caption:
+                conds["caption"] = True
+            todo = ds.select(**conds)
+            print(
+                f"ds {dsi+1}/{dsn}: using {len(todo)} of {len(ds._data)} records, "
+                f"{ds.count(skip=True)} are skipped"
+            )
+            on = len(todo)
+            for oi, n in enumerate(todo):
+                o = ds._data[n]
+                # assert os.path.getsize(o["fn"]) == o["fsz"]
 
-            # Manual vs automatic vs override caption.
-            caption = o.get("caption", "")
-            autocaption = o.get("autocaption", "")
-            if args.caption:
-                caption = args.caption.replace("AUTOCAPTION", autocaption).replace(
-                    "CAPTION", caption
-                )
-            else:
-                if caption == "":
-                    caption = autocaption
-                if type(caption) is list:
-                    caption = caption[0]
-                    assert len(caption) == 2, caption
-                    assert type(caption[1]) is str, caption
-                    caption = caption[1]
+                # Manual vs automatic vs override caption.
+                caption = o.get("caption", "")
+                autocaption = o.get("autocaption", "")
+                if args.caption:
+                    caption = args.caption.replace("AUTOCAPTION", autocaption).replace(
+                        "CAPTION", caption
+                    )
+                else:
+                    if caption == "":
+                        caption = autocaption
+                    if type(caption) is list:
+                        caption = caption[0]
+                        assert len(caption) == 2, caption
+                        assert type(caption[1]) is str, caption
+                        caption = caption[1]
 
-            if caption == "":
-                print(f'skip {o["fn"]} missing caption and autocaption')
-                continue
+                if caption == "":
+                    print(f'skip {o["fn"]} missing caption and autocaption')
+                    continue
 
-            caption = args.prefix + caption.strip().lower()
+                caption = args.prefix + caption.strip().lower()
 
-            # Stop at limit.
-            count += 1
-            if args.limit > 0 and count > args.limit:
-                return
+                # Stop at limit.
+                count += 1
+                if args.limit > 0 and count > args.limit:
+                    return
 
-            # Write out.
-            img = ds.cropped_jpg(o["n"], args.size)
-            mask = ds.cropped_mask(o["n"], args.size)
-            ofn = f"{count:06d}_{o['n']}_{o['md5']}"
-            with open(f"{args.outdir}/{ofn}.jpg", "wb") as f:
-                f.write(img)
-            with open(f"{args.outdir}/{ofn}.mask.png", "wb") as f:
-                f.write(mask)
-            with open(f"{args.outdir}/{ofn}.txt", "w") as f:
-                assert type(caption) is str, (caption, o)
-                f.write(caption + "\n")
+                # Write out.
+                img = ds.cropped_jpg(o["n"], args.size)
+                mask = ds.cropped_mask(o["n"], args.size)
+                ofn = f"{count:06d}_{o['n']}_{o['md5']}"
+                with open(f"{args.outdir}/{ofn}.jpg", "wb") as f:
+                    f.write(img)
+                with open(f"{args.outdir}/{ofn}.mask.png", "wb") as f:
+                    f.write(mask)
+                with open(f"{args.outdir}/{ofn}.txt", "w") as f:
+                    assert type(caption) is str, (caption, o)
+                    f.write(caption + "\n")
 
-            print(f'ds {dsi+1}/{dsn} n {oi+1}/{on} fn {o["fn"]!r} {caption!r}')
+                print(f'ds {dsi+1}/{dsn} n {oi+1}/{on} fn {o["fn"]!r} {caption!r}')
 
 
 if __name__ == "__main__":
@@ -4,7 +4,6 @@ Pad all images.
 """
 import argparse
 import os
-import hashlib
 import util
 import PIL
 from add import pad_to_square, md5
@@ -22,29 +21,43 @@ def main():
     print(f"working relative to {dsdir!r}")
 
     # Load dataset.
-    ds = util.Dataset(args.dsfile)
-
-    for md in ds._data.values():
-        fn = md['fn']
-        print(fn)
-        try:
-            img = util.load_image(fn, dsdir)
-        except PIL.UnidentifiedImageError as e:
-            print(f"WARN: skipping {fn} because {e}")
-            continue
-
-        fn = f'{dsdir}/{fn}'
-        cksum = md5(fn)
-        if cksum != md['md5']:
-            print(' md5 changed!')
-
-        md['md5'] = cksum
-        md['fsz'] = os.path.getsize(fn)
-        md['orig_w'] = img.width
-        md['orig_h'] = img.height
-        pad_to_square(md)
-
-    ds.compact()
+    ds = util.open_dataset(args.dsfile)
+
+    changed = 0
+    with util.StatIndex.for_dataset(args.dsfile) as index:
+        for md in ds._data.values():
+            fn = md['fn']
+            print(fn)
+            path = f'{dsdir}/{fn}'
+            st = util.StatIndex.stat(path)
+            known = index.get(fn, st)
+            if known is None:
+                # Changed or never indexed, read it.
+                try:
+                    w, h = util.probe_image(path)
+                except PIL.UnidentifiedImageError as e:
+                    print(f"WARN: skipping {fn} because {e}")
+                    continue
+                cksum = md5(path)
+                index.put(fn, st, cksum, w, h)
+            else:
+                cksum, w, h, _ = known
+            if cksum != md['md5']:
+                print(' md5 changed!')
+
+            before = dict(md)
+            md['md5'] = cksum
+            md['fsz'] = st[0]
+            md['orig_w'] = w
+            md['orig_h'] = h
+            pad_to_square(md)
+            changed += dict(md) != before
+
+    if changed:
+        print(f"{changed} records changed")
+        ds.compact()
+    else:
+        print("nothing changed")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Convert a dataset between the single file and the sharded layout, or change
+the number of shards.
+
+A sharded dataset is a directory, and the tools take it wherever they take a
+dataset JSON file. Keep the output next to the input, since originals are
+relative to the directory containing the dataset.
+"""
+from util import ShardedDataset, open_dataset
+import argparse
+import os
+
+# How many records to write at a time.
+BATCH = 10000
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("input", help="Dataset JSON file or sharded dataset dir.")
+    p.add_argument("output", help="Dataset to create.")
+    p.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="Number of shards, 1 writes a single JSON file.",
+    )
+    args = p.parse_args()
+
+    if os.path.exists(args.output):
+        p.error(f"{args.output} already exists")
+    if os.path.dirname(os.path.abspath(args.input)) != os.path.dirname(
+        os.path.abspath(args.output)
+    ):
+        p.error("output has to be in the same dir as input")
+
+    print(f"loading {args.input}")
+    src = open_dataset(args.input)
+    if args.shards > 1:
+        ShardedDataset.create(args.output, args.shards)
+    dst = open_dataset(args.output)
+    objs = [o for _, o in sorted(src._data.items())]
+    for i in range(0, len(objs), BATCH):
+        dst.add_many(objs[i : i + BATCH])
+        print(f"{min(i + BATCH, len(objs))}/{len(objs)} records")
+    # Writes the indexes.
+    dst.compact()
+    print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
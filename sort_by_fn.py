@@ -2,7 +2,7 @@
 """
 Sort a dataset by filename, this renumbers all the entries.
 """
-from util import Dataset
+from util import open_dataset
 import argparse
 
 
@@ -13,7 +13,7 @@ def main():
 
     for i in args.inputs:
         print(f"sorting {i}")
-        ds = Dataset(i)
+        ds = open_dataset(i)
         fn_n = [(md["fn"], md["n"]) for md in ds._data.values()]
         fn_n.sort()
 
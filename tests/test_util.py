@@ -0,0 +1,684 @@
+import json
+from pathlib import Path
+from unittest import TestCase
+
+from PIL import Image
+import numpy as np
+
+from util import (
+    DB,
+    Dataset,
+    DupeIndex,
+    ImageCache,
+    PackCache,
+    Record,
+    ShardedDataset,
+    StatIndex,
+    cache_key,
+    dhash,
+    json_dumps,
+    load_and_transform,
+    load_image,
+    md5_file,
+    open_dataset,
+    probe_image,
+)
+import pickle
+import sqlite3
+import tempfile
+
+
+class DBTestCase(TestCase):
+    def test_batched_writes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "test.cache")
+            with DB(fn, batch_size=10, batch_secs=1000) as db:
+                db[b"a"] = b"1"
+                # Pending writes are visible to the writer.
+                self.assertEqual(db[b"a"], b"1")
+                # But not committed yet.
+                with self.assertRaises(KeyError):
+                    DB(fn)[b"a"]
+            # Leaving the context commits.
+            self.assertEqual(DB(fn)[b"a"], b"1")
+
+    def test_flush_by_count(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "test.cache")
+            db = DB(fn, batch_size=3, batch_secs=1000)
+            for i in range(3):
+                db[f"k{i}".encode()] = b"x"
+            self.assertEqual(DB(fn)[b"k2"], b"x")
+
+    def test_lru_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "test.cache")
+            db = DB(fn, batch_size=1)
+            db.set_max_bytes(1000)
+            db[b"old"] = b"x" * 400
+            db[b"new"] = b"x" * 400
+            # Make "old" least recently used, then go over budget.
+            db._db.execute("UPDATE keys SET atime=0 WHERE key=?", (b"old",))
+            db[b"newer"] = b"x" * 400
+            self.assertNotIn(b"old", db)
+            self.assertIn(b"new", db)
+            self.assertIn(b"newer", db)
+            self.assertEqual(db.stats()["evictions"], 1)
+
+    def test_gc(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "test.cache")
+            db = DB(fn)
+            db[b"keep"] = b"1"
+            db[b"drop"] = b"2"
+            self.assertEqual(db.gc(lambda k: k == b"keep"), 1)
+            self.assertEqual(db.stats()["entries"], 1)
+            self.assertEqual(db[b"keep"], b"1")
+
+
+def make_dataset(dsdir, name="ds.json", size=(40, 30)):
+    """
+    Write an image and a one-record dataset referencing it, returns the dataset
+    filename.
+    """
+    Image.new("RGB", size, color=(255, 0, 0)).save(Path(dsdir) / "img.png")
+    fn = str(Path(dsdir) / name)
+    w, h = size
+    with Dataset(fn) as ds:
+        ds.add(
+            {
+                "fn": "img.png",
+                "md5": md5_file(Path(dsdir) / "img.png"),
+                "orig_w": w,
+                "orig_h": h,
+                "x": 0,
+                "y": (h - w) // 2,
+                "w": w,
+                "h": w,
+                "rot": 0,
+            }
+        )
+    return fn
+
+
+class DatasetTestCase(TestCase):
+    def test_shared_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            a = make_dataset(tmp, "a.json")
+            b = make_dataset(tmp, "b.json")
+            cache_dir = str(Path(tmp) / "cache")
+            with Dataset(a, cache_dir=cache_dir) as ds:
+                jpg = ds.cropped_jpg(0, 32)
+            with Dataset(b, cache_dir=cache_dir) as ds:
+                self.assertEqual(ds.cropped_jpg(0, 32), jpg)
+                stats = ds.cache_stats()
+            self.assertEqual(stats["entries"], 1)
+            self.assertEqual(stats["hits"], 1)
+
+    def test_migrate_json_keys(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "test.cache")
+            o = {"md5": "ab" * 16, "x": -1, "y": 2, "w": 3, "h": 4, "rot": 1}
+            old = sqlite3.connect(fn)
+            old.execute("CREATE TABLE db(key PRIMARY KEY, value)")
+            key = json.dumps(dict(o, sz=512), sort_keys=True)
+            old.execute("INSERT INTO db VALUES(?, ?)", (key, b"jpg"))
+            old.commit()
+            old.close()
+            self.assertEqual(DB(fn)[cache_key(o, 512)], b"jpg")
+
+
+def key(i, sz=512):
+    return cache_key({"md5": "%032x" % i, "x": 0, "y": 0, "w": 1, "h": 1}, sz)
+
+
+class ImageCacheTestCase(TestCase):
+    def test_lru(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for name in "abc":
+                Image.new("RGBA", (10, 10)).save(f"{tmp}/{name}.png")
+            load = lambda path: Image.open(path).convert("RGBA")
+            # Room for two 10x10 RGBA images.
+            cache = ImageCache(800)
+            a = cache.get(f"{tmp}/a.png", load)
+            cache.get(f"{tmp}/b.png", load)
+            self.assertIs(cache.get(f"{tmp}/a.png", load), a)
+            cache.get(f"{tmp}/c.png", load)  # Evicts b.
+            self.assertIs(cache.get(f"{tmp}/a.png", load), a)
+            stats = cache.stats()
+            self.assertEqual(stats["hits"], 2)
+            self.assertEqual(stats["misses"], 3)
+            self.assertEqual(stats["evictions"], 1)
+            self.assertEqual(stats["bytes"], 800)
+
+            # Editing the file invalidates it.
+            Image.new("RGBA", (5, 10)).save(f"{tmp}/a.png")
+            self.assertEqual(cache.get(f"{tmp}/a.png", load).width, 5)
+
+
+class LoadTestCase(TestCase):
+    def test_draft_decode(self):
+        def centroid(img):
+            a = np.asarray(img.convert("L"), dtype=float)
+            ys, xs = np.indices(a.shape)
+            return (a * xs).sum() / a.sum(), (a * ys).sum() / a.sum()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # Odd sizes and a rotation flip axes with partial JPEG blocks.
+            pixels = np.zeros((1001, 803, 3), dtype=np.uint8)
+            pixels[301:700, 203:601] = 255
+            exif = Image.Exif()
+            exif[0x0112] = 6
+            Image.fromarray(pixels).save(f"{tmp}/a.jpg", quality=95, exif=exif)
+            o = {"fn": "a.jpg", "orig_w": 1001, "orig_h": 803}
+            o.update(x=101, y=-3, w=800, h=800, rot=0)
+            img = load_and_transform(o, 100, 100, dsdir=tmp)
+            self.assertEqual(load_image("a.jpg", tmp, reduce=8).info["scale"][0], 8)
+            # Lands where a full resolution decode would, to a fraction of a
+            # full resolution pixel.
+            full = load_image("a.jpg", tmp).crop((101, -3, 901, 797))
+            full = full.resize((100, 100), Image.Resampling.BICUBIC)
+            for a, b in zip(centroid(img), centroid(full)):
+                self.assertAlmostEqual(a, b, delta=0.1)
+
+    def test_padded(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            Image.new("RGB", (40, 20), (0, 0, 255)).save(f"{tmp}/a.png")
+            # Padded to square as by add.pad_to_square, then rotated.
+            o = {"fn": "a.png", "orig_w": 40, "orig_h": 20}
+            o.update(x=0, y=-10, w=40, h=40, rot=1)
+            img = load_and_transform(o, 20, 20, dsdir=tmp)
+            self.assertEqual(img.mode, "RGBA")
+            self.assertEqual(img.getpixel((0, 10)), (0, 0, 0, 0))
+            self.assertEqual(img.getpixel((10, 10)), (0, 0, 255, 255))
+            self.assertEqual(img.getpixel((19, 10)), (0, 0, 0, 0))
+            img = load_and_transform(o, 20, 20, dsdir=tmp, mode="RGB")
+            self.assertEqual(img.getpixel((0, 10)), (0, 0, 0))
+            self.assertEqual(img.getpixel((10, 10)), (0, 0, 255))
+
+    def test_probe(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            exif = Image.Exif()
+            exif[0x0112] = 6
+            Image.new("RGB", (40, 20)).save(f"{tmp}/a.jpg", exif=exif)
+            Image.new("RGB", (40, 20)).save(f"{tmp}/b.png")
+            self.assertEqual(probe_image(f"{tmp}/a.jpg"), (20, 40))
+            self.assertEqual(load_image("a.jpg", tmp).size, (20, 40))
+            self.assertEqual(probe_image(f"{tmp}/b.png"), (40, 20))
+
+
+class StatIndexTestCase(TestCase):
+    def test_stat_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = f"{tmp}/a.png"
+            Image.new("RGB", (4, 3)).save(path)
+            st = StatIndex.stat(path)
+            with StatIndex.for_dataset(f"{tmp}/ds.json") as index:
+                self.assertIsNone(index.get("a.png", st))
+                index.put("a.png", st, md5_file(path), 4, 3)
+            index = StatIndex.for_dataset(f"{tmp}/ds.json")
+            self.assertEqual(index.get("a.png", st), (md5_file(path), 4, 3, None))
+            # Rewriting the file invalidates the entry.
+            Image.new("RGB", (5, 3)).save(path)
+            self.assertIsNone(index.get("a.png", StatIndex.stat(path)))
+
+
+class DupeIndexTestCase(TestCase):
+    def test_dhash(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pixels = np.random.default_rng(0).integers(0, 256, (9, 12, 3))
+            img = Image.fromarray(pixels.astype(np.uint8)).resize((120, 90))
+            img.save(f"{tmp}/a.png")
+            img.resize((60, 45)).save(f"{tmp}/b.jpg", quality=70)
+            img.transpose(Image.Transpose.FLIP_LEFT_RIGHT).save(f"{tmp}/c.png")
+            a, b, c = (
+                int(dhash(f"{tmp}/{i}"), 16) for i in ["a.png", "b.jpg", "c.png"]
+            )
+            self.assertLessEqual(bin(a ^ b).count("1"), 4)
+            self.assertGreater(bin(a ^ c).count("1"), 16)
+
+    def test_query(self):
+        index = DupeIndex(max_dist=3)
+        index.add("a", "ffff000000000000")
+        index.add("b", "ffff000000000007")
+        index.add("c", "0000ffff00000000")
+        self.assertEqual(index.query("ffff000000000001"), [(1, "a"), (2, "b")])
+        self.assertEqual(index.query("ffff00000000000f"), [(1, "b")])
+        self.assertEqual(index.query("0f0f0f0f0f0f0f0f"), [])
+        # Blank images of any color hash to about 0, they aren't duplicates.
+        index.add("d", "0000000000000000")
+        self.assertEqual(index.query("0000000000000001"), [])
+
+    def test_groups(self):
+        hashes = ["ffff000000000000", "0000ffff00000000", "ffff000000000007"]
+        hashes += ["ffff00000000003f", "0000ffff00000000", "1234567890abcdef"]
+        hashes += ["0000000000000000", "0000000000000001", "ffffffffffffffff"]
+        groups = DupeIndex.groups(list(range(9)), hashes, max_dist=3)
+        # 3 is within 3 bits of 2 but not 0, which still makes one group.
+        self.assertEqual(sorted(groups), [[0, 2, 3], [1, 4]])
+
+    def test_groups_skewed(self):
+        # Few bits set, so most hashes share chunks and runs get split.
+        rng = np.random.default_rng(0)
+        hashes = [
+            sum(1 << int(i) for i in rng.choice(64, 7, replace=False))
+            for _ in range(600)
+        ]
+        hashes += [h ^ 1 << int(rng.integers(64)) for h in hashes[:50]]
+        hexhashes = ["%016x" % h for h in hashes]
+        index = DupeIndex(max_dist=3)
+        for key, h in enumerate(hexhashes):
+            index.add(key, h)
+        pairs = {(k, key) for key, h in enumerate(hexhashes) for _, k in index.query(h)}
+        old = DupeIndex.MAX_RUN
+        DupeIndex.MAX_RUN = 8
+        try:
+            groups = DupeIndex.groups(list(range(len(hashes))), hexhashes, max_dist=3)
+        finally:
+            DupeIndex.MAX_RUN = old
+        group_of = {k: i for i, g in enumerate(groups) for k in g}
+        for a, b in pairs:
+            self.assertEqual(group_of.get(a, a), group_of.get(b, b))
+        for g in groups:
+            self.assertTrue(all(any((k, j) in pairs for j in g if j != k) for k in g))
+
+
+class PackCacheTestCase(TestCase):
+    def test_get_set(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            base = str(Path(tmp) / "test.cache")
+            with PackCache(base) as cache:
+                cache[key(1)] = b"one"
+                cache[key(2)] = b"two"
+            cache = PackCache(base)
+            self.assertEqual(cache[key(1)], b"one")
+            self.assertEqual(bytes(cache.view(key(2))), b"two")
+            self.assertNotIn(key(3), cache)
+            self.assertEqual(cache.stats()["entries"], 2)
+
+    def test_grow_and_gc(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            base = str(Path(tmp) / "test.cache")
+            num = PackCache.MIN_CAPACITY
+            with PackCache(base, batch_size=100) as cache:
+                for i in range(num):
+                    cache[key(i)] = str(i).encode()
+            cache = PackCache(base)
+            self.assertEqual(cache[key(num - 1)], str(num - 1).encode())
+            self.assertEqual(cache.gc(lambda k: k != key(0)), 1)
+            self.assertNotIn(key(0), cache)
+            self.assertEqual(cache[key(1)], b"1")
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            base = str(Path(tmp) / "test.cache")
+            cache = PackCache(base, batch_size=1)
+            cache.set_max_bytes(1000)
+            cache[key(1)] = b"x" * 400
+            cache[key(2)] = b"x" * 400
+            # Make 1 least recently used, then go over budget.
+            i, slot = cache._probe(cache._idx, key(1))
+            cache._set_slot(cache._idx, i, key(1), slot[1], slot[2], 0)
+            cache[key(3)] = b"x" * 400
+            self.assertNotIn(key(1), cache)
+            self.assertIn(key(2), cache)
+            self.assertIn(key(3), cache)
+            self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_other_process_rewrite(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            base = str(Path(tmp) / "test.cache")
+            a = PackCache(base, batch_size=1)
+            b = PackCache(base, batch_size=1)
+            a[key(1)] = b"one"
+            self.assertEqual(b[key(1)], b"one")
+            b.vacuum()
+            a[key(2)] = b"two"
+            self.assertEqual(b[key(2)], b"two")
+
+    def test_torn_slot(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            base = str(Path(tmp) / "test.cache")
+            cache = PackCache(base, batch_size=1)
+            cache[key(1)] = b"one"
+            i, slot = cache._probe(cache._idx, key(1))
+            # A slot another process is halfway through writing is a miss.
+            for offset, length in [(slot[1], 0), (slot[1], 2), (1, 3), (1 << 40, 3)]:
+                cache._set_slot(cache._idx, i, key(1), offset, length, 0)
+                self.assertNotIn(key(1), cache)
+            # Reads leave the index alone until flush().
+            cache._set_slot(cache._idx, i, *slot[:3], 0)
+            idx = bytes(cache._idx)
+            self.assertEqual(cache[key(1)], b"one")
+            self.assertEqual(bytes(cache._idx), idx)
+            cache.flush()
+            self.assertNotEqual(cache._probe(cache._idx, key(1))[1][3], 0)
+
+
+class AddManyTestCase(TestCase):
+    def test_add_many(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "ds.json")
+            ds = Dataset(fn)
+            ds.add({"n": 5, "fn": "a"})
+            ds.add_many([{"fn": "b"}, {"fn": "c"}])
+            self.assertEqual(ds.next_n(), 8)
+            ds = Dataset(fn)
+            self.assertEqual(ds._data[7]["fn"], "c")
+            self.assertEqual(ds.next_n(), 8)
+            self.assertTrue(ds.seen_fn("b"))
+
+    def test_no_reload_after_add(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "ds.json")
+            ds = Dataset(fn)
+            ds.add_many([{"fn": str(i)} for i in range(3)])
+            self.assertFalse(ds.refresh())
+            ds.add({"fn": "3"})
+            self.assertFalse(ds.refresh())
+
+    def test_delete_survives_compact(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "ds.json")
+            ds = Dataset(fn)
+            ds.add_many([{"fn": str(i)} for i in range(6)])
+            ds.update({"n": 0, "fn": "x"}, append=True)
+            del ds._data[5]
+            ds.compact()
+            self.assertNotIn(5, ds._data)
+            self.assertNotIn(5, Dataset(fn)._data)
+            self.assertEqual(Dataset(fn)._data[0]["fn"], "x")
+
+
+class CompactTestCase(TestCase):
+    def test_compact_log(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "ds.json")
+            ds = Dataset(fn)
+            ds.add_many([{"fn": str(i)} for i in range(10)])
+            for i in range(10):
+                ds.update({"n": i % 3, "fn": "x", "caption": str(i)}, append=False)
+            self.assertEqual(ds.stale_lines(), 10)
+            ds.compact_log()
+            self.assertEqual(ds.stale_lines(), 0)
+            with open(fn) as f:
+                self.assertEqual(len(f.readlines()), 10)
+            ds.update({"n": 0, "fn": "y"}, append=False)
+            self.assertEqual(Dataset(fn)._data, ds._data)
+            self.assertEqual(Dataset(fn)._data[2]["caption"], "8")
+
+    def test_renumber(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "ds.json")
+            ds = Dataset(fn)
+            ds.add_many([{"fn": str(i)} for i in range(5)])
+            # Like drop_missing.py.
+            for k in [1, 3]:
+                del ds._data[k]
+            for n, k in enumerate(list(ds._data.keys())):
+                ds._data[k]["n"] = n
+            ds.compact()
+            for d in [ds, Dataset(fn)]:
+                self.assertEqual(sorted(d._data.keys()), [0, 1, 2])
+                self.assertEqual([d._data[n]["fn"] for n in range(3)], ["0", "2", "4"])
+                self.assertEqual(d.next_n(), 3)
+
+    def test_background_compaction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "ds.json")
+            ds = Dataset(fn)
+            ds.COMPACT_MIN_LINES = 5
+            ds.add_many([{"fn": str(i)} for i in range(10)])
+            for i in range(100):
+                ds.update({"n": i % 10, "fn": "x", "caption": str(i)}, append=False)
+            ds.wait_for_compaction()
+            self.assertLess(ds.stale_lines(), 100)
+            self.assertEqual(Dataset(fn)._data, ds._data)
+
+    def test_close_replaced_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "ds.json")
+            with Dataset(fn) as ds:
+                ds.add_many([{"fn": str(i)} for i in range(3)])
+                f = ds._file
+                ds.compact()
+                self.assertTrue(f.closed)
+                ds.update({"n": 0, "fn": "x"}, append=False)
+                f = ds._file
+                ds.compact_log()
+                self.assertTrue(f.closed)
+                f = ds._file
+            self.assertTrue(f.closed)
+            self.assertIsNone(ds._file)
+
+
+class IndexTestCase(TestCase):
+    def test_lazy_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "ds.json")
+            ds = Dataset(fn)
+            ds.add_many([{"fn": str(i)} for i in range(10)])
+            ds.add({"n": 3, "fn": "x"})
+            ds.compact()
+            # Appended after the index was written.
+            ds.add({"n": 4, "fn": "y"})
+            ds.add({"fn": "z"})
+
+            ds = Dataset(fn)
+            self.assertIsNone(ds._data._items[0])
+            self.assertEqual(ds._data[3]["fn"], "x")
+            self.assertEqual(ds._data[4]["fn"], "y")
+            self.assertEqual(ds._data[10]["fn"], "z")
+            self.assertEqual(ds.next_n(), 11)
+            self.assertTrue(ds.seen_fn("9"))
+            self.assertEqual(len(ds._data), 11)
+
+    def test_rewritten_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "ds.json")
+            ds = Dataset(fn)
+            ds.add_many([{"fn": str(i)} for i in range(10)])
+            ds.compact()
+            # Rewrite the file behind the index's back.
+            with open(fn, "w") as f:
+                f.write(json.dumps({"n": 0, "fn": "new"}) + "\n")
+            ds = Dataset(fn)
+            self.assertEqual(list(ds._data.items()), [(0, {"n": 0, "fn": "new"})])
+
+
+class SnapshotTestCase(TestCase):
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "ds.json")
+            ds = Dataset(fn)
+            ds.add_many(
+                [
+                    {"fn": str(i), "x": -i, "caption": "é", "auto_blip1": ["a"]}
+                    for i in range(10)
+                ]
+            )
+            ds.add({"n": 2, "fn": "x", "skip": None, "big": 1 << 70})
+            ds.write_snapshot()
+            # Appended after the snapshot was written.
+            ds.add({"n": 4, "fn": "y"})
+            ds.add({"fn": "z"})
+
+            ds2 = Dataset(fn)
+            self.assertIsNotNone(ds2._data._base)
+            self.assertEqual(dict(ds2._data.items()), dict(ds._data.items()))
+            self.assertEqual(list(ds2._data), list(range(11)))
+            self.assertEqual(ds2.next_n(), 11)
+            del ds2._data[5]
+            self.assertNotIn(5, ds2._data)
+            self.assertEqual(len(ds2._data), 10)
+            ds2.compact_log()
+            self.assertEqual(Dataset(fn)._data, ds2._data)
+
+
+class SelectTestCase(TestCase):
+    def test_select(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ds = Dataset(str(Path(tmp) / "ds.json"))
+            ds.add_many([{"fn": str(i), "md5": str(i % 2)} for i in range(6)])
+            self.assertEqual(ds.select(md5="1"), [1, 3, 5])
+            self.assertEqual(ds.count(auto_coca=False), 6)
+            # Changed in place, then updated.
+            o = ds._data[3]
+            o["auto_coca"] = ["x"]
+            o["md5"] = "0"
+            ds.update(o, append=True)
+            ds.add({"fn": "6", "md5": "1", "skip": "blurry"})
+            self.assertEqual(ds.select(md5="1"), [1, 5, 6])
+            self.assertEqual(ds.select(auto_coca=False, skip=False), [0, 1, 2, 4, 5])
+            self.assertEqual(ds.select(auto_coca=True), [3])
+            self.assertEqual(ds.count(skip=True), 1)
+            self.assertEqual(ds.select(mask_state="prep"), [])
+            with self.assertRaises(ValueError):
+                ds.select(fn="1")
+
+    def test_select_without_parsing(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "ds.json")
+            ds = Dataset(fn)
+            ds.add_many([{"fn": str(i), "md5": str(i % 2)} for i in range(6)])
+            ds.update({"n": 2, "fn": "2", "md5": "0", "skip": "y"}, append=True)
+            ds.compact_log()
+            for snapshot in [False, True]:
+                if snapshot:
+                    ds.write_snapshot()
+                # Appended after the index or snapshot was written.
+                ds.add({"n": 3, "fn": "3", "md5": "1", "skip": "y"})
+                ds2 = Dataset(fn)
+                self.assertEqual(ds2.count(skip=True), 2)
+                self.assertEqual(ds2.select(md5="1", skip=False), [1, 5])
+                self.assertEqual(ds2.select(mask_state=None, md5="0"), [0, 2, 4])
+                self.assertEqual(ds2._data._items.get(0), None)
+                o = ds2._data[1]
+                o["skip"] = "y"
+                ds2.update(o, append=True)
+                del ds2._data[5]
+                self.assertEqual(ds2.select(skip=True), [1, 2, 3])
+                self.assertEqual(ds2.select(dhash=False), [0, 1, 2, 3, 4])
+                ds.update({"n": 1, "fn": "1", "md5": "1"}, append=True)
+
+
+class RecordTestCase(TestCase):
+    def test_dict_api(self):
+        o = {"n": 1, "fn": "a.jpg", "x": 4000, "caption": "c"}
+        r = Record(o)
+        self.assertEqual(r, o)
+        self.assertEqual(list(r.items()), list(o.items()))
+        self.assertEqual(r.get("skip", "no"), "no")
+        c = r.copy()
+        c["x"] = 1
+        del c["caption"]
+        c["skip"] = "y"
+        self.assertEqual(r["x"], 4000)
+        self.assertIn("caption", r)
+        self.assertEqual(json_dumps(c), '{"n": 1, "fn": "a.jpg", "x": 1, "skip": "y"}')
+        self.assertEqual(pickle.loads(pickle.dumps(r)), o)
+
+    def test_dataset(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "ds.json")
+            ds = Dataset(fn)
+            ds.add({"fn": "a.jpg"})
+            self.assertIsInstance(ds._data[0], Record)
+            self.assertTrue(ds.seen_fn("a.jpg"))
+            self.assertIsInstance(Dataset(fn)._data[0], Record)
+
+
+class ConcurrentTestCase(TestCase):
+    # Two Datasets on one file stand in for two processes: each has its own
+    # lock file handle, so they exclude each other the same way.
+
+    def test_refresh(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "ds.json")
+            a = Dataset(fn)
+            a.add_many([{"fn": str(i)} for i in range(3)])
+            b = Dataset(fn)
+            self.assertFalse(b.refresh())
+            a.add({"fn": "3"})
+            # Appends pick up the other process's records and N first.
+            b.add({"fn": "4"})
+            self.assertEqual(b._data[3]["fn"], "3")
+            self.assertEqual(b._data[4]["fn"], "4")
+            self.assertTrue(a.refresh())
+            self.assertEqual(a._data[4]["fn"], "4")
+            # Compaction keeps the other process's appends.
+            a.add({"n": 0, "fn": "x"})
+            b.compact()
+            self.assertEqual(Dataset(fn)._data[0]["fn"], "x")
+            # And others reload after it.
+            self.assertTrue(a.refresh())
+            self.assertEqual(a._data, b._data)
+            self.assertEqual(a.stale_lines(), 0)
+
+    def test_merge_keys(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "ds.json")
+            captioner = Dataset(fn)
+            captioner.add({"fn": "a"})
+            md = captioner._data[0]
+            editor = Dataset(fn)
+            editor.update({"n": 0, "fn": "a", "caption": "edited"}, append=True)
+            md["auto_coca"] = ["auto"]
+            captioner.add_many([md], keys=["auto_coca"])
+            o = Dataset(fn)._data[0]
+            self.assertEqual(o["caption"], "edited")
+            self.assertEqual(o["auto_coca"], ["auto"])
+            # A record dropped meanwhile isn't brought back as a fragment.
+            editor.refresh()
+            del editor._data[0]
+            editor.compact()
+            captioner.add_many([md], keys=["auto_coca"])
+            self.assertNotIn(0, Dataset(fn)._data)
+
+    def test_compact_log_after_other_rewrite(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "ds.json")
+            a = Dataset(fn)
+            a.add_many([{"fn": str(i)} for i in range(3)])
+            a.add({"n": 0, "fn": "x"})
+            b = Dataset(fn)
+            b.add({"fn": "3"})
+            b.compact()
+            # a's view of the file is stale, so this gives up.
+            a.compact_log()
+            self.assertEqual(len(Dataset(fn)._data), 4)
+            a.add({"n": 1, "fn": "y"})
+            a.compact_log()
+            ds = Dataset(fn)
+            self.assertEqual(len(ds._data), 4)
+            self.assertEqual(ds._data[1]["fn"], "y")
+            self.assertEqual(ds.stale_lines(), 0)
+
+
+class ShardTestCase(TestCase):
+    def test_sharded(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = str(Path(tmp) / "ds")
+            ShardedDataset.create(fn, 3)
+            ds = open_dataset(fn)
+            ds.add_many([{"fn": str(i), "md5": str(i % 2)} for i in range(10)])
+            self.assertEqual(ds.next_n(), 10)
+            self.assertTrue(Path(fn, "00001.json").exists())
+            ds.update({"n": 4, "fn": "x", "md5": "1"}, append=True)
+            self.assertEqual(ds.stale_lines(), 1)
+            self.assertEqual(ds.select(md5="1"), [1, 3, 4, 5, 7, 9])
+
+            ds = ShardedDataset(fn, jobs=2)
+            self.assertEqual(len(ds._data), 10)
+            self.assertEqual(ds._data[4]["fn"], "x")
+            self.assertTrue(ds.seen_fn("9"))
+            ds.compact_log()
+            self.assertEqual(ds.stale_lines(), 0)
+            self.assertEqual(ds._data[4]["fn"], "x")
+
+            one = open_dataset(fn, shard=1)
+            self.assertEqual(sorted(one._data), [1, 4, 7])
+            with self.assertRaises(ValueError):
+                one.add({"fn": "new"})
+            one.update({"n": 7, "fn": "y"}, append=True)
+            self.assertEqual(open_dataset(fn)._data[7]["fn"], "y")
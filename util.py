@@ -4,201 +4,1970 @@ Utilities.
 """
 from PIL import Image, ImageFile, ImageOps, ImageChops
 import json
+import math
 import os
 import numpy as np
 import sqlite3
 import io
+import time
+import hashlib
+import struct
+import contextlib
+import fcntl
+import mmap
+import collections.abc
+import concurrent.futures
+import zipfile
+import threading
+import sys
 
 # Don't throw exception when a file only partially loads.
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 
-class DB:
+# Cache keys are fixed-width: the crop id (md5 and how it's cropped and
+# rotated), then the output size, flags, and the md5 of the custom mask if any.
+_CROP_ID = struct.Struct(">16s4iB")
+_CACHE_KEY = struct.Struct(">33sHB16s")
+CROP_ID_LEN = _CROP_ID.size
+CACHE_KEY_LEN = _CACHE_KEY.size
+
+# Flags in the cache key.
+_KEY_MASK = 1
+
+
+def _crop_id(md5, x, y, w, h, rot):
+    return _CROP_ID.pack(bytes.fromhex(md5), x, y, w, h, rot)
+
+
+def crop_id(o):
     """
-    Presents sqlite3 as a dict.
+    Returns bytes identifying the pixels of metadata object `o`: the original
+    and how it's cropped and rotated.
     """
+    return _crop_id(o["md5"], o["x"], o["y"], o["w"], o["h"], o.get("rot", 0))
+
+
+def cache_key(o, sz, mask=False, mask_md5=None):
+    """
+    Returns the thumbnail cache key for metadata object `o` at size `sz`.
+    For masks, `mask_md5` is the md5 of the custom mask file, if any.
+    """
+    mask_md5 = bytes(16) if mask_md5 is None else bytes.fromhex(mask_md5)
+    return _CACHE_KEY.pack(crop_id(o), sz, _KEY_MASK if mask else 0, mask_md5)
+
+
+def cache_key_from_json(key):
+    """
+    Converts a cache key from the old JSON format to cache_key().
+    """
+    key = json.loads(key)
+    o = _crop_id(key["md5"], key["x"], key["y"], key["w"], key["h"], key["rot"])
+    mask_md5 = bytes.fromhex(key.get("mask_md5", "00" * 16))
+    return _CACHE_KEY.pack(o, key["sz"], _KEY_MASK * key.get("mask", 0), mask_md5)
+
+
+def cache_key_crop_id(key):
+    """
+    Returns the crop_id() that cache_key() was made from.
+    """
+    return key[:CROP_ID_LEN]
 
-    def __init__(self, fn):
-        self._db = sqlite3.connect(fn)
-        self._db.execute("CREATE TABLE IF NOT EXISTS db(key PRIMARY KEY, value)")
+
+def tmp_name(fn):
+    """
+    Returns a temp filename next to `fn`, unique to this process and thread.
+    """
+    return f"{fn}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+@contextlib.contextmanager
+def atomic_write(fn):
+    """
+    Opens a temp file for binary writing, and renames it over `fn` when the
+    with block exits without an exception.
+    """
+    tmp = tmp_name(fn)
+    try:
+        with open(tmp, "wb") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, fn)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+@contextlib.contextmanager
+def flock(fn, exclusive=True):
+    """
+    Holds an advisory lock on the given lock file (created if needed) for the
+    duration of the with block.
+    """
+    with open(fn, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class Cache:
+    """
+    Interface shared by the thumbnail cache backends: presents a dict from
+    fixed-width bytes keys (see cache_key) to bytes.
+
+    Writes are group-committed: they're buffered in memory and written in one
+    go once `batch_size` writes are pending or `batch_secs` have passed since
+    the last commit. Call flush() (or use the cache as a context manager) to
+    commit whatever is left.
+
+    Each entry tracks its size and last access time. If a byte budget is set
+    (see set_max_bytes), the least recently used entries are evicted on flush
+    until the total is back under budget.
+    """
+
+    # Counters persisted by the backend.
+    STATS = ["hits", "misses", "evictions"]
+
+    # Don't bother recording reads more often than this (in seconds).
+    ATIME_RESOLUTION = 60
+
+    # When over budget, evict down to this fraction of it.
+    LOW_WATER = 0.9
+
+    def __init__(self, batch_size, batch_secs):
+        self._batch_size = batch_size
+        self._batch_secs = batch_secs
+        self._pending = {}  # Map from key to value, not yet committed.
+        self._counts = {i: 0 for i in self.STATS}  # Not yet committed.
+        self._last_flush = time.monotonic()
 
     def __getitem__(self, key):
-        assert type(key) is str
-        ret = self._db.execute("SELECT value FROM db WHERE key=?", (key,)).fetchone()
+        return self._get(key, copy=True)
+
+    def view(self, key):
+        """
+        Like self[key] but returns a bytes-like object that the backend
+        doesn't have to copy, e.g. a memoryview.
+        """
+        return self._get(key, copy=False)
+
+    def _get(self, key, copy):
+        assert type(key) is bytes
+        try:
+            ret = self._pending[key]
+            self._counts["hits"] += 1
+            return ret
+        except KeyError:
+            pass
+        ret = self._lookup(key, copy)
         if ret is None:
+            self._counts["misses"] += 1
             raise KeyError()
-        return ret[0]
+        self._counts["hits"] += 1
+        return ret
 
     def __setitem__(self, key, value):
-        assert type(key) is str
+        assert type(key) is bytes
         assert type(value) is bytes
-        self._db.execute("REPLACE INTO db VALUES(?, ?)", (key, value))
+        self._pending[key] = value
+        if (
+            len(self._pending) >= self._batch_size
+            or time.monotonic() - self._last_flush >= self._batch_secs
+        ):
+            self.flush()
+
+    def __contains__(self, key):
+        assert type(key) is bytes
+        return key in self._pending or self._contains(key)
+
+    def _lookup(self, key, copy):
+        """
+        Returns the committed value for key, or None.
+        """
+        raise NotImplementedError
+
+    def _contains(self, key):
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Commit all pending writes, access times and counters, then evict if
+        over budget.
+        """
+        raise NotImplementedError
+
+    def gc(self, keep):
+        """
+        Delete every entry whose key doesn't satisfy keep(key).
+        Returns the number of entries deleted.
+        """
+        raise NotImplementedError
+
+    def max_bytes(self):
+        """
+        Returns the byte budget, or 0 if unlimited.
+        """
+        raise NotImplementedError
+
+    def set_max_bytes(self, max_bytes):
+        """
+        Sets the byte budget, 0 means unlimited. This is stored in the cache so
+        it applies to every process using it.
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        Returns a dict of counters and sizes.
+        """
+        raise NotImplementedError
+
+    def vacuum(self):
+        """
+        Give space freed by evictions and gc back to the filesystem.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+class DB(Cache):
+    """
+    Cache backend that stores everything in one sqlite3 file.
+
+    Keys live in a small WITHOUT ROWID table so lookups are a single b-tree
+    search on a compact index. Values live in a separate rowid table: sqlite
+    recommends against large rows in WITHOUT ROWID tables, and this keeps the
+    index pages dense.
+    """
+
+    def __init__(self, fn, batch_size=256, batch_secs=2.0):
+        super().__init__(batch_size, batch_secs)
+        # The timeout is how long to wait for other processes' transactions.
+        self._db = sqlite3.connect(fn, timeout=60)
+        # WAL makes commits cheap and lets readers proceed during writes.
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS keys("
+            "key BLOB PRIMARY KEY, id INTEGER, size INTEGER, atime INTEGER"
+            ") WITHOUT ROWID"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS blobs(id INTEGER PRIMARY KEY, value BLOB)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS keys_atime ON keys(atime)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta(name PRIMARY KEY, value)")
+        self._migrate()
         self._db.commit()
+        self._touched = {}  # Map from key to new atime, not yet committed.
 
+    def _migrate(self):
+        """
+        Convert caches from before binary keys: they have a single table
+        called db, keyed on JSON strings.
+        """
+        exists = self._db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='db'"
+        ).fetchone()
+        if exists is None:
+            return
+        cols = [i[1] for i in self._db.execute("PRAGMA table_info(db)")]
+        atime = "atime" if "atime" in cols else "0"
+        rows = self._db.execute(f"SELECT key, value, {atime} FROM db")
+        for key, value, atime in rows:
+            self._put(cache_key_from_json(key), value, atime)
+        self._db.execute("DROP TABLE db")
+
+    def _put(self, key, value, atime):
+        self._db.execute(
+            "DELETE FROM blobs WHERE id=(SELECT id FROM keys WHERE key=?)", (key,)
+        )
+        blob_id = self._db.execute(
+            "INSERT INTO blobs(value) VALUES(?)", (value,)
+        ).lastrowid
+        self._db.execute(
+            "REPLACE INTO keys VALUES(?, ?, ?, ?)", (key, blob_id, len(value), atime)
+        )
+
+    def _lookup(self, key, copy):
+        ret = self._db.execute(
+            "SELECT value, atime FROM keys JOIN blobs USING(id) WHERE key=?", (key,)
+        ).fetchone()
+        if ret is None:
+            return None
+        now = int(time.time())
+        if now - ret[1] >= self.ATIME_RESOLUTION:
+            self._touched[key] = now
+        return ret[0]
+
+    def _contains(self, key):
+        ret = self._db.execute("SELECT 1 FROM keys WHERE key=?", (key,)).fetchone()
+        return ret is not None
+
+    def flush(self):
+        now = int(time.time())
+        for k, v in self._pending.items():
+            self._put(k, v, now)
+        self._pending = {}
+        if self._touched:
+            self._db.executemany(
+                "UPDATE keys SET atime=? WHERE key=?",
+                [(t, k) for k, t in self._touched.items()],
+            )
+            self._touched = {}
+        self._evict()
+        self._add_counts(self._counts)
+        self._counts = {i: 0 for i in self.STATS}
+        self._db.commit()
+        self._last_flush = time.monotonic()
+
+    def _add_counts(self, counts):
+        for name, delta in counts.items():
+            if delta == 0:
+                continue
+            self._db.execute(
+                "INSERT INTO meta VALUES(?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value=value+excluded.value",
+                (name, delta),
+            )
+
+    def _get_meta(self, name, default=0):
+        ret = self._db.execute(
+            "SELECT value FROM meta WHERE name=?", (name,)
+        ).fetchone()
+        return default if ret is None else ret[0]
+
+    def max_bytes(self):
+        return self._get_meta("max_bytes")
+
+    def set_max_bytes(self, max_bytes):
+        self._db.execute("REPLACE INTO meta VALUES('max_bytes', ?)", (max_bytes,))
+        self.flush()
+
+    def total_bytes(self):
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM keys").fetchone()[0]
+
+    def _delete(self, keys):
+        """
+        Delete the given list of keys.
+        """
+        for key in keys:
+            self._db.execute(
+                "DELETE FROM blobs WHERE id=(SELECT id FROM keys WHERE key=?)", (key,)
+            )
+            self._db.execute("DELETE FROM keys WHERE key=?", (key,))
+
+    def _evict(self):
+        """
+        Delete least recently used entries until we're under budget.
+        """
+        max_bytes = self.max_bytes()
+        if max_bytes <= 0:
+            return
+        total = self.total_bytes()
+        if total <= max_bytes:
+            return
+        target = int(max_bytes * self.LOW_WATER)
+        doomed = []
+        for key, size in self._db.execute("SELECT key, size FROM keys ORDER BY atime"):
+            if total <= target:
+                break
+            doomed.append(key)
+            total -= size
+        self._delete(doomed)
+        self._counts["evictions"] += len(doomed)
+
+    def gc(self, keep):
+        self.flush()
+        doomed = [k for (k,) in self._db.execute("SELECT key FROM keys") if not keep(k)]
+        self._delete(doomed)
+        self._db.commit()
+        return len(doomed)
+
+    def stats(self):
+        out = {i: self._get_meta(i) + self._counts[i] for i in self.STATS}
+        out["entries"] = self._db.execute("SELECT COUNT(*) FROM keys").fetchone()[0]
+        out["bytes"] = self.total_bytes()
+        out["max_bytes"] = self.max_bytes()
+        return out
+
+    def vacuum(self):
+        self.flush()
+        self._db.execute("VACUUM")
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+class PackCache(Cache):
+    """
+    Cache backend made of an append-only pack file of values, plus an
+    open-addressing hash table of (key, offset, length, atime) slots that's
+    mmap'd. Lookups don't copy anything, and view() returns a memoryview
+    straight into the mmap'd pack.
+
+    Files, for base path {base}:
+      {base}.idx        the hash table, replaced atomically on rewrite
+      {base}.{gen}.pack values, the generation is in the idx header
+      {base}.lock       serializes writers across processes
+
+    Overwritten, evicted and gc'd values are only reclaimed when the pack is
+    rewritten: on gc(), vacuum(), and when evicting to get under budget.
+
+    Reads don't take the lock, so a slot only counts if the pack has a
+    matching (key, length) entry header at its offset. Only writers, holding
+    the lock, write slots; reads record access times for the next flush().
+    """
+
+    MAGIC = b"DSPACK1\0"
+    HEADER_FIELDS = ["gen", "capacity", "count", "live", "max_bytes"] + Cache.STATS
+    HEADER = struct.Struct(f"<8s{len(HEADER_FIELDS)}Q")
+    # Slots are (key, offset into pack, length, atime). Offset 0 means empty.
+    SLOT = struct.Struct(f"<{CACHE_KEY_LEN}sQII")
+    SLOT_DTYPE = np.dtype(
+        [
+            ("key", f"V{CACHE_KEY_LEN}"),
+            ("offset", "<u8"),
+            ("length", "<u4"),
+            ("atime", "<u4"),
+        ]
+    )
+    # Each value in the pack is preceded by its key and length.
+    ENTRY = struct.Struct(f"<{CACHE_KEY_LEN}sI")
+    MIN_CAPACITY = 1 << 12
+    MAX_LOAD = 0.5
+
+    def __init__(self, base, batch_size=256, batch_secs=2.0):
+        super().__init__(batch_size, batch_secs)
+        self._base = base
+        self._lock_fn = f"{base}.lock"
+        self._pack = None
+        self._touched = {}  # Map from key to new atime, not yet committed.
+        with flock(self._lock_fn):
+            if not os.path.exists(f"{base}.idx"):
+                self._write_generation({"gen": 0, "max_bytes": 0}, [])
+            self._open()
+
+    def _pack_fn(self, gen):
+        return f"{self._base}.{gen}.pack"
+
+    def _open(self):
+        """
+        (Re)map the current index and pack. Needs the lock, shared is enough.
+        """
+        with open(f"{self._base}.idx", "r+b") as f:
+            self._idx_ino = os.fstat(f.fileno()).st_ino
+            self._idx = mmap.mmap(f.fileno(), 0)
+        with open(self._pack_fn(self._header()["gen"]), "rb") as f:
+            self._pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _reopen(self):
+        with flock(self._lock_fn, exclusive=False):
+            self._open()
+
+    def _stale(self):
+        """
+        Returns True if another process replaced the index since we mapped it.
+        """
+        return os.stat(f"{self._base}.idx").st_ino != self._idx_ino
+
+    def _header(self):
+        vals = self.HEADER.unpack_from(self._idx)
+        assert vals[0] == self.MAGIC, vals[0]
+        return dict(zip(self.HEADER_FIELDS, vals[1:]))
+
+    def _set_header(self, h):
+        vals = [h[i] for i in self.HEADER_FIELDS]
+        self.HEADER.pack_into(self._idx, 0, self.MAGIC, *vals)
+
+    @classmethod
+    def _probe(cls, idx, key):
+        """
+        Returns (slot number, slot tuple or None if empty) for key.
+        """
+        capacity = cls.HEADER.unpack_from(idx)[2]
+        mask = capacity - 1
+        i = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+        i &= mask
+        while True:
+            slot = cls.SLOT.unpack_from(idx, cls.HEADER.size + i * cls.SLOT.size)
+            if slot[1] == 0:
+                return i, None
+            if slot[0] == key:
+                return i, slot
+            i = (i + 1) & mask
+
+    @classmethod
+    def _set_slot(cls, idx, i, *slot):
+        cls.SLOT.pack_into(idx, cls.HEADER.size + i * cls.SLOT.size, *slot)
+
+    def _valid(self, slot):
+        """
+        Returns True if `slot` points at its own entry in the mapped pack.
+        Readers don't take the lock, so they may see a slot that a writer is
+        halfway through writing, or one pointing past what we have mapped.
+        """
+        key, offset, length, _ = slot
+        if length == 0 or offset < self.ENTRY.size:
+            return False
+        if offset + length > len(self._pack):
+            return False
+        entry = self.ENTRY.unpack_from(self._pack, offset - self.ENTRY.size)
+        return entry == (key, length)
+
+    def _find(self, key):
+        """
+        Returns the slot tuple for key, or None.
+        """
+        slot = self._probe(self._idx, key)[1]
+        if slot is not None and self._valid(slot):
+            return slot
+        if slot is None and not self._stale():
+            return None
+        # Another process appended or rewrote, or is writing this slot right
+        # now: look again with writers locked out.
+        with flock(self._lock_fn, exclusive=False):
+            self._open()
+            slot = self._probe(self._idx, key)[1]
+        if slot is not None and self._valid(slot):
+            return slot
+        return None
+
+    def _lookup(self, key, copy):
+        slot = self._find(key)
+        if slot is None:
+            return None
+        _, offset, length, atime = slot
+        now = int(time.time())
+        if now - atime >= self.ATIME_RESOLUTION:
+            self._touched[key] = now
+        ret = memoryview(self._pack)[offset : offset + length]
+        return bytes(ret) if copy else ret
+
+    def _contains(self, key):
+        return self._find(key) is not None
+
+    def _slots(self):
+        """
+        Returns a numpy array of all the used slots in the index.
+        """
+        slots = np.frombuffer(self._idx, dtype=self.SLOT_DTYPE, offset=self.HEADER.size)
+        return slots[slots["offset"] != 0].copy()
+
+    def flush(self):
+        with flock(self._lock_fn):
+            self._open()
+            h = self._header()
+            if (h["count"] + len(self._pending)) > h["capacity"] * self.MAX_LOAD:
+                self._rewrite(lambda k: True, reserve=len(self._pending))
+                h = self._header()
+            now = int(time.time())
+            with open(self._pack_fn(h["gen"]), "ab") as f:
+                offset = f.tell()
+                slots = []
+                for key, value in self._pending.items():
+                    f.write(self.ENTRY.pack(key, len(value)))
+                    f.write(value)
+                    offset += self.ENTRY.size
+                    slots.append((key, offset, len(value)))
+                    offset += len(value)
+            # Values are written before the index points at them.
+            for key, offset, length in slots:
+                i, old = self._probe(self._idx, key)
+                if old is None:
+                    h["count"] += 1
+                else:
+                    h["live"] -= old[2]
+                h["live"] += length
+                self._set_slot(self._idx, i, key, offset, length, now)
+            self._pending = {}
+            for key, atime in self._touched.items():
+                i, slot = self._probe(self._idx, key)
+                if slot is not None:
+                    self._set_slot(self._idx, i, key, slot[1], slot[2], atime)
+            self._touched = {}
+            for i in self.STATS:
+                h[i] += self._counts[i]
+            self._counts = {i: 0 for i in self.STATS}
+            self._set_header(h)
+            self._open()  # Pick up what we appended.
+            if 0 < h["max_bytes"] < h["live"]:
+                self._rewrite(lambda k: True)
+        self._last_flush = time.monotonic()
+
+    def _rewrite(self, keep, reserve=0):
+        """
+        With the lock held: write a new generation holding the entries that
+        satisfy keep(key), most recently used first, up to LOW_WATER of the
+        budget if there is one. Returns the number of entries dropped.
+        """
+        h = self._header()
+        slots = self._slots()
+        slots = slots[np.argsort(-slots["atime"].astype(np.int64), kind="stable")]
+        budget = int(h["max_bytes"] * self.LOW_WATER)
+        kept = []
+        live = 0
+        for slot in slots:
+            key = slot["key"].tobytes()
+            if not keep(key):
+                continue
+            length = int(slot["length"])
+            if budget > 0 and live + length > budget:
+                h["evictions"] += 1
+                continue
+            kept.append((key, int(slot["offset"]), length, int(slot["atime"])))
+            live += length
+        old_gen = h["gen"]
+        h["gen"] += 1
+        self._write_generation(h, kept, reserve)
+        self._open()
+        os.unlink(self._pack_fn(old_gen))
+        return len(slots) - len(kept)
+
+    def _write_generation(self, h, slots, reserve=0):
+        """
+        Write a pack holding the given slots' values, and an index pointing at
+        it. Then atomically switch to them by replacing the index.
+        """
+        capacity = self.MIN_CAPACITY
+        while len(slots) + reserve > capacity * self.MAX_LOAD / 2:
+            capacity *= 2
+        h = dict({i: 0 for i in self.HEADER_FIELDS}, **h)
+        h["capacity"] = capacity
+        h["count"] = len(slots)
+        h["live"] = sum(i[2] for i in slots)
+        idx = bytearray(self.HEADER.size + capacity * self.SLOT.size)
+        self.HEADER.pack_into(idx, 0, self.MAGIC, *[h[i] for i in self.HEADER_FIELDS])
+        with open(self._pack_fn(h["gen"]), "wb") as f:
+            f.write(self.MAGIC)  # So that offset 0 is never used.
+            offset = len(self.MAGIC)
+            for key, old_offset, length, atime in slots:
+                f.write(self.ENTRY.pack(key, length))
+                f.write(self._pack[old_offset : old_offset + length])
+                offset += self.ENTRY.size
+                i, _ = self._probe(idx, key)
+                self._set_slot(idx, i, key, offset, length, atime)
+                offset += length
+        tmp = f"{self._base}.idx.tmp"
+        with open(tmp, "wb") as f:
+            f.write(idx)
+        os.replace(tmp, f"{self._base}.idx")
+
+    def gc(self, keep):
+        self.flush()
+        with flock(self._lock_fn):
+            self._open()
+            return self._rewrite(keep)
+
+    def max_bytes(self):
+        return self._header()["max_bytes"]
+
+    def set_max_bytes(self, max_bytes):
+        with flock(self._lock_fn):
+            self._open()
+            h = self._header()
+            h["max_bytes"] = max_bytes
+            self._set_header(h)
+        self.flush()
+
+    def stats(self):
+        if self._stale():
+            self._reopen()
+        h = self._header()
+        out = {i: h[i] + self._counts[i] for i in self.STATS}
+        out["entries"] = h["count"]
+        out["bytes"] = h["live"]
+        out["max_bytes"] = h["max_bytes"]
+        return out
+
+    def vacuum(self):
+        self.gc(lambda k: True)
+
+
+# Thumbnail cache implementations by name.
+CACHE_BACKENDS = {"sqlite": DB, "pack": PackCache}
+
+
+def open_cache(base, backend=None):
+    """
+    Opens the thumbnail cache at path `base` with the named backend. If
+    backend is None, uses the pack backend if there's a pack cache at `base`,
+    otherwise sqlite.
+    """
+    if backend is None:
+        backend = "pack" if os.path.exists(f"{base}.idx") else "sqlite"
+    return CACHE_BACKENDS[backend](base)
+
+
+class _Shape:
+    """
+    The keys of a Record in order, and a map from key to position. One shape
+    is shared by every record with the same keys.
+    """
+
+    __slots__ = ("keys", "pos")
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.pos = {k: i for i, k in enumerate(keys)}
+
+
+_SHAPES = {}  # Map from tuple of keys to _Shape.
+
+# String values that repeat across records and are worth sharing.
+_INTERNED_VALUES = frozenset(["fn", "skip", "mask_state"])
+
+
+def _shape(keys):
+    shape = _SHAPES.get(keys)
+    if shape is None:
+        keys = tuple(sys.intern(k) for k in keys)
+        shape = _SHAPES[keys] = _Shape(keys)
+    return shape
+
+
+# Ints below this (e.g. coordinates and sizes) are shared between records.
+_SHARED_INTS = 1 << 16
+_INTS = {}
+
+
+def _intern_value(k, v):
+    if type(v) is int:
+        if 256 < v < _SHARED_INTS:
+            return _INTS.setdefault(v, v)
+    elif k in _INTERNED_VALUES and type(v) is str:
+        return sys.intern(v)
+    return v
+
+
+class Record(collections.abc.MutableMapping):
+    """
+    A metadata object that behaves like a dict, but is much smaller: the keys
+    live in a _Shape shared with other records, and the values in a tuple.
+    Filenames and other repeated strings are interned, so e.g. Dataset._fns
+    shares them instead of holding copies.
+
+    Use json_dumps() to serialize, plain json.dumps() doesn't know about it.
+    """
+
+    __slots__ = ("_shape", "_values")
+
+    def __init__(self, obj=()):
+        if type(obj) is not dict:
+            obj = dict(obj)
+        self._shape = _shape(tuple(obj))
+        values = []
+        for k, v in obj.items():
+            # Inlined _intern_value(), this is the hot path when loading.
+            if type(v) is int:
+                if 256 < v < _SHARED_INTS:
+                    v = _INTS.setdefault(v, v)
+            elif k in _INTERNED_VALUES and type(v) is str:
+                v = sys.intern(v)
+            values.append(v)
+        self._values = tuple(values)
+
+    def __getitem__(self, k):
+        return self._values[self._shape.pos[k]]
+
+    def get(self, k, default=None):
+        i = self._shape.pos.get(k)
+        return default if i is None else self._values[i]
+
+    def __setitem__(self, k, v):
+        v = _intern_value(k, v)
+        i = self._shape.pos.get(k)
+        if i is None:
+            self._shape = _shape(self._shape.keys + (k,))
+            self._values += (v,)
+        else:
+            self._values = self._values[:i] + (v,) + self._values[i + 1 :]
+
+    def __delitem__(self, k):
+        i = self._shape.pos[k]
+        keys = self._shape.keys
+        self._shape = _shape(keys[:i] + keys[i + 1 :])
+        self._values = self._values[:i] + self._values[i + 1 :]
+
+    def __contains__(self, k):
+        return k in self._shape.pos
+
+    def __iter__(self):
+        return iter(self._shape.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def copy(self):
+        # The values tuple is never changed in place, so it can be shared.
+        out = Record.__new__(Record)
+        out._shape = self._shape
+        out._values = self._values
+        return out
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __reduce__(self):
+        return (Record, (dict(self),))
+
+
+def _json_default(obj):
+    if isinstance(obj, Record):
+        return dict(zip(obj._shape.keys, obj._values))
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def json_dumps(obj, **kwargs):
+    """
+    Like json.dumps(), but also serializes Records.
+    """
+    return json.dumps(obj, default=_json_default, **kwargs)
+
+
+class Snapshot:
+    """
+    Read-only columnar copy of a compacted dataset file, memory-mapped from
+    {fn}.snap so that loading doesn't parse or build a dict per record.
+
+    Integer fields are arrays, string fields are a blob plus an array of
+    offsets into it, and whatever doesn't fit a column is JSON in "extra".
+    A "present" bitmask per row records which fields the record has.
+    Rows are in file order, along with the offset and length of each line in
+    the JSON file so compact_log() can still copy lines. Other columns can be
+    stored along, e.g. Dataset's index terms.
+    """
+
+    MAGIC = b"DSSNAP1\0"
+    INT_FIELDS = [
+        "n",
+        "x",
+        "y",
+        "w",
+        "h",
+        "rot",
+        "orig_w",
+        "orig_h",
+        "fsz",
+        "manual_crop",
+        "manual_rot",
+        "manual_ts",
+        "needs_rebuild",
+    ]
+    STR_FIELDS = ["fn", "md5", "caption", "skip", "mask_fn", "mask_state"]
+    # Bit i of "present" is set if the row has FIELDS[i].
+    FIELDS = INT_FIELDS + STR_FIELDS + ["extra"]
 
-class Dataset:
     def __init__(self, fn):
-        self._data = {}  # Map from N to metadata object.
+        with open(fn, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:8] != self.MAGIC:
+            raise ValueError(f"{fn} is not a snapshot")
+        (hlen,) = struct.unpack_from("<Q", self._mm, 8)
+        self.header = json.loads(self._mm[16 : 16 + hlen])
+        start = self._align(16 + hlen)
+        self.columns = {
+            name: np.frombuffer(self._mm, dtype, count, start + offset)
+            for name, (dtype, offset, count) in self.header["columns"].items()
+        }
+        self.ns = self.columns["n"]
+        self.line_offsets = self.columns["line_offset"]
+        self.line_lengths = self.columns["line_length"]
+        self._present = self.columns["present"]
+        # Rows sorted by N, for lookups.
+        self._by_n = self.columns["by_n"]
+        self._sorted_ns = self.columns["sorted_n"]
+
+    @staticmethod
+    def _align(offset):
+        return (offset + 7) & ~7
+
+    def __len__(self):
+        return len(self.ns)
+
+    def find(self, n):
+        """
+        Returns the row for N, or -1.
+        """
+        i = int(np.searchsorted(self._sorted_ns, n))
+        if i < len(self._sorted_ns) and self._sorted_ns[i] == n:
+            return int(self._by_n[i])
+        return -1
+
+    def record(self, row):
+        """
+        Returns the metadata object in the given row.
+        """
+        return self.records([row])[0]
+
+    def records(self, rows):
+        """
+        Returns a list of metadata objects for the given rows, decoding a
+        column at a time.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        present = self._present[rows]
+        out = [{} for _ in range(len(rows))]
+        for i, field in enumerate(self.FIELDS):
+            has = np.flatnonzero(present & (1 << i))
+            if not len(has):
+                continue
+            which = rows[has]
+            objs = [out[j] for j in has.tolist()]
+            if field in self.INT_FIELDS:
+                for obj, v in zip(objs, self.columns[field][which].tolist()):
+                    obj[field] = v
+                continue
+            offsets = self.columns[f"{field}.offsets"]
+            starts = offsets[which].tolist()
+            ends = offsets[which + 1].tolist()
+            # One copy of the span of the blob that's needed, then slices.
+            lo, hi = min(starts), max(ends)
+            data = self.columns[f"{field}.data"][lo:hi].tobytes()
+            values = [data[a - lo : b - lo].decode() for a, b in zip(starts, ends)]
+            if field == "extra":
+                for obj, v in zip(objs, values):
+                    obj.update(json.loads(v))
+            else:
+                for obj, v in zip(objs, values):
+                    obj[field] = v
+        return out
+
+    @classmethod
+    def write(cls, fn, items, line_offsets, jsonl, other=None):
+        """
+        Writes a snapshot of `items` (N, object) to `fn`. `line_offsets` maps N
+        to the (offset, length) of its line in the JSON file, and `jsonl` is
+        (size, mtime_ns, sig) of the JSON file, to check the snapshot against.
+        `other` maps more column names to arrays to store as is.
+        """
+        items = list(items)
+        rows = len(items)
+        bits = {field: 1 << i for i, field in enumerate(cls.FIELDS)}
+        ints = {field: np.zeros(rows, np.int64) for field in cls.INT_FIELDS}
+        strs = {field: [b""] * rows for field in cls.STR_FIELDS + ["extra"]}
+        present = np.zeros(rows, np.uint32)
+        for row, (n, obj) in enumerate(items):
+            mask = 0
+            extra = {}
+            for k, v in obj.items():
+                if k in ints and type(v) is int and -(1 << 63) <= v < 1 << 63:
+                    ints[k][row] = v
+                elif k in strs and k != "extra" and type(v) is str:
+                    strs[k][row] = v.encode()
+                else:
+                    extra[k] = v
+                    continue
+                mask |= bits[k]
+            if extra:
+                strs["extra"][row] = json.dumps(extra).encode()
+                mask |= bits["extra"]
+            present[row] = mask
+        assert (present & bits["n"]).all(), "every record needs an int n"
+
+        ns = ints["n"]
+        by_n = np.argsort(ns, kind="stable")
+        cols = dict(ints)
+        cols["present"] = present
+        cols["by_n"] = by_n.astype(np.int64)
+        cols["sorted_n"] = ns[by_n]
+        cols["line_offset"] = np.array(
+            [line_offsets[n][0] for n, _ in items], dtype=np.int64
+        )
+        cols["line_length"] = np.array(
+            [line_offsets[n][1] for n, _ in items], dtype=np.int64
+        )
+        for field, values in strs.items():
+            lengths = np.fromiter(map(len, values), np.int64, rows)
+            cols[f"{field}.offsets"] = np.concatenate([[0], np.cumsum(lengths)])
+            cols[f"{field}.data"] = np.frombuffer(b"".join(values), np.uint8)
+        cols.update(other or {})
+
+        columns = {}
+        offset = 0
+        for name, arr in cols.items():
+            columns[name] = (arr.dtype.str, offset, len(arr))
+            offset = cls._align(offset + arr.nbytes)
+        size, mtime, sig = jsonl
+        header = json.dumps(
+            {
+                "rows": rows,
+                "jsonl": [size, mtime, sig.hex()],
+                "columns": columns,
+            }
+        ).encode()
+        with atomic_write(fn) as f:
+            f.write(cls.MAGIC + struct.pack("<Q", len(header)) + header)
+            start = cls._align(f.tell())
+            for name, arr in cols.items():
+                f.write(bytes(start + columns[name][1] - f.tell()))
+                f.write(arr.tobytes())
+
+
+class Records(collections.abc.MutableMapping):
+    """
+    Map from N to metadata object, where objects can be added unparsed and are
+    parsed on first access by calling parse(list of Ns) -> {N: object}.
+    Iterating over values or items parses everything that's left in one go.
+
+    Objects are stored as Records, dicts are converted when they're added.
+
+    Records can also come from a Snapshot `base`, with the in-memory objects
+    overlaid on top. Base rows are materialized on first access, and iterate
+    in snapshot order, before the Ns that aren't in the snapshot.
+    """
+
+    def __init__(self, parse, items=None):
+        # Map from N to Record, or None if not parsed yet.
+        self._items = {}
+        if items is not None:
+            self._items = {n: self._record(obj) for n, obj in items.items()}
+        self._parse = parse
+        self._base = None  # Snapshot, or None.
+        self._deleted = set()  # Ns in _base that were deleted.
+        self._num_new = 0  # Number of Ns in _items that aren't in _base.
+
+    @staticmethod
+    def _record(obj):
+        return obj if obj is None or type(obj) is Record else Record(obj)
+
+    def set_base(self, base):
+        assert not self._items
+        self._base = base
+
+    def _base_row(self, n):
+        return -1 if self._base is None else self._base.find(n)
+
+    def add_unparsed(self, n):
+        self[n] = None
+
+    def _parse_all(self):
+        todo = [n for n, obj in self._items.items() if obj is None]
+        if todo:
+            for n, obj in self._parse(todo).items():
+                self._items[n] = Record(obj)
+        if self._base is not None:
+            todo = [
+                row
+                for row, n in enumerate(self._base.ns.tolist())
+                if n not in self._items and n not in self._deleted
+            ]
+            for obj in self._base.records(todo):
+                self._items[obj["n"]] = Record(obj)
+
+    def __getitem__(self, n):
+        obj = self._items.get(n)
+        if obj is None:
+            if n in self._items:
+                obj = self._parse([n])[n]
+            else:
+                row = self._base_row(n)
+                if row < 0 or n in self._deleted:
+                    raise KeyError(n)
+                obj = self._base.record(row)
+            obj = self._items[n] = Record(obj)
+        return obj
+
+    def __setitem__(self, n, obj):
+        obj = self._record(obj)
+        if n not in self._items:
+            if self._base_row(n) >= 0:
+                self._deleted.discard(n)
+            else:
+                self._num_new += 1
+        self._items[n] = obj
+
+    def __delitem__(self, n):
+        if self._base_row(n) < 0:
+            del self._items[n]
+            self._num_new -= 1
+        elif n in self._deleted:
+            raise KeyError(n)
+        else:
+            self._items.pop(n, None)
+            self._deleted.add(n)
+
+    def __contains__(self, n):
+        if n in self._items:
+            return True
+        return self._base_row(n) >= 0 and n not in self._deleted
+
+    def __iter__(self):
+        if self._base is None:
+            yield from self._items
+            return
+        for n in self._base.ns.tolist():
+            if n not in self._deleted:
+                yield n
+        new = [n for n in self._items if self._base_row(n) < 0]
+        yield from new
+
+    def __len__(self):
+        if self._base is None:
+            return len(self._items)
+        return len(self._base) - len(self._deleted) + self._num_new
+
+    def keys(self):
+        if self._base is None:
+            return self._items.keys()
+        return super().keys()
+
+    def values(self):
+        self._parse_all()
+        if self._base is None:
+            return self._items.values()
+        return [self._items[n] for n in self]
+
+    def items(self):
+        self._parse_all()
+        if self._base is None:
+            return self._items.items()
+        return [(n, self._items[n]) for n in self]
+
+
+class Dataset:
+    """
+    A dataset JSON file, plus its thumbnail cache.
+
+    By default the cache lives next to the dataset in {fn}.cache. If cache_dir
+    is given, the cache in that directory is used instead: it can be shared by
+    any number of datasets (and processes) since keys only depend on the
+    content being rendered.
+
+    cache_backend picks the cache implementation, see open_cache(). With
+    with_cache=False there's no cache, only the records.
+
+    The file is a log: updates are appended, and the last line for each N wins.
+    compact() and compact_log() rewrite it without the superseded lines.
+
+    Several processes can work on the same dataset at once: appends and
+    rewrites hold a lock on {fn}.lock, each append first picks up what other
+    processes appended, and refresh() picks up their changes on demand.
+    """
+
+    # Filename of the shared cache within cache_dir.
+    SHARED_CACHE = "thumbnails.cache"
+
+    # update() compacts in the background once there are this many superseded
+    # lines, and they're at least this fraction of the number of records.
+    COMPACT_MIN_LINES = 1000
+    COMPACT_RATIO = 0.5
+
+    # select() can match records on these values...
+    INDEXED_VALUES = ["md5", "mask_state"]
+    # ...and on whether these keys are present.
+    INDEXED_KEYS = [
+        "skip",
+        "caption",
+        "manual_crop",
+        "manual_rot",
+        "mask_fn",
+        "autocaption",
+        "auto_blip1",
+        "auto_blip2",
+        "auto_coca",
+        "dhash",
+        "dupe_of",
+    ]
+
+    def __init__(self, fn, cache_dir=None, cache_backend=None, with_cache=True):
         self._fn = fn
         # Full path to fn's parent dir.
         self._dir = os.path.dirname(os.path.abspath(fn))
         # Relative (to _dir) path to the mask dir.
         self._maskdir = os.path.basename(os.path.abspath(fn)) + ".masks"
-        self._fns = set()  # Set of original filenames.
+        # Lock file held while appending to or replacing the file, shared while
+        # reading it.
+        self._lockfn = f"{fn}.lock"
+        # Held while appending to or replacing the file within this process.
+        self._append_lock = threading.Lock()
+        self._compactor = None  # Background compaction thread.
+        self._tail = None  # (n, offset, length) appended during compaction.
+        self._generation = 0  # Incremented when the file is reloaded.
+        self._reset()
         if os.path.exists(fn):
-            self._load(fn)
-        self._cache = DB(f"{fn}.cache")
+            with flock(self._lockfn, exclusive=False):
+                self._load(open(fn, "rb"))
+        self._cache = None
+        if with_cache:
+            self._open_cache(f"{fn}.cache", cache_dir, cache_backend)
+
+    def _open_cache(self, base, cache_dir, cache_backend):
+        """
+        Opens the cache at `base`, or the shared one in cache_dir if given.
+        """
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            base = f"{cache_dir}/{self.SHARED_CACHE}"
+        self._cache = open_cache(base, cache_backend)
+        self._mask_md5s = {}  # Map from mask path to ((mtime, size), md5).
+
+    def flush(self):
+        """
+        Commit pending cache writes.
+        """
+        if self._cache is not None:
+            self._cache.flush()
+
+    def __enter__(self):
+        return self
+
+    def close(self):
+        """
+        Commits pending cache writes and closes the file. Records that weren't
+        parsed yet can't be read afterwards.
+        """
+        self.flush()
+        self.wait_for_compaction()
+        with self._append_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _reset(self):
+        """
+        Forget everything loaded from the file.
+        """
+        self._data = Records(self._parse)  # Map from N to metadata object.
+        self._fns = None  # Set of original filenames, built on first use.
+        # Index terms (see _index_terms()) of the records as of the last index
+        # or snapshot, as columns (see _make_terms()) so they're loaded without
+        # parsing. None if they're not known.
+        self._terms = self._make_terms([], [])
+        # Map from N to its terms when it was last indexed, for records added or
+        # updated since _terms, since records are often changed in place before
+        # being updated.
+        self._indexed = {}
+        # Map from index term to the set of Ns that have it, each built from
+        # _terms and _indexed on first use by select().
+        self._index = {}
+        self._next_n = 0  # One past the highest N seen.
+        # Map from N to (byte offset, length) of its last line in the file.
+        self._offsets = {}
+        self._lines = 0  # Number of lines in the file.
+        # True while the line offsets of records in the snapshot (see
+        # Records) are only in the snapshot, rather than in _offsets.
+        self._base_lines = False
+        # The file as loaded. Stays open so lazy parsing keeps working even if
+        # another process replaces the file, until the next refresh().
+        self._file = None
+        self._size = 0  # Number of bytes of _file that are loaded.
+        self._mtime = None  # mtime of _file if it was _size bytes, else None.
+
+    def _load(self, f):
+        """
+        Load dataset from the open file `f`.
+
+        If the snapshot {fn}.snap (see write_snapshot()) or else the index
+        sidecar {fn}.idx matches the start of the file, records it covers are
+        loaded lazily, on first access. Only lines appended since are parsed
+        now, then the index is brought up to date.
+        """
+        self._file = f
+        self._size = self._load_snapshot(f) or self._load_index(f)
+        if self._read_tail():
+            self._save_index()
+
+    def _read_tail(self):
+        """
+        Parses the complete lines appended to _file past _size. Returns the
+        number of lines read.
+        """
+        fd = self._file.fileno()
+        st = os.fstat(fd)
+        data = os.pread(fd, st.st_size - self._size, self._size)
+        # Leave out a partial line that's still being written.
+        lines = data[: data.rfind(b"\n") + 1].splitlines(keepends=True)
+        offset = self._size
+        offsets = []
+        for line in lines:
+            obj = json.loads(line)
+            self._memadd(obj)
+            offsets.append((obj["n"], offset, len(line)))
+            offset += len(line)
+        with self._append_lock:
+            for n, start, length in offsets:
+                self._offsets[n] = (start, length)
+                if self._tail is not None:
+                    self._tail.append((n, start, length))
+            self._lines += len(lines)
+            self._size = offset
+            self._mtime = st.st_mtime_ns if offset == st.st_size else None
+        return len(lines)
+
+    def refresh(self):
+        """
+        Picks up changes other processes made to the file: parses the lines
+        they appended, or reloads everything if they rewrote it (e.g. when
+        compacting). This only costs a stat() when nothing changed.
+        Returns True if anything did.
+        """
+        with flock(self._lockfn, exclusive=False):
+            return self._refresh()
+
+    def _refresh(self):
+        """
+        refresh(), for callers that hold the lock.
+        """
+        try:
+            st = os.stat(self._fn)
+        except FileNotFoundError:
+            return False
+        if self._file is not None:
+            if st.st_ino == os.fstat(self._file.fileno()).st_ino:
+                if st.st_size > self._size:
+                    return self._read_tail() > 0
+                if (st.st_size, st.st_mtime_ns) == (self._size, self._mtime):
+                    return False
+        # Replaced, truncated or rewritten in place: start over.
+        with self._append_lock:
+            self._generation += 1
+            if self._file is not None:
+                self._file.close()
+            self._reset()
+        self._load(open(self._fn, "rb"))
+        return True
+
+    def _index_sig(self, f, size):
+        """
+        Returns a signature of the first `size` bytes of the file: its last few
+        KB, which change if the file is rewritten rather than appended to.
+        """
+        start = max(0, size - 4096)
+        return hashlib.md5(os.pread(f.fileno(), size - start, start)).digest()
+
+    def _covers(self, f, size, mtime, sig):
+        """
+        Returns True if an index or snapshot of the file when it was `size`
+        bytes long, with that mtime and _index_sig(), is valid for `f`.
+        """
+        st = os.fstat(f.fileno())
+        if size > st.st_size:
+            return False
+        if (size, mtime) == (st.st_size, st.st_mtime_ns):
+            return True
+        return self._index_sig(f, size) == sig
+
+    def _load_snapshot(self, f):
+        """
+        Use {fn}.snap as the base of _data if it's valid for the open file
+        `f`. Returns the offset up to which it's valid.
+        """
+        try:
+            snap = Snapshot(f"{self._fn}.snap")
+            size, mtime, sig = snap.header["jsonl"]
+        except (OSError, KeyError, ValueError):
+            return 0
+        if not self._covers(f, size, mtime, bytes.fromhex(sig)):
+            return 0
+        self._data.set_base(snap)
+        self._terms = self._load_terms(snap.columns)
+        self._base_lines = True
+        self._next_n = int(snap.ns.max()) + 1 if len(snap) else 0
+        self._lines = len(snap)
+        return size
+
+    def _load_index(self, f):
+        """
+        Populate _offsets and the unparsed records from {fn}.idx if it's valid
+        for the open file `f`. Returns the offset up to which it's valid.
+        """
+        try:
+            idx = np.load(f"{self._fn}.idx")
+            size, mtime, lines = idx["meta"].tolist()
+            sig = idx["sig"].tobytes()
+            ns, offsets, lengths = idx["n"], idx["offset"], idx["length"]
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return 0
+        if not self._covers(f, size, mtime, sig):
+            return 0
+        self._offsets = dict(zip(ns.tolist(), zip(offsets.tolist(), lengths.tolist())))
+        for n in self._offsets:
+            self._data.add_unparsed(n)
+        self._terms = self._load_terms(idx)
+        self._next_n = int(ns.max()) + 1 if len(ns) else 0
+        self._lines = lines
+        return size
+
+    def _save_index(self):
+        """
+        Write {fn}.idx: the offset and length of the last line for each N, and
+        the index terms if they're known. Not needed while the snapshot has
+        the offsets.
+        """
+        if self._base_lines or self._file is None:
+            return
+        with self._append_lock:
+            try:
+                if os.stat(self._fn).st_ino != os.fstat(self._file.fileno()).st_ino:
+                    return  # Replaced by another process, refresh() reloads.
+            except FileNotFoundError:
+                return
+            sig = self._index_sig(self._file, self._size)
+            ns = list(self._offsets.keys())
+            offsets, lengths = zip(*self._offsets.values()) if ns else ((), ())
+            meta = [self._size, self._mtime or 0, self._lines]
+            terms = self._saved_terms()
+            with atomic_write(f"{self._fn}.idx") as f:
+                np.savez(
+                    f,
+                    meta=np.array(meta),
+                    sig=np.frombuffer(sig, dtype=np.uint8),
+                    n=np.array(ns, dtype=np.int64),
+                    offset=np.array(offsets, dtype=np.int64),
+                    length=np.array(lengths, dtype=np.int64),
+                    **terms,
+                )
+
+    def _parse(self, ns):
+        """
+        Returns a dict from N to the object parsed from its last line in the
+        file, for the given list of Ns.
+        """
+        out = {}
+        with self._append_lock:
+            fd = self._file.fileno()
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+                for n in ns:
+                    offset, length = self._offsets[n]
+                    out[n] = json.loads(mm[offset : offset + length])
+        return out
+
+    def next_n(self):
+        """
+        Returns the next N.
+        """
+        return self._next_n
+
+    def _memadd(self, obj):
+        """
+        Adds the specified object into the in-memory data, without updating the file
+        on disk. Dicts are stored as a Record copy.
+        """
+        n = obj["n"]
+        assert type(n) is int, n
+        self._data[n] = obj
+        obj = self._data[n]  # The stored Record.
+        if self._fns is not None:
+            self._fns.add(obj["fn"])
+        if self._terms is not None:
+            self._reindex(n, obj)
+        if n >= self._next_n:
+            self._next_n = n + 1
+
+    def _index_terms(self, obj):
+        """
+        Returns the tuple of index terms for metadata object `obj`.
+        """
+        terms = [(k, obj.get(k)) for k in self.INDEXED_VALUES]
+        terms += [(k, k in obj) for k in self.INDEXED_KEYS]
+        return tuple(terms)
+
+    def _make_terms(self, ns, terms):
+        """
+        Returns columns of the index terms for a list of Ns and their terms,
+        sorted by N: "n", "keys" with bit i set if INDEXED_KEYS[i] is present,
+        and the JSON of the value of each of INDEXED_VALUES.
+        """
+        nv = len(self.INDEXED_VALUES)
+        ns = np.array(ns, dtype=np.int64)
+        order = np.argsort(ns, kind="stable")
+        keys = [sum(has << i for i, (_, has) in enumerate(t[nv:])) for t in terms]
+        cols = {"n": ns[order], "keys": np.array(keys, dtype=np.uint32)[order]}
+        for i, k in enumerate(self.INDEXED_VALUES):
+            values = [json_dumps(t[i][1]).encode() for t in terms]
+            cols[k] = np.array(values, dtype=bytes)[order]
+        return cols
+
+    def _terms_sig(self):
+        return json.dumps([self.INDEXED_VALUES, self.INDEXED_KEYS]).encode()
+
+    def _load_terms(self, arrays):
+        """
+        Returns the index term columns saved by _saved_terms() in `arrays`, or
+        None if they weren't saved for the current INDEXED_VALUES/INDEXED_KEYS.
+        """
+        try:
+            if arrays["terms.sig"].tobytes() != self._terms_sig():
+                return None
+            names = ["n", "keys"] + self.INDEXED_VALUES
+            return {k: np.asarray(arrays[f"terms.{k}"]) for k in names}
+        except KeyError:
+            return None
+
+    def _saved_terms(self):
+        """
+        Returns a dict of arrays with the index terms of all records, to store
+        in {fn}.idx or the snapshot, or an empty dict if they're not known.
+        """
+        cols = self._terms
+        indexed = dict(self._indexed)
+        if cols is None:
+            return {}
+        if indexed:
+            new = self._make_terms(list(indexed), list(indexed.values()))
+            keep = ~np.isin(cols["n"], new["n"])
+            cols = {k: np.concatenate([v[keep], new[k]]) for k, v in cols.items()}
+            order = np.argsort(cols["n"], kind="stable")
+            cols = {k: v[order] for k, v in cols.items()}
+        out = {f"terms.{k}": v for k, v in cols.items()}
+        out["terms.sig"] = np.frombuffer(self._terms_sig(), dtype=np.uint8)
+        return out
+
+    def _column_terms(self, n):
+        """
+        Returns N's tuple of index terms from _terms, or () if it's not there.
+        """
+        ns = self._terms["n"]
+        i = int(np.searchsorted(ns, n))
+        if i == len(ns) or ns[i] != n:
+            return ()
+        keys = int(self._terms["keys"][i])
+        terms = [(k, json.loads(self._terms[k][i])) for k in self.INDEXED_VALUES]
+        terms += [(k, bool(keys >> i & 1)) for i, k in enumerate(self.INDEXED_KEYS)]
+        return tuple(terms)
+
+    def _reindex(self, n, obj):
+        old = self._indexed.get(n)
+        if old is None:
+            old = self._column_terms(n)
+        new = self._index_terms(obj)
+        if old == new:
+            return
+        for term in old:
+            if term in self._index:
+                self._index[term].discard(n)
+        for term in new:
+            if term in self._index:
+                self._index[term].add(n)
+        self._indexed[n] = new
+
+    def _build_terms(self):
+        """
+        Builds _terms by parsing every record, when they weren't saved.
+        """
+        items = list(self._data.items())
+        terms = [self._index_terms(obj) for _, obj in items]
+        self._terms = self._make_terms([n for n, _ in items], terms)
+        self._indexed = {}
+        self._index = {}
+        self._save_index()
+
+    def _term_set(self, term):
+        """
+        Returns the set of Ns that have index term `term`.
+        """
+        if self._terms is None:
+            self._build_terms()
+        out = self._index.get(term)
+        if out is not None:
+            return out
+        k, v = term
+        cols = self._terms
+        if k in self.INDEXED_KEYS:
+            bit = 1 << self.INDEXED_KEYS.index(k)
+            match = (cols["keys"] & bit != 0) == v
+        else:
+            match = cols[k] == json_dumps(v).encode()
+        out = set(cols["n"][match].tolist())
+        for n, terms in self._indexed.items():
+            if term in terms:
+                out.add(n)
+            else:
+                out.discard(n)
+        indexed = np.fromiter(self._indexed, np.int64, len(self._indexed))
+        known = len(cols["n"]) + int((~np.isin(indexed, cols["n"])).sum())
+        if known != len(self._data):
+            out = {n for n in out if n in self._data}  # Some were deleted.
+        self._index[term] = out
+        return out
+
+    def _select(self, conds):
+        if not conds:
+            return set(self._data.keys())
+        sets = []
+        for k, v in conds.items():
+            if k in self.INDEXED_KEYS:
+                v = bool(v)
+            elif k not in self.INDEXED_VALUES:
+                raise ValueError(f"{k!r} is not indexed")
+            sets.append(self._term_set((k, v)))
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def select(self, **conds):
+        """
+        Returns the sorted list of Ns of records that match all of `conds`,
+        e.g. select(mask_state="prep") or select(skip=False, auto_coca=False).
+        INDEXED_VALUES match by value (None for absent), INDEXED_KEYS match by
+        whether the key is present. This takes time proportional to the
+        smallest matching set rather than to the size of the dataset.
+        """
+        return sorted(self._select(conds))
+
+    def count(self, **conds):
+        """
+        Returns the number of records that select(**conds) would return.
+        """
+        return len(self._select(conds))
+
+    def seen_fn(self, fn):
+        if self._fns is None:
+            self._fns = {obj["fn"] for obj in self._data.values()}
+        return fn in self._fns
+
+    def add(self, obj):
+        self.add_many([obj])
+
+    def add_many(self, objs, keys=None):
+        """
+        Adds (or updates) a list of objects, assigning N to those that don't have
+        one, and appends them to the file in one write.
+
+        With `keys`, only those keys are copied from each object onto the latest
+        version of its record, which another process may have changed since.
+        Objects whose record was removed meanwhile are skipped. Use this for
+        long running jobs that only fill in their own keys.
+        """
+        if not objs:
+            return
+        with flock(self._lockfn):
+            # Appends from other processes come first, and so does their N.
+            self._refresh()
+            if keys is not None:
+                objs = [self._merge(obj, keys) for obj in objs]
+                # Records removed meanwhile stay removed.
+                objs = [obj for obj in objs if obj is not None]
+            for obj in objs:
+                if "n" not in obj:
+                    obj["n"] = self.next_n()
+                self._memadd(obj)
+            lines = [(json_dumps(obj) + "\n").encode() for obj in objs]
+            with self._append_lock:
+                with open(self._fn, "ab") as f:
+                    offset = f.tell()
+                    f.write(b"".join(lines))
+                    # Flush first, so the size and mtime are the ones after
+                    # this write and refresh() knows it has nothing to read.
+                    f.flush()
+                    st = os.fstat(f.fileno())
+                for obj, line in zip(objs, lines):
+                    self._offsets[obj["n"]] = (offset, len(line))
+                    if self._tail is not None:
+                        self._tail.append((obj["n"], offset, len(line)))
+                    offset += len(line)
+                self._lines += len(lines)
+                if self._file is None:
+                    self._file = open(self._fn, "rb")
+                self._size = offset
+                self._mtime = st.st_mtime_ns if offset == st.st_size else None
+
+    def _merge(self, obj, keys):
+        """
+        Returns the latest version of obj's record with `keys` set like in obj,
+        or None if the record no longer exists.
+        """
+        latest = self._data.get(obj["n"])
+        if latest is None:
+            return None
+        for k in keys:
+            if k in obj:
+                latest[k] = obj[k]
+            elif k in latest:
+                del latest[k]
+        return latest
+
+    def update(self, obj, append):
+        """
+        Appends the updated obj to the file. Unless in append only mode, once
+        enough superseded lines pile up, the file is compacted in a background
+        thread.
+        """
+        self.add(obj)
+        if not append and self.needs_compact():
+            self.compact_in_background()
+
+    def stale_lines(self):
+        """
+        Returns the number of superseded lines in the file.
+        """
+        return self._lines - len(self._data)
+
+    def needs_compact(self):
+        stale = self.stale_lines()
+        return stale >= max(
+            self.COMPACT_MIN_LINES, self.COMPACT_RATIO * len(self._data)
+        )
+
+    def compact(self):
+        """
+        Rewrites the file from the in-memory data. Use this after changing
+        _data directly, e.g. removing or renumbering records.
+
+        Changes that other processes appended are picked up first. If another
+        process rewrote the file meanwhile, everything is reloaded from it
+        instead, dropping direct changes to _data.
+        """
+        self.wait_for_compaction()
+        with flock(self._lockfn):
+            self._refresh()
+            # Callers may have renumbered or removed records, or replaced _data,
+            # so key by each record's own N.
+            items = [(obj["n"], obj) for obj in self._data.values()]
+            self._data = Records(self._parse, dict(items))
+            terms = [self._index_terms(obj) for _, obj in items]
+            self._terms = self._make_terms([n for n, _ in items], terms)
+            self._indexed = {}
+            self._index = {}
+            self._next_n = max([-1] + [n for n, _ in items]) + 1
+            offsets = {}
+            with self._append_lock:
+                with atomic_write(self._fn) as f:
+                    for n, obj in items:
+                        line = (json_dumps(obj) + "\n").encode()
+                        offsets[n] = (f.tell(), len(line))
+                        f.write(line)
+                    size = f.tell()
+                self._offsets = offsets
+                self._lines = len(offsets)
+                self._base_lines = False
+                old, self._file = self._file, open(self._fn, "rb")
+                if old is not None:
+                    old.close()
+                self._size = size
+                self._mtime = os.fstat(self._file.fileno()).st_mtime_ns
+            self._save_index()
 
-    def _load(self, fn):
+    def write_snapshot(self):
         """
-        Load dataset from the given filename.
+        Compacts the file, then writes {fn}.snap: a columnar copy of it that
+        later loads memory-map instead of parsing, see Snapshot.
         """
-        with open(fn, "r") as f:
-            for line in f.readlines():
-                self._memadd(json.loads(line))
+        self.compact()
+        with self._append_lock:
+            sig = self._index_sig(self._file, self._size)
+            Snapshot.write(
+                f"{self._fn}.snap",
+                self._data.items(),
+                self._offsets,
+                (self._size, self._mtime or 0, sig),
+                self._saved_terms(),
+            )
 
-    def next_n(self):
+    def _all_offsets(self):
         """
-        Returns the next N.
+        Returns a list of (N, (offset, length)) of the last line for each N
+        still in _data, including the ones only the snapshot knows about.
         """
-        return max([-1] + list(self._data.keys())) + 1
+        if not self._base_lines:
+            return [(n, v) for n, v in self._offsets.items() if n in self._data]
+        base = self._data._base
+        deleted = self._data._deleted
+        out = []
+        for n, offset, length in zip(
+            base.ns.tolist(), base.line_offsets.tolist(), base.line_lengths.tolist()
+        ):
+            if n not in deleted:
+                out.append((n, self._offsets.get(n, (offset, length))))
+        out += [(n, v) for n, v in self._offsets.items() if base.find(n) < 0]
+        return out
 
-    def _memadd(self, obj):
+    def compact_in_background(self):
         """
-        Adds the specified object into the in-memory data, without updating the file
-        on disk.
+        Starts compact_log() in a thread, unless one is already running.
         """
-        n = obj["n"]
-        assert type(n) is int, n
-        self._data[n] = obj
-        self._fns.add(obj["fn"])
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._compactor = threading.Thread(target=self.compact_log)
+        self._compactor.start()
 
-    def seen_fn(self, fn):
-        return fn in self._fns
+    def wait_for_compaction(self):
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
 
-    def add(self, obj):
-        if "n" not in obj:
-            obj["n"] = self.next_n()
-        self._memadd(obj)
-        with open(self._fn, "a") as f:
-            json.dump(obj, f)
-            f.write("\n")
+    def compact_log(self):
+        """
+        Rewrites the file keeping only the last line for each N, like compact().
+        This works from the file rather than from the in-memory data, copying
+        lines without parsing them, so it's safe to run in a thread while
+        records are being updated and appended. The rewrite is atomic: a crash
+        leaves either the old or the new file.
 
-    def update(self, obj, append):
-        if append:
-            # Append only mode: don't rewrite the whole file.
-            self.add(obj)
+        Lines other processes appended meanwhile are kept. If another process
+        rewrote the file meanwhile, this gives up.
+        """
+        with self._append_lock:
+            offsets = self._all_offsets()
+            f = self._file
+            size = self._size
+            generation = self._generation
+            self._tail = []
+        if f is None:
             return
-        self._memadd(obj)
-        self.compact()
-
-    def compact(self):
-        with open(self._fn, "w") as f:
-            for obj in self._data.values():
-                json.dump(obj, f)
-                f.write("\n")
+        fd = f.fileno()
+        tmp = tmp_name(self._fn)
+        try:
+            new_offsets = {}
+            with open(tmp, "wb") as out:
+                for n, (offset, length) in offsets:
+                    new_offsets[n] = (out.tell(), length)
+                    out.write(os.pread(fd, length, offset))
+                # Copy what was appended meanwhile, blocking appends by any
+                # process until the new file is in place.
+                with flock(self._lockfn), self._append_lock:
+                    if generation != self._generation:
+                        return
+                    if os.stat(self._fn).st_ino != os.fstat(fd).st_ino:
+                        return  # Rewritten by another process.
+                    start = out.tell()
+                    pos, end = size, os.fstat(fd).st_size
+                    while pos < end:
+                        chunk = os.pread(fd, min(1 << 20, end - pos), pos)
+                        if not chunk:
+                            break
+                        out.write(chunk)
+                        pos += len(chunk)
+                    out.flush()
+                    os.fsync(out.fileno())
+                    os.replace(tmp, self._fn)
+                    for n, offset, length in self._tail:
+                        new_offsets[n] = (offset - size + start, length)
+                    self._offsets = new_offsets
+                    self._base_lines = False
+                    self._lines = len(offsets) + len(self._tail)
+                    self._tail = None
+                    # Lines past _size that weren't parsed yet are copied too,
+                    # the next refresh() picks them up from the new file.
+                    self._file = open(self._fn, "rb")
+                    f.close()
+                    self._size += start - size
+                    st = os.fstat(self._file.fileno())
+                    self._mtime = st.st_mtime_ns if st.st_size == self._size else None
+        finally:
+            self._tail = None
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        self._save_index()
 
     def prep_mask(self, n, append, force=False):
         """
         Creates {fn}.masks/{n}_{md5}.prep.mask.png
         """
+        maskfn = self.prep_mask_fn(n, force)
+        render_prep_mask(self._data[n], self._dir, maskfn)
+        self.set_prep_mask(n, maskfn, append)
+
+    def prep_mask_fn(self, n, force=False):
+        """
+        First step of prep_mask: returns the mask filename to render to, see
+        render_prep_mask. Then call set_prep_mask.
+        """
         obj = self._data[n]
         if not force:
             assert "mask_fn" not in obj
         os.makedirs(f"{self._dir}/{self._maskdir}", exist_ok=True)
-        maskfn = f'{self._maskdir}/{obj["n"]}_{obj["md5"]}.prep.mask.png'
-        img = load_image(obj["fn"], dsdir=self._dir).convert("RGB")
-        img = np.asarray(img).copy()  # copy to make it not readonly
-        rgb = np.asarray([255, 0, 255])
-        precision = 255 - (1 + 2 + 4 + 8)  # bitmask
-        # Darken full purple if it's present in the image.
-        cond = (img & precision) == (rgb & precision)
-        cond = cond.all(axis=2)
-        img[cond] = [200, 0, 200]
-        fn = f"{self._dir}/{maskfn}"
-        Image.fromarray(img).save(fn)
-        print(f'saved {fn}')
+        return f'{self._maskdir}/{obj["n"]}_{obj["md5"]}.prep.mask.png'
+
+    def set_prep_mask(self, n, maskfn, append):
+        obj = self._data[n]
         obj["mask_fn"] = maskfn
         obj["mask_state"] = "prep"
         self.update(obj, append)
 
-    def cropped_jpg(self, n, sz):
+    def gc_cache(self):
+        """
+        Drops cache entries whose md5/crop/rot don't match any current record.
+        Returns the number of entries dropped.
+        """
+        return gc_cache(self._cache, self.live_crop_ids())
+
+    def live_crop_ids(self):
+        """
+        Returns the set of crop_id() of all records.
+        """
+        return {crop_id(o) for o in self._data.values()}
+
+    def cache_stats(self):
+        out = self._cache.stats()
+        out["decoded"] = image_cache.stats()
+        return out
+
+    def cropped_jpg(self, n, sz, view=False):
         """
         Returns JPEG image data for object n, cropped and scaled and rotated.
-        Populates the cache.
+        Populates the cache. With view=True, may return a memoryview into the
+        cache instead of bytes.
         """
         o = self._data[n]
-        key = {
-            "md5": o["md5"],
-            "x": o["x"],
-            "y": o["y"],
-            "w": o["w"],
-            "h": o["h"],
-            "sz": sz,
-            "rot": o.get("rot", 0),
-        }
-        key = json.dumps(key, sort_keys=True)
+        key = cache_key(o, sz)
         try:
-            return self._cache[key]
+            return self._cache.view(key) if view else self._cache[key]
         except KeyError:
-            img = load_and_transform(o, sz, sz, dsdir=self._dir)
-            img = img.convert("RGB")  # Drop alpha.
-            s = io.BytesIO()
-            img.save(s, format="jpeg", quality=95)
-            img = s.getvalue()
+            img = render_jpg(o, sz, self._dir)
             self._cache[key] = img
             return img
 
-    def cropped_mask(self, n, sz):
+    def cropped_mask(self, n, sz, view=False):
         """
         Returns PNG image data for the mask for object n, cropped and scaled
-        and rotated. Populates the cache.
+        and rotated. Populates the cache. See cropped_jpg for `view`.
         """
-        o = self._data[n].copy()
-        key = {
-            "md5": o["md5"],
-            "x": o["x"],
-            "y": o["y"],
-            "w": o["w"],
-            "h": o["h"],
-            "sz": sz,
-            "rot": o.get("rot", 0),
-            "mask": 1,
-        }
-        key = json.dumps(key, sort_keys=True)
+        o = self._data[n]
+        key = cache_key(o, sz, mask=True, mask_md5=self._mask_md5(o))
         try:
-            return self._cache[key]
+            return self._cache.view(key) if view else self._cache[key]
         except KeyError:
-            img = load_and_transform(o, sz, sz, dsdir=self._dir)
-            r, g, b, a = img.split()
-            del img
-
-            # Apply a custom mask if present.
-            if o.get("mask_state", "") == "done":
-                om = o.copy()
-                om["fn"] = o["mask_fn"]
-                mask = load_and_transform(om, sz, sz, dsdir=self._dir)
-                mask = mask.convert("L")
-                a = ImageChops.multiply(a, mask)
-
-            s = io.BytesIO()
-            a.save(s, format="png")
-            img = s.getvalue()
+            img = render_mask(o, sz, self._dir)
             self._cache[key] = img
             return img
 
+    def cache_keys(self, n, sz):
+        """
+        Returns the cache keys used by cropped_jpg and cropped_mask for object n.
+        """
+        o = self._data[n]
+        return (
+            cache_key(o, sz),
+            cache_key(o, sz, mask=True, mask_md5=self._mask_md5(o)),
+        )
+
+    def _mask_md5(self, o):
+        """
+        Returns the md5 of the custom mask file for `o`, or None if there isn't
+        one. Memoized on the file's mtime and size.
+        """
+        if o.get("mask_state", "") != "done":
+            return None
+        fn = f'{self._dir}/{o["mask_fn"]}'
+        st = os.stat(fn)
+        sig = (st.st_mtime_ns, st.st_size)
+        memo = self._mask_md5s.get(fn)
+        if memo is None or memo[0] != sig:
+            memo = (sig, md5_file(fn))
+            self._mask_md5s[fn] = memo
+        return memo[1]
+
     def masked_thumbnail(self, n, sz, color=(255, 0, 255)):
         """
         Like cropped_jpg but draws the mask on if present.
         """
-        o = self._data[n]
-        img = Image.open(io.BytesIO(self.cropped_jpg(n, sz)))
-        mask = Image.open(io.BytesIO(self.cropped_mask(n, sz)))
-        color = Image.new("RGB", img.size, color=color)
-        img = Image.composite(img, color, mask).convert("RGB")
-        s = io.BytesIO()
-        img.save(s, format="jpeg", quality=95)
-        return s.getvalue()
+        return render_masked(self.cropped_jpg(n, sz), self.cropped_mask(n, sz), color)
 
     def crop_preview(self, n, x, y, wh, sz):
         """
@@ -210,13 +1979,7 @@ class Dataset:
         o["y"] = y
         o["w"] = wh
         o["h"] = wh
-        o["sz"] = sz
-        # TODO: change this to verbose logging.
-        print(f"crop_preview for {o}")
-        img = load_and_transform(o, sz, sz, dsdir=self._dir).convert("RGB")
-        s = io.BytesIO()
-        img.save(s, format="jpeg", quality=95)
-        return s.getvalue()
+        return render_preview(o, sz, self._dir)
 
     def rotate_preview(self, n, rot, sz):
         """
@@ -225,41 +1988,846 @@ class Dataset:
         """
         o = self._data[n].copy()
         o["rot"] = rot
-        o["sz"] = sz
-        # TODO: change this to verbose logging.
-        print(f"rotate_preview for {o}")
-        img = load_and_transform(o, sz, sz, dsdir=self._dir).convert("RGB")
-        s = io.BytesIO()
-        img.save(s, format="jpeg", quality=95)
-        return s.getvalue()
+        return render_preview(o, sz, self._dir)
+
+
+class ShardRecords(collections.abc.MutableMapping):
+    """
+    Map from N to metadata object over the loaded shards of a ShardedDataset.
+    """
+
+    def __init__(self, ds):
+        self._ds = ds
+
+    def _records(self, n):
+        shard = self._ds._shards.get(n % self._ds.num_shards)
+        if shard is None:
+            raise KeyError(n)
+        return shard._data
+
+    def __getitem__(self, n):
+        return self._records(n)[n]
+
+    def __setitem__(self, n, obj):
+        self._records(n)[n] = obj
+
+    def __delitem__(self, n):
+        del self._records(n)[n]
+
+    def __contains__(self, n):
+        try:
+            return n in self._records(n)
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        for shard in self._ds._shards.values():
+            yield from shard._data
+
+    def __len__(self):
+        return sum(len(shard._data) for shard in self._ds._shards.values())
+
+    def values(self):
+        return [o for s in self._ds._shards.values() for o in s._data.values()]
+
+    def items(self):
+        return [i for s in self._ds._shards.values() for i in s._data.items()]
+
+
+def _index_shard(fn):
+    """
+    Runs in a worker process: loading a shard brings its index up to date, so
+    loading it again is quick.
+    """
+    Dataset(fn, with_cache=False).close()
+
+
+def _compact_shard(fn):
+    """
+    Runs in a worker process: compact_log() for a shard.
+    """
+    with Dataset(fn, with_cache=False) as ds:
+        if ds.stale_lines():
+            ds.compact_log()
+
+
+def _snapshot_shard(fn):
+    """
+    Runs in a worker process: write_snapshot() for a shard.
+    """
+    with Dataset(fn, with_cache=False) as ds:
+        ds.write_snapshot()
+
+
+class ShardedDataset(Dataset):
+    """
+    A dataset split across several files by N: a directory with MANIFEST, and
+    record N in shard file N % num_shards. Works like a Dataset, except that
+    loading, compact_log() and write_snapshot() run on the shards in parallel
+    in `jobs` processes.
+
+    With `shard`, only that shard is loaded, so e.g. several captioners can each
+    work on their own shard. Adding records without N needs all shards.
+
+    Originals and masks are relative to the directory containing the dataset
+    directory, and the thumbnail cache is in the dataset directory.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, fn, cache_dir=None, cache_backend=None, shard=None, jobs=None):
+        fn = os.path.normpath(fn)
+        self._fn = fn
+        self._dir = os.path.dirname(os.path.abspath(fn))
+        self._maskdir = os.path.basename(os.path.abspath(fn)) + ".masks"
+        # Held while assigning N to new records.
+        self._lockfn = f"{fn}/manifest.lock"
+        self._jobs = jobs or os.cpu_count()
+        with open(f"{fn}/{self.MANIFEST}") as f:
+            self.num_shards = json.load(f)["shards"]
+        ids = range(self.num_shards) if shard is None else [shard]
+        stale = [self._shard_fn(i) for i in ids if self._needs_index(i)]
+        self._map(_index_shard, stale)
+        self._shards = {i: Dataset(self._shard_fn(i), with_cache=False) for i in ids}
+        self._data = ShardRecords(self)
+        self._open_cache(f"{fn}/{self.SHARED_CACHE}", cache_dir, cache_backend)
+
+    @classmethod
+    def create(cls, fn, num_shards):
+        """
+        Creates an empty sharded dataset.
+        """
+        os.makedirs(fn)
+        with atomic_write(f"{fn}/{cls.MANIFEST}") as f:
+            f.write(json.dumps({"shards": num_shards}).encode())
+
+    def _shard_fn(self, i):
+        return f"{self._fn}/{i:05d}.json"
+
+    def _needs_index(self, i):
+        """
+        Returns True if shard i was changed since its index or snapshot was
+        written, so it'd be parsed when loaded.
+        """
+        fn = self._shard_fn(i)
+        try:
+            mtime = os.path.getmtime(fn)
+        except FileNotFoundError:
+            return False
+        for ext in [".idx", ".snap"]:
+            if os.path.exists(fn + ext) and os.path.getmtime(fn + ext) >= mtime:
+                return False
+        return True
+
+    def _map(self, func, fns):
+        """
+        Runs func(fn) for each of fns, in parallel processes if there's more
+        than one.
+        """
+        if len(fns) > 1 and self._jobs > 1:
+            jobs = min(len(fns), self._jobs)
+            with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+                list(pool.map(func, fns))
+        else:
+            for fn in fns:
+                func(fn)
+
+    def _shard(self, n):
+        shard = self._shards.get(n % self.num_shards)
+        if shard is None:
+            raise ValueError(f"N {n} is in shard {n % self.num_shards}, not loaded")
+        return shard
+
+    def close(self):
+        self.flush()
+        for shard in self._shards.values():
+            shard.close()
+
+    def refresh(self):
+        return any([shard.refresh() for shard in self._shards.values()])
+
+    def next_n(self):
+        if len(self._shards) != self.num_shards:
+            raise ValueError("new records need all shards loaded")
+        return max(shard.next_n() for shard in self._shards.values())
+
+    def seen_fn(self, fn):
+        return any(shard.seen_fn(fn) for shard in self._shards.values())
+
+    def _select(self, conds):
+        return set().union(*(s._select(conds) for s in self._shards.values()))
+
+    def add_many(self, objs, keys=None):
+        if any("n" not in obj for obj in objs):
+            with flock(self._lockfn):
+                for shard in self._shards.values():
+                    shard.refresh()
+                n = self.next_n()
+                for obj in objs:
+                    if "n" not in obj:
+                        obj["n"] = n
+                        n += 1
+                self._add_to_shards(objs, keys)
+        else:
+            self._add_to_shards(objs, keys)
+
+    def _add_to_shards(self, objs, keys):
+        groups = {}
+        for obj in objs:
+            groups.setdefault(obj["n"] % self.num_shards, []).append(obj)
+        for i, group in groups.items():
+            self._shard(i).add_many(group, keys)
+
+    def update(self, obj, append):
+        self._shard(obj["n"]).update(obj, append)
+
+    def stale_lines(self):
+        return sum(shard.stale_lines() for shard in self._shards.values())
+
+    def needs_compact(self):
+        return any(shard.needs_compact() for shard in self._shards.values())
+
+    def compact(self):
+        # Records may have been renumbered, so they may change shards.
+        groups = {i: {} for i in self._shards}
+        for obj in self._data.values():
+            self._shard(obj["n"])
+            groups[obj["n"] % self.num_shards][obj["n"]] = obj
+        self.wait_for_compaction()
+        for i, shard in self._shards.items():
+            shard._data = groups[i]
+            shard.compact()
+        self._data = ShardRecords(self)
+
+    def compact_in_background(self):
+        for shard in self._shards.values():
+            if shard.needs_compact():
+                shard.compact_in_background()
+
+    def wait_for_compaction(self):
+        for shard in self._shards.values():
+            shard.wait_for_compaction()
+
+    def compact_log(self):
+        self.wait_for_compaction()
+        stale = [i for i, shard in self._shards.items() if shard.stale_lines()]
+        self._map(_compact_shard, [self._shard_fn(i) for i in stale])
+        for i in stale:
+            self._shards[i].refresh()
+
+    def write_snapshot(self):
+        self.wait_for_compaction()
+        self._map(_snapshot_shard, [self._shard_fn(i) for i in self._shards])
+        self.refresh()
+
+
+def open_dataset(fn, cache_dir=None, cache_backend=None, shard=None):
+    """
+    Opens a dataset file, or a sharded dataset directory (see ShardedDataset)
+    in which case `shard` picks a single shard to load.
+    """
+    if os.path.isdir(fn):
+        return ShardedDataset(fn, cache_dir, cache_backend, shard=shard)
+    if shard is not None:
+        raise ValueError(f"{fn} is not sharded")
+    return Dataset(fn, cache_dir, cache_backend)
+
+
+def gc_cache(cache, live):
+    """
+    Drops entries from `cache` whose crop_id isn't in the set `live`.
+    Returns the number of entries dropped.
+    """
+    return cache.gc(lambda key: cache_key_crop_id(key) in live)
+
+
+def md5_file(fn):
+    """
+    Returns the hex md5sum of the given filename. Memory use doesn't depend on
+    the file size: it's read through one reused buffer.
+    """
+    h = hashlib.md5()
+    buf = bytearray(1 << 20)
+    view = memoryview(buf)
+    with open(fn, "rb", buffering=0) as f:
+        while size := f.readinto(buf):
+            h.update(view[:size])
+    return h.hexdigest()
+
+
+class StatIndex:
+    """
+    Persistent map from a file's path to its md5, image size and dhash, so
+    files that haven't changed don't need to be read again. An entry only counts
+    while the file's size, mtime and inode are what they were when it was
+    read (see stat).
+
+    Lives next to a dataset, see for_dataset. Writes are committed by
+    flush(), or on leaving the context.
+    """
+
+    def __init__(self, fn):
+        self._db = sqlite3.connect(fn, timeout=60)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS files("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, ino INTEGER, "
+            "md5 TEXT, w INTEGER, h INTEGER, dhash TEXT"
+            ")"
+        )
+        cols = [i[1] for i in self._db.execute("PRAGMA table_info(files)")]
+        if "dhash" not in cols:
+            self._db.execute("ALTER TABLE files ADD COLUMN dhash TEXT")
+        self._db.commit()
+
+    @classmethod
+    def for_dataset(cls, fn):
+        """
+        Opens the index for the dataset file (or sharded dataset dir) fn.
+        """
+        return cls(f"{fn}/files.stat" if os.path.isdir(fn) else f"{fn}.stat")
+
+    @staticmethod
+    def stat(path):
+        """
+        Returns the (size, mtime, inode) of path that entries are checked
+        against.
+        """
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns, st.st_ino
+
+    def get(self, path, st):
+        """
+        Returns (md5, w, h, dhash) for path if it was indexed with stat `st`,
+        or None. dhash is None if it wasn't computed.
+        """
+        return self._db.execute(
+            "SELECT md5, w, h, dhash FROM files WHERE path=? AND size=? AND mtime=? "
+            "AND ino=?",
+            (path, *st),
+        ).fetchone()
+
+    def put(self, path, st, md5, w, h, dhash=None):
+        self._db.execute(
+            "REPLACE INTO files VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+            (path, *st, md5, w, h, dhash),
+        )
+
+    def flush(self):
+        self._db.commit()
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def render_jpg(o, sz, dsdir="."):
+    """
+    Returns JPEG image data for metadata object `o`, cropped and scaled and
+    rotated.
+    """
+    img = load_and_transform(o, sz, sz, dsdir=dsdir, mode="RGB")
+    s = io.BytesIO()
+    img.save(s, format="jpeg", quality=95)
+    return s.getvalue()
+
+
+def render_mask(o, sz, dsdir="."):
+    """
+    Returns PNG image data for the mask for metadata object `o`, cropped and
+    scaled and rotated.
+    """
+    a = load_and_transform(o, sz, sz, dsdir=dsdir).getchannel("A")
+
+    # Apply a custom mask if present.
+    if o.get("mask_state", "") == "done":
+        om = o.copy()
+        om["fn"] = o["mask_fn"]
+        mask = load_and_transform(om, sz, sz, dsdir=dsdir, mode="L")
+        a = ImageChops.multiply(a, mask)
+
+    s = io.BytesIO()
+    a.save(s, format="png")
+    return s.getvalue()
+
+
+def render_masked(jpg, mask, color=(255, 0, 255)):
+    """
+    Returns JPEG image data for JPEG data `jpg` with `color` where PNG data
+    `mask` is transparent, see Dataset.masked_thumbnail.
+    """
+    img = Image.open(io.BytesIO(jpg))
+    mask = Image.open(io.BytesIO(mask))
+    color = Image.new("RGB", img.size, color=color)
+    img = Image.composite(img, color, mask).convert("RGB")
+    s = io.BytesIO()
+    img.save(s, format="jpeg", quality=95)
+    return s.getvalue()
+
+
+def render_preview(o, sz, dsdir="."):
+    """
+    Returns JPEG image data for metadata object `o`, cropped and scaled and
+    rotated, for previews in the web UI.
+    """
+    # TODO: change this to verbose logging.
+    print(f"preview for {o}")
+    img = load_and_transform(o, sz, sz, dsdir=dsdir, mode="RGB")
+    s = io.BytesIO()
+    img.save(s, format="jpeg", quality=95)
+    return s.getvalue()
+
+
+def render_prep_mask(o, dsdir, maskfn):
+    """
+    Writes the starting point for hand-drawing a mask for metadata object `o`
+    to {dsdir}/{maskfn}: the original, with any pixels that are already the
+    mask color darkened.
+    """
+    img = load_image(o["fn"], dsdir=dsdir).convert("RGB")
+    img = np.asarray(img).copy()  # copy to make it not readonly
+    rgb = np.asarray([255, 0, 255])
+    precision = 255 - (1 + 2 + 4 + 8)  # bitmask
+    # Darken full purple if it's present in the image.
+    cond = (img & precision) == (rgb & precision)
+    cond = cond.all(axis=2)
+    img[cond] = [200, 0, 200]
+    fn = f"{dsdir}/{maskfn}"
+    Image.fromarray(img).save(fn)
+    print(f"saved {fn}")
+
+
+class ImageCache:
+    """
+    Thread-safe LRU of decoded images, bounded by the bytes of pixel data
+    they hold. Entries are keyed on a path plus any extra load arguments, and
+    only used if the file's mtime and size still match, so edited files get
+    decoded again.
+
+    Cached images are shared: callers must not modify them in place.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._images = collections.OrderedDict()  # key -> (stat, img, size)
+        self._bytes = 0
+        self._counts = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def _size(img):
+        return img.width * img.height * len(img.getbands())
+
+    def get(self, path, load, *args):
+        """
+        Returns the image for (path, *args), calling load(path, *args) on a
+        miss.
+        """
+        key = (path, *args)
+        st = os.stat(path)
+        st = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            ent = self._images.get(key)
+            if ent is not None and ent[0] == st:
+                self._images.move_to_end(key)
+                self._counts["hits"] += 1
+                return ent[1]
+            self._counts["misses"] += 1
+
+        # Decode without holding the lock.
+        img = load(path, *args)
+        size = self._size(img)
+        with self._lock:
+            old = self._images.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            if size > self.max_bytes:
+                return img
+            self._images[key] = (st, img, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, _, sz) = self._images.popitem(last=False)
+                self._bytes -= sz
+                self._counts["evictions"] += 1
+        return img
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._counts)
+            out["entries"] = len(self._images)
+            out["bytes"] = self._bytes
+            out["max_bytes"] = self.max_bytes
+        return out
+
+
+# Speeds up e.g. multiple crops of the same original, and interleaved image and
+# mask loads. Each process has its own, see init_image_cache.
+image_cache = ImageCache(512 << 20)
+
+
+def init_image_cache(max_bytes):
+    """
+    Sets the budget of this process's image_cache, 0 disables it. Use this as
+    the initializer of process pools that render, with each worker's share.
+    """
+    image_cache.max_bytes = max_bytes
+    image_cache.clear()
+
 
+# Scale factors that JPEG decoders can apply while decoding (DCT scaling).
+DRAFT_SCALES = [8, 4, 2, 1]
 
-# A cache to speed up e.g. multiple crops of the same original.
-_load_cache = [("", None)]  # (fn, Image object)
+# EXIF orientations (see ImageOps.exif_transpose) that reverse the stored
+# image's x and y axes.
+_EXIF_FLIP_X = {2, 3, 6, 7}
+_EXIF_FLIP_Y = {3, 4, 7, 8}
 
 
-def load_image(fn, dsdir="."):
+def pyramid_scale(w, h, out_w, out_h):
     """
-    Load image and apply EXIF rotation. Returns an RGBA Image object.
+    Returns the largest power of two scale that still leaves at least
+    out_w x out_h pixels in a w x h crop.
     """
-    if _load_cache[0][0] == fn:
-        return _load_cache[0][1]
+    s = 1
+    while w >= out_w * s * 2 and h >= out_h * s * 2:
+        s *= 2
+    return s
+
+
+def _halve(img):
+    scale, pad_x, pad_y = img.info.get("scale", (1, 0, 0))
+    img = img.reduce(2)
+    img.info["scale"] = (scale * 2, pad_x, pad_y)
+    return img
+
 
-    img = Image.open(f"{dsdir}/{fn}")
+def _decode(path, reduce=1):
+    img = Image.open(path)
+    if reduce > 1 and (img.format != "JPEG" or reduce > DRAFT_SCALES[0]):
+        # Halve the level above, which stays in the cache for the next
+        # request at that scale.
+        img.close()
+        return _halve(image_cache.get(path, _decode, reduce // 2))
+    draft = None
+    if reduce > 1:
+        orientation = img.getexif().get(0x0112, 1)
+        src_w, src_h = img.size
+        draft = img.draft(img.mode, (max(1, src_w // reduce), max(1, src_h // reduce)))
+    # Only keep an alpha channel if there's transparency to keep.
+    alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
     img = ImageOps.exif_transpose(img)
-    img = img.convert("RGBA")
-    _load_cache[0] = (fn, img)
+    img = img.convert("RGBA" if alpha else "RGB")
+    if draft is not None:
+        # Decoded at 1/scale, with partial blocks at the right and bottom
+        # rounded up to a whole pixel. Where EXIF flips an axis, that partial
+        # pixel ends up first: note how far it sticks out so crops can be
+        # mapped back exactly.
+        scale = round(src_w / draft[1][2])
+        if orientation >= 5:
+            src_w, src_h = src_h, src_w
+        pad_x = img.width * scale - src_w if orientation in _EXIF_FLIP_X else 0
+        pad_y = img.height * scale - src_h if orientation in _EXIF_FLIP_Y else 0
+        img.info["scale"] = (scale, pad_x, pad_y)
     return img
 
 
-def load_and_transform(o, out_w, out_h, dsdir="."):
+def probe_image(path):
+    """
+    Returns the (width, height) of image file `path` after EXIF rotation, like
+    load_image would, but only reading its headers.
+    """
+    with Image.open(path) as img:
+        w, h = img.size
+        # PNGs look for EXIF after the pixel data if there's none before it,
+        # which means decoding them.
+        if img.format != "PNG" or "exif" in img.info:
+            if img.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+                w, h = h, w
+    return w, h
+
+
+def dhash(path):
+    """
+    Returns the 64 bit difference hash of image file `path`, as 16 hex digits:
+    one bit per pair of horizontally adjacent pixels in a 9x8 grayscale
+    thumbnail, set if the left one is brighter. Resized and re-encoded copies
+    of an image get the same or a nearby hash, see DupeIndex.
+    """
+    with Image.open(path) as img:
+        # Only the thumbnail matters, so let JPEGs decode at down to 1/8 as
+        # long as that leaves plenty of pixels to average.
+        img.draft("L", (72, 64))
+        img = ImageOps.exif_transpose(img)
+        img = img.convert("L").resize((9, 8), Image.Resampling.BOX)
+    px = np.asarray(img, dtype=np.int16)
+    return np.packbits(px[:, :-1] > px[:, 1:]).tobytes().hex()
+
+
+def _hash_chunks(max_dist):
+    """
+    Returns (shift, bits) for splitting a 64 bit hash into max_dist + 1
+    chunks: two hashes within max_dist bits agree on at least one chunk.
+    """
+    num = max_dist + 1
+    bounds = [round(i * 64 / num) for i in range(num + 1)]
+    return [(lo, hi - lo) for lo, hi in zip(bounds, bounds[1:])]
+
+
+def _popcount(x):
+    """
+    Returns the number of bits set in each element of uint64 array x.
+    """
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + (
+        (x >> np.uint64(2)) & np.uint64(0x3333333333333333)
+    )
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+
+class DupeIndex:
+    """
+    Finds near-duplicate images: keys whose dhash()es are within max_dist bits
+    of each other.
+
+    This is multi-index hashing: the hash is split into max_dist + 1 chunks,
+    each with a table from the chunk's value to the keys that have it. Any
+    hash within max_dist bits of a query agrees with it on some chunk, so only
+    the keys sharing a chunk with the query need comparing.
+
+    Hashes with almost no bits set (or almost all) are ignored: uniform and
+    low-detail images, e.g. blank frames or flat backgrounds of any color, all
+    hash like that without being duplicates.
+    """
+
+    # groups() splits runs of hashes sharing a chunk that are longer than this
+    # on the rest of the bits, rather than comparing all pairs.
+    MAX_RUN = 256
+
+    def __init__(self, max_dist=4):
+        self.max_dist = max_dist
+        self._chunks = _hash_chunks(max_dist)
+        self._tables = [{} for _ in self._chunks]
+        self._hashes = {}  # key -> int hash
+
+    @staticmethod
+    def degenerate(h, max_dist):
+        """
+        Returns True if int hash h is within max_dist bits of all 0s or all 1s.
+        """
+        bits = bin(h).count("1")
+        return bits <= max_dist or bits >= 64 - max_dist
+
+    def _keys(self, h):
+        for (shift, bits), table in zip(self._chunks, self._tables):
+            yield table, (h >> shift) & ((1 << bits) - 1)
+
+    def add(self, key, hexhash):
+        h = int(hexhash, 16)
+        if self.degenerate(h, self.max_dist):
+            return
+        self._hashes[key] = h
+        for table, chunk in self._keys(h):
+            table.setdefault(chunk, []).append(key)
+
+    def query(self, hexhash):
+        """
+        Returns a list of (distance, key) for the keys within max_dist bits of
+        hexhash, closest first.
+        """
+        h = int(hexhash, 16)
+        if self.degenerate(h, self.max_dist):
+            return []
+        found = {}
+        for table, chunk in self._keys(h):
+            for key in table.get(chunk, ()):
+                if key not in found:
+                    found[key] = bin(h ^ self._hashes[key]).count("1")
+        return sorted(
+            ((dist, key) for key, dist in found.items() if dist <= self.max_dist),
+            key=lambda i: i[0],
+        )
+
+    @classmethod
+    def groups(cls, keys, hexhashes, max_dist=4):
+        """
+        Batch version of query() for every pair at once: returns the groups
+        of keys connected by hashes within max_dist bits, each in the order
+        of `keys`. Like query(), this ignores degenerate hashes.
+        """
+        hashes = np.array([int(h, 16) for h in hexhashes], dtype=np.uint64)
+        bits = _popcount(hashes)
+        ok = (bits > max_dist) & (bits < 64 - max_dist)
+        keys = [k for k, i in zip(keys, ok.tolist()) if i]
+        hashes = hashes[ok]
+        # Identical hashes are always grouped, so only compare unique ones.
+        uniq, inverse = np.unique(hashes, return_inverse=True)
+        parent = list(range(len(uniq)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        pairs = []  # (a, b) arrays of indices into uniq within max_dist bits.
+
+        def compare_next(idx, count):
+            """
+            Finds the pairs within max_dist bits between each idx[i] and the
+            count[i] indices after it, a block of pairs at a time.
+            """
+            total = np.cumsum(count)
+            lo = 0
+            while lo < len(idx):
+                done = total[lo - 1] if lo else 0
+                hi = int(np.searchsorted(total, done + (1 << 22), "right"))
+                hi = max(lo + 1, hi)
+                c = count[lo:hi]
+                first = np.repeat(np.arange(lo, hi), c)
+                offset = np.arange(len(first)) - np.repeat(np.cumsum(c) - c, c)
+                a, b = idx[first], idx[first + offset + 1]
+                close = _popcount(uniq[a] ^ uniq[b]) <= max_dist
+                pairs.append((a[close], b[close]))
+                lo = hi
+
+        def compare(run, positions):
+            """
+            Finds the pairs within max_dist bits among the hashes in `run`,
+            which agree on all but the bits at `positions`. Like the chunks of
+            the whole hash, any two within max_dist bits agree on one of
+            max_dist + 1 parts of `positions`, so only hashes sharing a part
+            need comparing. Skewed hashes (few bits set) share parts a lot, so
+            runs longer than MAX_RUN are split the same way on the bits left.
+            """
+            if len(positions) <= max_dist:
+                pairs.append((run[:-1], run[1:]))  # They can't differ by more.
+                return
+            for part in np.array_split(positions, max_dist + 1):
+                mask = np.uint64(sum(1 << p for p in part.tolist()))
+                chunk = uniq[run] & mask
+                order = np.argsort(chunk, kind="stable")
+                run_sorted = run[order]
+                bounds = np.flatnonzero(np.diff(chunk[order])) + 1
+                bounds = np.concatenate([[0], bounds, [len(run)]])
+                lengths = np.diff(bounds)
+                long = lengths > cls.MAX_RUN
+                # Compare each hash in a short run with the ones after it.
+                ends = np.repeat(np.where(long, 0, bounds[1:]), lengths)
+                count = np.maximum(ends - np.arange(len(run)) - 1, 0)
+                compare_next(run_sorted, count)
+                rest = np.setdiff1d(positions, part)
+                for k in np.flatnonzero(long).tolist():
+                    compare(run_sorted[bounds[k] : bounds[k + 1]], rest)
+
+        if len(uniq) > 1:
+            compare(np.arange(len(uniq)), np.arange(64))
+        if pairs:
+            a = np.concatenate([a for a, _ in pairs])
+            b = np.concatenate([b for _, b in pairs])
+            for i, j in np.unique(np.stack([a, b], axis=1), axis=0).tolist():
+                i, j = find(i), find(j)
+                if i != j:
+                    parent[i] = j
+
+        groups = {}
+        for key, u in zip(keys, inverse.tolist()):
+            groups.setdefault(find(u), []).append(key)
+        return [g for g in groups.values() if len(g) > 1]
+
+
+def load_image(fn, dsdir=".", cache=True, reduce=1):
     """
-    load_image for the given metadata object `o` and transform it: crop, scale to out_w x out_h,
-    and rotate. Returns an RGBA Image object.
+    Load image and apply EXIF rotation. Returns an RGB Image object, or RGBA
+    if the image has transparency. It may be shared with other callers (see
+    ImageCache) unless cache=False.
+
+    With reduce > 1 (a power of two), returns a level of the image's pyramid
+    at 1/reduce of its resolution. JPEGs decode at up to 1/8 directly (DCT
+    scaling), smaller levels are made by halving the next larger one. The
+    image's info["scale"] is then (scale, pad_x, pad_y): full resolution
+    (x, y) is at ((x + pad_x) / scale, (y + pad_y) / scale).
+    """
+    # Key on the full path: the same fn can mean different files in different
+    # datasets.
+    path = f"{dsdir}/{fn}"
+    if not cache:
+        return _decode(path, reduce)
+    return image_cache.get(path, _decode, reduce)
+
+
+def _coverage(start, step, n, limit):
+    """
+    Returns the fraction of each of n output pixels, the first starting at
+    `start` and each `step` wide, that lies within [0, limit).
+    """
+    lo = start + np.arange(n) * step
+    return np.clip((np.minimum(lo + step, limit) - np.maximum(lo, 0)) / step, 0, 1)
+
+
+def _resize_padded(img, box, out_w, out_h):
+    """
+    Like img.resize((out_w, out_h), box=box) for a box that sticks out of img.
+    Only the output pixels that overlap img are resampled. Returns the result,
+    black where it's outside img, and an "L" image of how much of each pixel
+    is inside img (None if img has its own alpha, which covers that).
+    """
+    x0, y0, x1, y1 = box
+    sx = (x1 - x0) / out_w
+    sy = (y1 - y0) / out_h
+    # Output pixels that overlap img, and the part of img they cover. At the
+    # edges that sticks out by less than a pixel, crop() pads it.
+    ox0 = min(out_w, max(0, math.floor(-x0 / sx)))
+    oy0 = min(out_h, max(0, math.floor(-y0 / sy)))
+    ox1 = max(ox0, min(out_w, math.ceil((img.width - x0) / sx)))
+    oy1 = max(oy0, min(out_h, math.ceil((img.height - y0) / sy)))
+    out = Image.new(img.mode, (out_w, out_h))
+    if ox0 < ox1 and oy0 < oy1:
+        bx0, by0 = x0 + ox0 * sx, y0 + oy0 * sy
+        bx1, by1 = x0 + ox1 * sx, y0 + oy1 * sy
+        ib = (math.floor(bx0), math.floor(by0), math.ceil(bx1), math.ceil(by1))
+        part = img.crop(ib).resize(
+            (ox1 - ox0, oy1 - oy0),
+            Image.Resampling.BICUBIC,
+            box=(bx0 - ib[0], by0 - ib[1], bx1 - ib[0], by1 - ib[1]),
+        )
+        out.paste(part, (ox0, oy0))
+    if img.mode == "RGBA":
+        return out, None
+    cover = np.outer(
+        _coverage(y0, sy, out_h, img.height), _coverage(x0, sx, out_w, img.width)
+    )
+    alpha = Image.fromarray((cover * 255 + 0.5).astype(np.uint8), "L")
+    return out, alpha
+
+
+def load_and_transform(o, out_w, out_h, dsdir=".", mode="RGBA"):
+    """
+    load_image for the given metadata object `o` and transform it: crop, scale
+    to out_w x out_h, and rotate. Returns an Image object in `mode`: with
+    "RGBA", the parts of the crop outside the original (see add.pad_to_square)
+    are transparent, otherwise they're black.
+
+    When the crop is at least twice the output size, it's taken from the
+    smallest level of the image's pyramid that still covers the output
+    resolution (see load_image), mapped onto it with subpixel precision.
+
+    The crop and scale are a single resample from the original, rotation is
+    a lossless transpose, and alpha is only computed where the crop is
+    padded.
     """
-    img = load_image(o["fn"], dsdir)
-    assert img.width == o["orig_w"], (img.width, o["orig_w"])  # TODO: warn instead
-    assert img.height == o["orig_h"]
     x, y, w, h = o["x"], o["y"], o["w"], o["h"]
     assert w > 0, w
     assert h > 0, h
@@ -269,7 +2837,29 @@ def load_and_transform(o, out_w, out_h, dsdir="."):
     assert out_h <= 1024, out_h
     rot = o.get("rot", 0)
     assert rot in [0, 1, 2, 3], rot
-    img = img.crop((x, y, x + w, y + h))
-    img = img.resize((out_w, out_h), Image.Resampling.BICUBIC)
-    img = img.rotate(rot * 90)
-    return img
+    img = load_image(o["fn"], dsdir, reduce=pyramid_scale(w, h, out_w, out_h))
+    scale, pad_x, pad_y = img.info.get("scale", (1, 0, 0))
+    # TODO: warn instead
+    assert img.width == -(-o["orig_w"] // scale), (img.width, o["orig_w"], scale)
+    assert img.height == -(-o["orig_h"] // scale)
+    x0, y0 = (x + pad_x) / scale, (y + pad_y) / scale
+    x1, y1 = x0 + w / scale, y0 + h / scale
+    alpha = None
+    if x0 >= 0 and y0 >= 0 and x1 <= img.width and y1 <= img.height:
+        img = img.resize((out_w, out_h), Image.Resampling.BICUBIC, box=(x0, y0, x1, y1))
+    else:
+        img, alpha = _resize_padded(img, (x0, y0, x1, y1), out_w, out_h)
+    if rot:
+        method = [
+            None,
+            Image.Transpose.ROTATE_90,
+            Image.Transpose.ROTATE_180,
+            Image.Transpose.ROTATE_270,
+        ][rot]
+        img = img.transpose(method)
+        if alpha is not None:
+            alpha = alpha.transpose(method)
+    if mode == "RGBA" and alpha is not None:
+        # The resampled colors are premultiplied by how much is inside.
+        return Image.merge("RGBa", (*img.split(), alpha)).convert("RGBA")
+    return img.convert(mode)
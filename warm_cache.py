@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Pre-render thumbnails and masks into the cache, in parallel.
+
+Keys that are already cached are skipped, so an interrupted run can just be
+restarted and it picks up where it left off.
+"""
+from util import open_dataset
+import argparse
+import collections
+import concurrent.futures
+import os
+import time
+import util
+
+
+def render(o, dsdir, todo):
+    """
+    Runs in a worker process. Renders the (key, sz, is_mask) items in `todo`
+    for metadata object `o` and returns a list of (key, data).
+    """
+    out = []
+    for key, sz, is_mask in todo:
+        if is_mask:
+            out.append((key, util.render_mask(o, sz, dsdir)))
+        else:
+            out.append((key, util.render_jpg(o, sz, dsdir)))
+    return out
+
+
+def find_missing(ds, sizes):
+    """
+    Yields (n, todo) for every record with something missing from the cache.
+    """
+    for n in ds._data:
+        todo = []
+        for sz in sizes:
+            jpg_key, mask_key = ds.cache_keys(n, sz)
+            if jpg_key not in ds._cache:
+                todo.append((jpg_key, sz, False))
+            if mask_key not in ds._cache:
+                todo.append((mask_key, sz, True))
+        if todo:
+            yield n, todo
+
+
+def warm(ds, args, pool):
+    print("looking for uncached records")
+    missing = list(find_missing(ds, args.sizes))
+    total = len(missing)
+    print(f"{total} of {len(ds._data)} records need rendering")
+
+    start = last_report = time.monotonic()
+    done = 0
+    renders = 0
+    in_flight = collections.deque()
+    missing = iter(missing)
+    while True:
+        # Keep the pool busy without queueing the whole dataset.
+        while len(in_flight) < args.jobs * 4:
+            try:
+                n, todo = next(missing)
+            except StopIteration:
+                break
+            in_flight.append(pool.submit(render, ds._data[n], ds._dir, todo))
+        if not in_flight:
+            break
+        try:
+            results = in_flight.popleft().result()
+        except Exception as e:
+            print(f"WARN: render failed: {e!r}")
+            results = []
+        for key, data in results:
+            ds._cache[key] = data
+        done += 1
+        renders += len(results)
+
+        now = time.monotonic()
+        if now - last_report >= args.report_secs or done == total:
+            last_report = now
+            elapsed = now - start
+            print(
+                f"{done}/{total} records, {renders} renders, "
+                f"{renders / elapsed:.1f} renders/sec"
+            )
+    ds.flush()
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("inputs", nargs="+", help="One or more dataset JSON files.")
+    p.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[512],
+        help="Thumbnail sizes to render.",
+    )
+    p.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes.",
+    )
+    p.add_argument(
+        "--image_cache_mb",
+        type=int,
+        default=256,
+        help="Memory for decoded originals, in MB of pixel data, split between "
+        "the workers. Each record's originals are only reused across its own "
+        "sizes and mask, so this needn't be big.",
+    )
+    p.add_argument(
+        "--report_secs",
+        type=float,
+        default=5,
+        help="How often to print progress.",
+    )
+    p.add_argument(
+        "--cache_dir",
+        default=None,
+        help="Use the shared thumbnail cache in this dir. (optional)",
+    )
+    p.add_argument(
+        "--cache_backend",
+        choices=sorted(util.CACHE_BACKENDS),
+        default=None,
+        help="Thumbnail cache implementation, when creating a new cache.",
+    )
+    args = p.parse_args()
+
+    pool = concurrent.futures.ProcessPoolExecutor(
+        args.jobs,
+        initializer=util.init_image_cache,
+        initargs=((args.image_cache_mb << 20) // args.jobs,),
+    )
+    with pool:
+        for fn in args.inputs:
+            print(f"loading {fn}")
+            ds = open_dataset(
+                fn, cache_dir=args.cache_dir, cache_backend=args.cache_backend
+            )
+            with ds:
+                warm(ds, args, pool)
+
+
+if __name__ == "__main__":
+    main()